@@ -12,20 +12,113 @@
 # the URL to the user's resources.
 
 # Here are defined the classes that create the Refresh Token and Access Token.
+#
+# Both tokens are kept in a TokenStore on disk: the Refresh Token doesn't
+# expire and the Access Token lasts about an hour, so most runs don't need to
+# talk to the authorization APIs at all.
 
 import urllib         # Open arbitrary resources by URL
 import urllib2        # basic and digest authentication, redirections, cookies  
+import os
+import json
+import time
+import calendar
+import re
+import threading
+import logging
 
 # sugarsync packages:
 import utils
 
+# same logger in all modules
+logger = logging.getLogger('sugarsync')
+
+
+class AuthorizationError(Exception):
+    '''Raised when SugarSync doesn't hand out the requested token.'''
+
+
+class TokenStore(object):
+    '''Persists tokens on disk as a JSON dictionary, readable only by the
+    current user (the Refresh Token is as good as the user's password).
+
+    Entries look like:
+        {"<cache key>": {"token": "...", "body": "<xml response>",
+                         "expires": 1370000000.0 or null}}
+    '''
+
+    DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.sugarsync',
+                                'tokens.json')
+
+    # an Access Token this close (in seconds) to its expiration is treated
+    # as expired, so it doesn't run out in the middle of a command
+    EXPIRY_MARGIN = 300
+
+    def __init__(self, path=None):
+        self.path = os.path.expanduser(path or self.DEFAULT_PATH)
+        self.tokens = self.load()
+
+    def load(self):
+        '''Returns the stored tokens, or an empty dict if the file is missing
+        or unreadable.'''
+        try:
+            with open(self.path) as stream:
+                return json.load(stream)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def save(self):
+        '''Writes the tokens to a temporary file created with 0600
+        permissions and renames it over the store, so a crash never leaves
+        a half written store behind.'''
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        temp_path = self.path + '.tmp'
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as stream:
+            json.dump(self.tokens, stream)
+        os.rename(temp_path, self.path)
+
+    def get(self, key):
+        '''Returns the entry stored under key if it is still valid, else
+        None.'''
+        entry = self.tokens.get(key)
+        if entry is None:
+            return None
+        expires = entry.get('expires')
+        if expires is not None and expires - self.EXPIRY_MARGIN <= time.time():
+            return None
+        return entry
+
+    def put(self, key, token, body, expires=None):
+        self.tokens[key] = {'token': token, 'body': body, 'expires': expires}
+        self.save()
+
+    def discard(self, key):
+        if self.tokens.pop(key, None) is not None:
+            self.save()
+
 
 class TokenFactory(object):
     '''Parent class for RefreshToken and AccessToken. The procedure for 
     creating a token is the same, only the API's url, user agent and
-    xml request string differ.'''
+    xml request string differ.
+    If a TokenStore is given, a valid token from the store is used instead
+    of making the request, and new tokens are saved in the store.'''
+
+    def __init__(self, object, store=None):
+        self.store = store
+        self.from_cache = False
+        if store is not None:
+            entry = store.get(object.cache_key)
+            if entry is not None:
+                self.token = entry['token']
+                self.response_body = entry['body']
+                self.expires = entry['expires']
+                self.from_cache = True
+                return
 
-    def __init__(self, object):
         self.response = self.get_authorization_response(object)
         self.response_url = self.response.geturl()
         self.response_headers = self.response.info()
@@ -36,6 +129,18 @@ class TokenFactory(object):
         self.response_body = self.response.read()
 
         self.token = self.response_headers.get('Location', '')
+        if self.token == '':
+            raise AuthorizationError("No token received from " + object.URL)
+        self.expires = object.get_expiration(self.response_body)
+
+        if store is not None:
+            store.put(object.cache_key, self.token, self.response_body,
+                      self.expires)
+
+    def get_expiration(self, response_body):
+        '''Returns when the token expires, as seconds since the epoch, or
+        None if it doesn't expire. Children override it.'''
+        return None
 
     def get_authorization_response(self, object):
         '''Defines the HTTP POST request to SugarSync's API and returns a 
@@ -51,7 +156,14 @@ class TokenFactory(object):
         # Make a request using HTTP POST because data keyword param. is not 
         # empty, if data is empty => GET request
         self.request = urllib2.Request(url, data=object.data, headers=headers)
-        response = utils.make_request(self.request)
+        try:
+            response = utils.make_request(self.request)
+        except utils.RequestError as e:
+            if e.code is not None and 400 <= e.code < 500:
+                # wrong credentials, or a revoked Refresh Token
+                raise AuthorizationError("{0} refused the authorization "
+                                         "request: {1}".format(url, e.code))
+            raise
 
         return response
 
@@ -84,17 +196,21 @@ class RefreshToken(TokenFactory):
     {*} - variable placeholder when using APP_AUTH_REQUEST_TEMPLATE.format(vars...)
     """
 
-    def __init__(self, *args):
+    def __init__(self, *args, **kwargs):
         '''Fills the template unique to this class with the request details: 
         replaces "{ }" from the template with arguments and calls
-        other helper methods.
+        other helper methods. Accepts a store=TokenStore() keyword argument.
         Cannot return anything, otherwise you get a Type error at runtime.'''
 
         self.data = self.template.format(*args)
+        # the password is not part of the key, it is never written to disk
+        username, application, access_key = args[0], args[2], args[3]
+        self.cache_key = 'refresh:{0}:{1}:{2}'.format(username, application,
+                                                      access_key)
         # To use super(), it needs to inherit from object, directly or not
         # All the classes that inherit from object are new style, 
         # classes >=python2.2
-        super(RefreshToken, self).__init__(self)
+        super(RefreshToken, self).__init__(self, kwargs.get('store'))
 
 
 class AccessToken(TokenFactory):
@@ -119,10 +235,130 @@ class AccessToken(TokenFactory):
     privateAccessKey - Developer application privateAccessKey
     refreshToken - token obtained using the user's username & password
     """
-    def __init__(self, *args):
+
+    # used when the response doesn't say when the token expires
+    LIFETIME = 3600
+
+    def __init__(self, *args, **kwargs):
+        '''Accepts a store=TokenStore() keyword argument.'''
         self.data = self.template.format(*args)
+        access_key, refresh_token = args[0], args[2]
+        self.cache_key = 'access:{0}:{1}'.format(access_key, refresh_token)
         # Call the parent class __init__ with itself as argument
-        super(AccessToken, self).__init__(self)
+        super(AccessToken, self).__init__(self, kwargs.get('store'))
+
+    def get_expiration(self, response_body):
+        expires = parse_expiration(response_body)
+        if expires is None:
+            return time.time() + self.LIFETIME
+        return expires
+
+
+def parse_expiration(response_body):
+    '''Reads <expiration> from an authorization response body, e.g.
+    2010-06-07T14:19:37.000-07:00, and converts it to seconds since the epoch.
+    Returns None if there's no expiration in the body.'''
+    match = re.search(r'<expiration>(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)'
+                      r'(?:\.\d+)?(Z|[+-]\d\d:?\d\d)?</expiration>',
+                      response_body or '')
+    if match is None:
+        return None
+    expires = calendar.timegm(time.strptime(match.group(1),
+                                            '%Y-%m-%dT%H:%M:%S'))
+    offset = match.group(2)
+    if offset and offset != 'Z':
+        sign = -1 if offset[0] == '-' else 1
+        offset = offset[1:].replace(':', '')
+        expires -= sign * (int(offset[:2]) * 3600 + int(offset[2:]) * 60)
+    return expires
+
+
+def get_access_token(username, password, application, access_key,
+                     private_access_key, store=None):
+    '''Returns an AccessToken, doing as few round-trips as possible:
+    a valid Access Token from the store needs none, a stored Refresh Token
+    saves the app-authorization request and the credentials are used only
+    when there's nothing usable in the store.'''
+
+    refresh = RefreshToken(username, password, application, access_key,
+                           private_access_key, store=store)
+    try:
+        return AccessToken(access_key, private_access_key, refresh.token,
+                           store=store)
+    except AuthorizationError:
+        if not refresh.from_cache:
+            raise
+        # the stored Refresh Token was revoked, e.g. the password changed
+        store.discard(refresh.cache_key)
+        refresh = RefreshToken(username, password, application, access_key,
+                               private_access_key, store=store)
+        return AccessToken(access_key, private_access_key, refresh.token,
+                           store=store)
+
+
+class TokenProvider(object):
+    '''Hands out a valid access token to any number of threads, for as long
+    as the program runs. The token is renewed from the Refresh Token
+    shortly before it expires, or when the server rejects it (see
+    invalidate()); one thread renews it while the others wait for the
+    result, so a batch of transfers makes one authorization request, not
+    one per transfer. Install it with utils.set_token_provider() and every
+    request gets the current token, whatever token its headers were built
+    with.'''
+
+    def __init__(self, username, password, application, access_key,
+                 private_access_key, store=None):
+        self.credentials = (username, password, application, access_key,
+                            private_access_key)
+        self.store = store
+        self.lock = threading.Lock()
+        self.refresh_token = None
+        self.access = None              # the current AccessToken
+
+    def get_token(self):
+        '''Returns the current access token, renewing it if needed.'''
+        with self.lock:
+            if self.access is None or self.expiring(self.access):
+                self.renew()
+            return self.access.token
+
+    def get_access(self):
+        '''Returns the current AccessToken, with the response body.'''
+        self.get_token()
+        return self.access
+
+    def invalidate(self, token):
+        '''The server rejected token (401); the next get_token() gets a
+        new one. Threads rejected with the same token renew it once.'''
+        with self.lock:
+            if self.access is not None and self.access.token == token:
+                if self.store is not None:
+                    self.store.discard(self.access.cache_key)
+                self.access = None
+
+    @staticmethod
+    def expiring(access):
+        return (access.expires is not None and
+                access.expires - TokenStore.EXPIRY_MARGIN <= time.time())
+
+    def renew(self):
+        access_key, private_access_key = self.credentials[3:]
+        if self.refresh_token is None:
+            self.refresh_token = RefreshToken(*self.credentials,
+                                              store=self.store)
+        try:
+            access = AccessToken(access_key, private_access_key,
+                                 self.refresh_token.token, store=self.store)
+        except AuthorizationError:
+            # the Refresh Token was revoked, e.g. the password changed
+            if self.store is not None:
+                self.store.discard(self.refresh_token.cache_key)
+            self.refresh_token = RefreshToken(*self.credentials,
+                                              store=self.store)
+            access = AccessToken(access_key, private_access_key,
+                                 self.refresh_token.token, store=self.store)
+        self.access = access
+        logger.debug("New access token, expires at %s", access.expires)
 
 
 
@@ -0,0 +1,294 @@
+#!/usr/bin/python
+
+"""
+Benchmarks the SugarSync client against a local mock of the API
+(mockserver.py), so it runs without network access or an account.
+
+Usage:
+    benchmark.py [options] [<scenario>...]
+    benchmark.py -h | --help
+
+Options:
+    <scenario>                list, download, segmented, upload, batch or startup; all of them if none is given
+    --files <n>               Files downloaded and uploaded [default: 20]
+    --size <bytes>            Size of each of them [default: 1048576]
+    --entries <n>             Entries of the folder listed [default: 2000]
+    --repeat <n>              Times the folder is listed, or the client started [default: 10]
+    -j --concurrency <n>      Concurrent transfers of the batch scenario [default: 4]
+    --segments <n>            Connections per file of the segmented scenario [default: 4]
+    --segment-size <bytes>    Size of the ranges of the segmented scenario [default: 262144]
+    --latency <seconds>       Latency the server adds to every request [default: 0]
+    --bandwidth <KBps>        Server bandwidth per connection, unlimited if not given
+    --error-rate <ratio>      Share of the requests failing with 503 [default: 0]
+    --json <file>             Write the results as JSON
+    --baseline <file>         Compare with results written by --json, exit with status 1 on a regression
+    --tolerance <ratio>       Regression allowed before failing [default: 0.2]
+
+Scenarios:
+list      - pages through a folder of --entries entries, --repeat times
+download  - downloads --files files, one after the other
+segmented - downloads --files files, one after the other, each over --segments connections
+upload    - creates and uploads --files files, one after the other
+batch     - downloads --files files, --concurrency at a time
+startup   - runs "sugarsync.py --version" --repeat times, each in a new interpreter
+
+For each scenario it reports the throughput, the p50 and p99 latency of
+one operation (a listing, a file) and the peak memory the scenario used,
+above what its process used before it started; each scenario runs in a
+process of its own.
+"""
+
+# Benchmark of the SugarSync Linux client. It was written with python2.7 in mind.
+
+from docopt import docopt   # docopt creates beautiful command-line interfaces
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+
+# sugarsync packages:
+import auth
+import utils
+from listing import iter_collection_contents
+from transfers import TransferBatch
+from mockserver import MockSugarSync
+from metrics import percentile
+
+SCENARIOS = ['list', 'download', 'segmented', 'upload', 'batch', 'startup']
+
+
+def timed(function, *args):
+    """Returns the seconds function(*args) took."""
+
+    started = time.time()
+    function(*args)
+    return time.time() - started
+
+
+def run_list(server, access_token, options):
+    contents_url = '{0}/folder/{1}/contents'.format(server.url,
+                                                    server.listing)
+    def list_folder():
+        for entry in iter_collection_contents(access_token, contents_url):
+            pass
+    return [timed(list_folder) for i in range(options['repeat'])], 0
+
+
+def run_download(server, access_token, options):
+    directory = tempfile.mkdtemp()
+    try:
+        latencies = [timed(download, access_token, url, directory)
+                     for url in server.downloads]
+    finally:
+        shutil.rmtree(directory)
+    return latencies, options['files'] * options['size']
+
+
+def download(access_token, url, directory):
+    filename = os.path.join(directory, url.split('/')[-2])
+    utils.FileDownloadAPI(access_token, url).download(filename)
+
+
+def run_segmented(server, access_token, options):
+    directory = tempfile.mkdtemp()
+    def download(url):
+        filename = os.path.join(directory, url.split('/')[-2])
+        utils.SegmentedDownloadAPI(access_token, url, options['segments'],
+                                   options['segment_size']).download(filename)
+    try:
+        latencies = [timed(download, url) for url in server.downloads]
+    finally:
+        shutil.rmtree(directory)
+    return latencies, options['files'] * options['size']
+
+
+def run_upload(server, access_token, options):
+    directory = tempfile.mkdtemp()
+    try:
+        local_path = os.path.join(directory, 'upload.bin')
+        with open(local_path, 'wb') as stream:
+            stream.write(os.urandom(options['size']))
+        folder_url = '{0}/folder/{1}'.format(server.url, server.root)
+        def upload(number):
+            creator = utils.FileCreation(access_token, folder_url)
+            file_data_url = creator.create_file('upload{0}.bin'.format(number),
+                                                'application/octet-stream')
+            utils.FileUploadAPI(access_token).upload_file(file_data_url,
+                                                          local_path)
+        latencies = [timed(upload, number)
+                     for number in range(options['files'])]
+    finally:
+        shutil.rmtree(directory)
+    return latencies, options['files'] * options['size']
+
+
+def run_batch(server, access_token, options):
+    directory = tempfile.mkdtemp()
+    latencies = []
+    def job(url):
+        latencies.append(timed(download, access_token, url, directory))
+        return options['size']
+    try:
+        batch = TransferBatch(options['concurrency'])
+        for url in server.downloads:
+            batch.add(url, job, url)
+        batch.run()
+        if batch.failed:
+            raise batch.failed[0][1]
+    finally:
+        shutil.rmtree(directory)
+    return latencies, batch.transferred
+
+
+def run_startup(server, access_token, options):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'sugarsync.py')
+    directory = tempfile.mkdtemp()      # for a log file, if one is written
+    def start():
+        subprocess.check_output([sys.executable, script, '--version'],
+                                cwd=directory)
+    try:
+        return [timed(start) for i in range(options['repeat'])], 0
+    finally:
+        shutil.rmtree(directory)
+
+
+def run_scenario(name, server, options, results):
+    """Runs in a process of its own, so that the peak memory is the
+    scenario's; puts the measures in the results queue. The process is a
+    fork of the benchmark, so the peak is measured from the memory it had
+    already, the mock server's and its data included."""
+
+    # kilobytes on Linux
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        utils.configure_session(pool_size=max(10, options['concurrency'],
+                                              options['segments']))
+        access = auth.get_access_token('bench@example.com', 'password',
+                                       'app', 'key', 'private key')
+        run = globals()['run_' + name]
+        started = time.time()
+        latencies, size = run(server, access.token, options)
+        elapsed = time.time() - started
+        results.put({
+            'scenario': name,
+            'operations': len(latencies),
+            'seconds': elapsed,
+            'operations_per_second': len(latencies) / elapsed,
+            'megabytes_per_second': size / (1024.0 * 1024) / elapsed,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'peak_memory_mb': (resource.getrusage(
+                        resource.RUSAGE_SELF).ru_maxrss - baseline) / 1024.0})
+    except Exception as e:
+        results.put({'scenario': name, 'error': repr(e)})
+
+
+def start_server(options):
+    """Starts the mock server, with the files of the scenarios."""
+
+    server = MockSugarSync(latency=options['latency'],
+                           bandwidth=options['bandwidth'],
+                           error_rate=options['error_rate'], seed=1)
+    server.start()
+    auth.RefreshToken.URL = server.url + '/app-authorization'
+    auth.AccessToken.URL = server.url + '/authorization'
+
+    server.listing = server.add_folder('listing')
+    for number in range(options['entries']):
+        server.add_file('entry{0}.txt'.format(number), 'x', server.listing)
+    data = os.urandom(options['size'])
+    server.downloads = ['{0}/file/{1}/data'.format(server.url,
+                            server.add_file('file{0}.bin'.format(number), data))
+                        for number in range(options['files'])]
+    return server
+
+
+def compare(results, baseline, tolerance):
+    """Returns the regressions of results compared with baseline, as text."""
+
+    regressions = []
+    before = dict((result['scenario'], result) for result in baseline)
+    for result in results:
+        old = before.get(result['scenario'])
+        if old is None or 'error' in old or 'error' in result:
+            continue
+        if (result['operations_per_second'] <
+                old['operations_per_second'] * (1 - tolerance)):
+            regressions.append("{0}: throughput {1:.1f} ops/s, was "
+                               "{2:.1f}".format(result['scenario'],
+                                                result['operations_per_second'],
+                                                old['operations_per_second']))
+        if result['p99_ms'] > old['p99_ms'] * (1 + tolerance):
+            regressions.append("{0}: p99 {1:.1f} ms, was {2:.1f}".format(
+                                result['scenario'], result['p99_ms'],
+                                old['p99_ms']))
+    return regressions
+
+
+def print_results(results):
+    print("{0:<10} {1:>6} {2:>9} {3:>9} {4:>9} {5:>9} {6:>9}".format(
+            'scenario', 'ops', 'ops/s', 'MB/s', 'p50 ms', 'p99 ms', 'peak MB'))
+    for result in results:
+        if 'error' in result:
+            print("{0:<10} failed: {1}".format(result['scenario'],
+                                               result['error']))
+            continue
+        print("{scenario:<10} {operations:>6} {operations_per_second:>9.1f} "
+              "{megabytes_per_second:>9.2f} {p50_ms:>9.1f} {p99_ms:>9.1f} "
+              "{peak_memory_mb:>9.1f}".format(**result))
+
+
+### MAIN ####
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__, help=True)
+    scenarios = arguments['<scenario>'] or SCENARIOS
+    for name in scenarios:
+        if name not in SCENARIOS:
+            sys.exit("Unknown scenario {0}".format(name))
+
+    bandwidth = arguments['--bandwidth']
+    options = {'files': int(arguments['--files']),
+               'size': int(arguments['--size']),
+               'entries': int(arguments['--entries']),
+               'repeat': int(arguments['--repeat']),
+               'concurrency': int(arguments['--concurrency']),
+               'segments': int(arguments['--segments']),
+               'segment_size': int(arguments['--segment-size']),
+               'latency': float(arguments['--latency']),
+               'bandwidth': float(bandwidth) * 1024 if bandwidth else None,
+               'error_rate': float(arguments['--error-rate'])}
+
+    # only the problems, not every transfer
+    logging.getLogger('sugarsync').setLevel(logging.WARNING)
+    server = start_server(options)
+    results = []
+    for name in scenarios:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_scenario,
+                                          args=(name, server, options, queue))
+        process.start()
+        results.append(queue.get())
+        process.join()
+    server.stop()
+    print_results(results)
+
+    if arguments['--json']:
+        with open(arguments['--json'], 'w') as stream:
+            json.dump(results, stream, indent=2)
+    failed = any('error' in result for result in results)
+    if arguments['--baseline']:
+        with open(arguments['--baseline']) as stream:
+            regressions = compare(results, json.load(stream),
+                                  float(arguments['--tolerance']))
+        for regression in regressions:
+            print("REGRESSION\t" + regression)
+        failed = failed or bool(regressions)
+    sys.exit(1 if failed else 0)
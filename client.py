@@ -0,0 +1,119 @@
+#!/usr/bin/python
+
+"""Contains a non-blocking facade over the classes of auth.py and utils.py,
+for programs that make many requests at once, e.g. thousands of metadata
+calls: every call returns right away with a pending result, and the
+requests are made by a bounded pool of worker threads, at most
+concurrency of them at a time, however many calls are queued.
+
+    client = SugarSyncClient(concurrency=32)
+    client.authorize(username, password, application, access_key,
+                     private_access_key).get()
+    results = [client.get(url) for url in urls]
+    for resource in client.gather(results):
+        print(resource.xml_info.pprint())
+    client.close()
+
+The blocking classes are unchanged and are what the workers run; the
+results are multiprocessing.pool.AsyncResult objects: .get(timeout)
+returns the value or raises the exception of the call, .ready() tells if
+it finished."""
+
+from multiprocessing.pool import ThreadPool   # a Pool of threads, not processes
+
+# sugarsync packages:
+from auth import get_access_token
+from utils import (SugarSyncHTTPGetUtil, FileDownloadAPI, FileCreation,
+                   FileUploadAPI)
+
+
+class SugarSyncClient(object):
+    '''Queues SugarSync API calls on concurrency worker threads. All the
+    calls share the HTTP session of utils, so its pool_size should be at
+    least concurrency, see utils.configure_session(); otherwise the extra
+    connections are opened for one request and closed.
+
+    The calls made after authorize() use its access token; wait for the
+    result of authorize() before queuing them.'''
+
+    def __init__(self, access_token=None, concurrency=16):
+        self.access_token = access_token
+        self.concurrency = concurrency
+        self.pool = ThreadPool(concurrency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, function, *args, **kwargs):
+        '''Queues function(*args, **kwargs), returns an AsyncResult.'''
+        return self.pool.apply_async(function, args, kwargs)
+
+    def authorize(self, username, password, application, access_key,
+                  private_access_key, store=None):
+        '''Gets an access token, see auth.get_access_token(); the result is
+        the auth.AccessToken.'''
+
+        def authorize():
+            access = get_access_token(username, password, application,
+                                      access_key, private_access_key, store)
+            self.access_token = access.token
+            return access
+        return self.submit(authorize)
+
+    def get(self, url):
+        '''GETs a resource; the result is the utils.SugarSyncHTTPGetUtil,
+        with .info and .xml_info.'''
+
+        def get():
+            return SugarSyncHTTPGetUtil(self.access_token, url)
+        return self.submit(get)
+
+    def create_file(self, folder_url, display_name, media_type):
+        '''Creates a file representation in a folder; the result is its
+        fileData URL.'''
+
+        def create_file():
+            creator = FileCreation(self.access_token, folder_url)
+            return creator.create_file(display_name, media_type)
+        return self.submit(create_file)
+
+    def upload(self, file_data_url, local_path, use_mmap=False):
+        '''Uploads a local file; the result is the HTTP response.'''
+
+        def upload():
+            return FileUploadAPI(self.access_token).upload_file(
+                                        file_data_url, local_path, use_mmap)
+        return self.submit(upload)
+
+    def download(self, file_data_url, filename, chunk_size=None,
+                 checksum=None):
+        '''Downloads file data to filename; the result is the checksum, if
+        one was asked for, see utils.FileDownloadAPI.download().'''
+
+        def download():
+            downloader = FileDownloadAPI(self.access_token, file_data_url)
+            return downloader.download(filename, chunk_size, checksum)
+        return self.submit(download)
+
+    def map(self, function, iterable):
+        '''Queues function(item) for each item; returns an AsyncResult
+        whose value is the list of the results, in order.'''
+        return self.pool.map_async(function, iterable)
+
+    @staticmethod
+    def gather(results, timeout=None):
+        '''Waits for the AsyncResults and returns their values, in order.
+        The first failed call raises its exception.'''
+        return [result.get(timeout) for result in results]
+
+    def close(self):
+        '''Waits for the queued calls to finish and stops the workers.'''
+        self.pool.close()
+        self.pool.join()
+
+
+if __name__ == '__main__':
+    print("This file should not be used directly, it is used by sugarsync.py.")
@@ -0,0 +1,214 @@
+#!/usr/bin/python
+
+"""Contains a local cache of the content of the downloaded files, so that
+downloading again a file that didn't change remotely copies it from the
+disk instead of fetching it from the server."""
+
+import os
+import time
+import errno
+import shutil
+import hashlib
+import sqlite3
+import logging
+import tempfile
+import threading
+
+# sugarsync packages:
+from utils import hash_file
+
+# same logger in all modules
+logger = logging.getLogger('sugarsync')
+
+
+class ContentCache(object):
+    '''Stores copies of downloaded files in a directory, keyed by the
+    fileData URL and the version of the remote file (its size and
+    lastModified, as listed by the server): a new version is a different
+    key, so a changed file is never served from the cache.
+
+    The SQLite index next to the copies records their size, SHA-1 and when
+    they were last used. Once the copies take more than max_bytes, the
+    least recently used ones are deleted. A copy is checked against its
+    SHA-1 before being served, and dropped if it doesn't match, e.g. after
+    the disk or someone changed it.
+
+    With link=True, hits are hard links to the cached copy instead of
+    copies, and downloaded files are added the same way, which costs no
+    disk space; a downloaded file changed in place then changes the copy
+    too, which the check catches. Links fall back to copies across file
+    systems.'''
+
+    DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.sugarsync',
+                                'content')
+    MAX_BYTES = 1024 * 1024 * 1024
+
+    def __init__(self, path=None, max_bytes=None, link=False):
+        self.path = os.path.expanduser(path or self.DEFAULT_PATH)
+        self.max_bytes = self.MAX_BYTES if max_bytes is None else max_bytes
+        self.link = link
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, 0o700)
+        # the connection is shared by the worker threads, one at a time
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(self.path, 'index.db'),
+                                          check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS contents ('
+                                    'url TEXT, '
+                                    'version TEXT, '
+                                    'name TEXT, '
+                                    'size INTEGER, '
+                                    'sha1 TEXT, '
+                                    'used REAL, '
+                                    'PRIMARY KEY (url, version))')
+
+    @staticmethod
+    def version_of(size, last_modified):
+        '''Returns the version key of a remote file, None if the listing
+        tells neither its size nor when it was modified.'''
+        if size is None and last_modified is None:
+            return None
+        return '{0}/{1}'.format(size, last_modified)
+
+    def blob_path(self, name):
+        return os.path.join(self.path, name)
+
+    def lookup(self, url, version):
+        '''Returns a dict with the name, size and sha1 of the copy of url,
+        or None if it's not in the cache.'''
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT name, size, sha1 FROM contents WHERE url = ? AND '
+                'version = ?', (url, version)).fetchone()
+        if row is None:
+            return None
+        return {'name': row[0], 'size': row[1], 'sha1': row[2]}
+
+    def get(self, url, version, filename):
+        '''Writes the cached content of url to filename and returns its
+        SHA-1; returns None, leaving filename alone, if there is no valid
+        copy of this version.'''
+
+        entry = self.lookup(url, version)
+        if entry is None:
+            return None
+        blob = self.blob_path(entry['name'])
+        try:
+            valid = (os.path.getsize(blob) == entry['size'] and
+                     hash_file(blob, 'sha1') == entry['sha1'])
+        except OSError:
+            valid = False
+        if not valid:
+            logger.warning("Cached copy of {0} is damaged, dropping "
+                           "it".format(url))
+            self.remove(url, version)
+            return None
+
+        # a link made before is already the copy; otherwise filename is
+        # replaced at once, like a download does
+        if not (os.path.exists(filename) and os.path.samefile(blob, filename)):
+            temp_filename = filename + '.part'
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            if not (self.link and self.try_link(blob, temp_filename)):
+                shutil.copyfile(blob, temp_filename)
+            os.rename(temp_filename, filename)
+        with self.lock, self.connection:
+            self.connection.execute('UPDATE contents SET used = ? WHERE '
+                                    'url = ? AND version = ?',
+                                    (time.time(), url, version))
+        return entry['sha1']
+
+    def put(self, url, version, filename):
+        '''Adds the content of filename, just downloaded from url, to the
+        cache, then evicts what no longer fits. A file larger than the whole
+        cache isn't added.'''
+
+        size = os.path.getsize(filename)
+        if size > self.max_bytes:
+            return
+        name = hashlib.sha1('{0} {1}'.format(url, version)).hexdigest()
+        blob = self.blob_path(name)
+        # written beside, then renamed, so that no reader sees half a copy
+        descriptor, temp_blob = tempfile.mkstemp(dir=self.path,
+                                                 suffix='.part')
+        os.close(descriptor)
+        os.remove(temp_blob)
+        if not (self.link and self.try_link(filename, temp_blob)):
+            shutil.copyfile(filename, temp_blob)
+        sha1 = hash_file(temp_blob, 'sha1')
+        os.rename(temp_blob, blob)
+        with self.lock, self.connection:
+            # the older versions of the file won't be asked for again
+            older = self.connection.execute(
+                'SELECT name FROM contents WHERE url = ? AND version != ?',
+                (url, version)).fetchall()
+            self.connection.execute('DELETE FROM contents WHERE url = ? AND '
+                                    'version != ?', (url, version))
+            self.connection.execute(
+                'INSERT OR REPLACE INTO contents VALUES (?, ?, ?, ?, ?, ?)',
+                (url, version, name, size, sha1, time.time()))
+        for row in older:
+            self.delete_blob(row[0])
+        self.evict()
+
+    @staticmethod
+    def try_link(source, destination):
+        '''Hard links destination to source; returns False if the file
+        system can't, e.g. across devices.'''
+        try:
+            os.link(source, destination)
+            return True
+        except OSError as e:
+            if e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK,
+                           errno.ENOTSUP):
+                return False
+            raise
+
+    def size(self):
+        '''Returns how many bytes the cached copies take.'''
+        with self.lock:
+            return self.connection.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM contents').fetchone()[0]
+
+    def evict(self):
+        '''Deletes the least recently used copies until the others fit in
+        max_bytes.'''
+        with self.lock, self.connection:
+            rows = self.connection.execute(
+                'SELECT url, version, name, size FROM contents '
+                'ORDER BY used DESC').fetchall()
+            total = 0
+            for url, version, name, size in rows:
+                total += size
+                if total > self.max_bytes:
+                    self.connection.execute('DELETE FROM contents WHERE '
+                                            'url = ? AND version = ?',
+                                            (url, version))
+                    self.delete_blob(name)
+                    logger.debug("Evicted %s from the content cache", url)
+
+    def remove(self, url, version):
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                'SELECT name FROM contents WHERE url = ? AND version = ?',
+                (url, version)).fetchone()
+            self.connection.execute('DELETE FROM contents WHERE url = ? AND '
+                                    'version = ?', (url, version))
+        if row is not None:
+            self.delete_blob(row[0])
+
+    def delete_blob(self, name):
+        try:
+            os.remove(self.blob_path(name))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def close(self):
+        self.connection.close()
+
+
+if __name__ == '__main__':
+    print("This file should not be used directly, it is used by sugarsync.py.")
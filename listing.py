@@ -0,0 +1,219 @@
+#!/usr/bin/python
+
+"""Contains the classes used for listing and looking up the contents of 
+SugarSync folders (collections)."""
+
+import os.path
+import fnmatch
+import urllib2
+import collections
+import Queue
+from multiprocessing.pool import ThreadPool   # a Pool of threads, not processes
+import xml.etree.ElementTree as ET        # convert to and from XML
+
+# sugarsync packages:
+from utils import make_request, SugarSyncHTTPGetUtil
+from metacache import CachedHTTPGetUtil
+
+
+# One item of a collection's contents, either a <file> or a <collection>:
+#   kind - "file", or the collection's type, e.g. "folder", "syncFolder"
+#   name - displayName
+#   ref - URL of the file or collection resource
+#   url - fileData URL of a file, contents URL of a collection
+#   size, last_modified - of a file, None for collections
+Entry = collections.namedtuple('Entry', 'kind name ref url size last_modified')
+
+
+class ContentsPage(object):
+    '''Parses a <collectionContents> document incrementally while it is read
+    from stream, yielding an Entry for each file or collection, so that
+    neither the document nor the element tree is ever held whole in memory.
+
+    <collectionContents start="0" hasMore="true" end="499">
+        <collection type="folder">...</collection>
+        <file>...</file>
+        ...
+    </collectionContents>
+    '''
+
+    def __init__(self, stream):
+        self.stream = stream            # anything with .read(size)
+        # set from the root element's attributes while iterating:
+        self.has_more = False
+        self.end = None
+
+    def __iter__(self):
+        depth = 0
+        root = None
+        for event, element in ET.iterparse(self.stream, ('start', 'end')):
+            if event == 'start':
+                depth += 1
+                if depth == 1:
+                    root = element
+                    self.has_more = element.get('hasMore') == 'true'
+                    end = element.get('end')
+                    self.end = int(end) if end is not None else None
+                continue
+            depth -= 1
+            if depth == 1:
+                yield self.make_entry(element)
+                # forget the entries already handed out
+                root.clear()
+
+    @staticmethod
+    def make_entry(element):
+        if element.tag == 'file':
+            size = element.findtext('size')
+            return Entry('file', element.findtext('displayName'),
+                         element.findtext('ref'), element.findtext('fileData'),
+                         int(size) if size else None,
+                         element.findtext('lastModified'))
+        return Entry(element.get('type', 'folder'),
+                     element.findtext('displayName'), element.findtext('ref'),
+                     element.findtext('contents'), None, None)
+
+
+def iter_collection_contents(access_token, contents_url, page_size=500,
+                             cache=None):
+    '''Yields the Entry records of a collection's contents, as they arrive.
+    The contents are requested page_size entries at a time, using the
+    start and max parameters of the API, and each page is parsed while it
+    is being downloaded. With a metacache.MetadataCache the pages go
+    through the cache instead.'''
+
+    separator = '&' if '?' in contents_url else '?'
+    headers = {'User-Agent': SugarSyncHTTPGetUtil.user_agent,
+               'Authorization': access_token}
+    start = 0
+    while True:
+        url = '{0}{1}start={2}&max={3}'.format(contents_url, separator, start,
+                                               page_size)
+        if cache is not None:
+            stream = CachedHTTPGetUtil(access_token, url, cache,
+                                       parse=False).stream
+        else:
+            stream = make_request(urllib2.Request(url, headers=headers))
+        page = ContentsPage(stream)
+        count = 0
+        for entry in page:
+            count += 1
+            yield entry
+        if not page.has_more or count == 0:
+            break
+        start = page.end + 1 if page.end is not None else start + count
+
+
+def walk_collection(access_token, contents_url, max_depth=None, 
+                    concurrency=4, page_size=500, cache=None):
+    '''Yields (path, Entry) pairs for everything below a collection, like
+    os.walk() but flat: path is the entry's name prefixed by the names of
+    the collections above it, e.g. "Photos/2013/beach.jpg".
+
+    The sub-collections found are listed concurrently, by at most
+    concurrency worker threads; max_depth=1 lists only the collection
+    itself, None has no limit. The order of the entries depends on which
+    listing finishes first.'''
+
+    def list_collection(prefix, url, depth):
+        # runs in a worker thread; the whole listing of one collection, or
+        # the exception that stopped it, is handed back at once
+        try:
+            return prefix, depth, list(iter_collection_contents(
+                                    access_token, url, page_size, cache))
+        except Exception as e:
+            return prefix, depth, e
+
+    results = Queue.Queue()
+    pool = ThreadPool(concurrency)
+    
+    def submit(prefix, url, depth):
+        pool.apply_async(list_collection, (prefix, url, depth),
+                         callback=results.put)
+
+    try:
+        submit('', contents_url, 1)
+        pending = 1
+        while pending:
+            try:
+                # without a timeout, Ctrl+C isn't handled while waiting
+                prefix, depth, entries = results.get(timeout=1)
+            except Queue.Empty:
+                continue
+            pending -= 1
+            if isinstance(entries, Exception):
+                raise entries
+            for entry in entries:
+                path = prefix + entry.name
+                yield path, entry
+                if (entry.kind != 'file' and entry.url and
+                        (max_depth is None or depth < max_depth)):
+                    submit(path + '/', entry.url, depth + 1)
+                    pending += 1
+    finally:
+        pool.terminate()
+
+
+class FolderIndex(object):
+    '''Maps the names of the files in a folder listing to their fileData
+    URLs. It is built once per listing, then any number of lookups are
+    dictionary lookups instead of scans of the listing.
+
+    <file>
+        <displayName>Documents/notes.txt</displayName>
+        ...
+        <fileData>https://api.sugarsync.com/file/:sc:.../data</fileData>
+    </file>
+    '''
+
+    def __init__(self):
+        self.urls = {}              # displayName -> fileData URL
+        self.basenames = {}         # basename -> [displayName, ...]
+        self.sizes = {}             # fileData URL -> size, if known
+        self.modified = {}          # fileData URL -> lastModified, if known
+
+    @classmethod
+    def from_entries(cls, entries):
+        '''Builds the index from Entry records, see iter_collection_contents().
+        Collections are skipped.'''
+        index = cls()
+        for entry in entries:
+            if entry.kind == 'file':
+                index.add(entry.name, entry.url, entry.size,
+                          entry.last_modified)
+        return index
+
+    def add(self, display_name, file_data_url, size=None,
+            last_modified=None):
+        self.urls[display_name] = file_data_url
+        if size is not None:
+            self.sizes[file_data_url] = size
+        if last_modified is not None:
+            self.modified[file_data_url] = last_modified
+        # sometimes displayName contains the absolute path, but you
+        # usually specify just the basename at the command line.
+        basename = os.path.basename(display_name)
+        self.basenames.setdefault(basename, []).append(display_name)
+
+    def __len__(self):
+        return len(self.urls)
+
+    def lookup(self, pattern):
+        '''Returns the (basename, fileData URL) pairs of the files matching
+        pattern, trying in order: the exact displayName, the basename and,
+        if pattern contains any of *?[, the basenames matching the glob.'''
+        if pattern in self.urls:
+            return [(os.path.basename(pattern), self.urls[pattern])]
+        if pattern in self.basenames:
+            names = [pattern]
+        elif any(char in pattern for char in '*?['):
+            names = sorted(fnmatch.filter(self.basenames, pattern))
+        else:
+            names = []
+        return [(name, self.urls[display_name])
+                for name in names
+                for display_name in self.basenames[name]]
+
+
+if __name__ == '__main__':
+    print("This file should not be used directly, it is used by sugarsync.py.")
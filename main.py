@@ -1,23 +1,84 @@
 #!/usr/bin/python2.7
 #<--encoding: UTF-8-->
 
+"""The graphical SugarSync client, built with Kivy; the layout is in
+sugarsync.kv.
+
+Nothing that talks to the server runs on the UI thread: authentication and
+listings run on the worker threads of a client.SugarSyncClient, downloads
+on those of a transfers.TransferScheduler, and their results are handed
+back to the UI thread through the Kivy clock, see call_back_on_ui().
+
+The application id and the developer keys are read from sugarsync.ini,
+section [sugarsync], created next to this file on the first run."""
+
+import os
+import logging
 
 import kivy
-kivy.require('1.4.1')       # replace with your current kivy version !
+kivy.require('1.10.0')      # RecycleView appeared in 1.10.0
 
 from kivy.app import App    # your main entry point into the Kivy run loop.
-#from kivy.uix.floatlayout import FloatLayout
-from kivy.properties import ObjectProperty
-#from kivy.uix.button import Button
+from kivy.clock import Clock    # schedules calls on the UI thread
+from kivy.properties import (ObjectProperty, StringProperty, NumericProperty,
+                             BooleanProperty)
+from kivy.uix.boxlayout import BoxLayout
+from kivy.uix.behaviors import ButtonBehavior
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
 
 # implement sliding from one screen to other
 from kivy.uix.screenmanager import (ScreenManager, Screen, SlideTransition,
                                     WipeTransition)
 
+# sugarsync packages:
+from auth import TokenStore, TokenProvider
+from utils import (XmlUtils, SugarSyncHTTPGetUtil, FileDownloadAPI,
+                   configure_session, set_token_provider)
+from listing import iter_collection_contents
+from transfers import TransferScheduler
+from client import SugarSyncClient
+
+# same logger in all modules
+logger = logging.getLogger('sugarsync')
+
+ONE_GB = 1024.0 * 1024 * 1024
+
+# entries added to the file list at a time while a folder is listed; one
+# RecycleView refresh per batch instead of one per entry
+LISTING_BATCH = 500
+# how often the progress of the transfers is redrawn, in seconds
+PROGRESS_INTERVAL = 0.25
+
+
+def call_back_on_ui(function, args=(), on_done=None, on_error=None):
+    '''Runs function(*args) in the current thread, a worker, then hands its
+    result to on_done, or the exception it raised to on_error, on the UI
+    thread: widgets must only be touched from there. Clock.schedule_once
+    can be called from any thread; the call runs before the next frame.'''
+
+    try:
+        result = function(*args)
+    except Exception as e:
+        logger.debug("%s failed", function.__name__, exc_info=True)
+        if on_error is not None:
+            Clock.schedule_once(lambda dt: on_error(e))
+    else:
+        if on_done is not None:
+            Clock.schedule_once(lambda dt: on_done(result))
+
+
+def format_size(size):
+    '''Returns size, in bytes, as text, e.g. 1.5 MB.'''
+
+    if size is None:
+        return ''
+    for unit in ('bytes', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            break
+        size /= 1024.0
+    return ('{0} {1}' if unit == 'bytes' else '{0:.1f} {1}').format(size,
+                                                                    unit)
 
-#from kivy.uix.widget import Widget
-#class MyWidget(Widget):
-#    pass
 
 class LoginPage(Screen):
     '''Defines the Login page with objects that collect user input.'''
@@ -27,6 +88,7 @@ class LoginPage(Screen):
     user_password = ObjectProperty()
     login = ObjectProperty()
     sign_up = ObjectProperty()
+    message = StringProperty()          # why the last login failed
 
     def __init__(self, *args, **kwargs):
         '''Binds the Login & Sign Up buttons to on_press event handlers.'''
@@ -36,9 +98,12 @@ class LoginPage(Screen):
         self.sign_up.bind(on_press=self.load_sign_up_page)
 
     def load_user_workspace(self, obj):
-        '''Changes the currently displayed screen. '''
+        '''Changes the currently displayed screen and signs in; the
+        workspace fills in as the answers of the server arrive.'''
 
-        #login_page.clear_widgets()
+        self.message = ''
+        workspace = self.manager.get_screen('workspace')
+        workspace.sign_in(self.user_email.text, self.user_password.text)
         self.manager.current = 'workspace'
         self.manager.transition.direction = 'left'
 
@@ -48,29 +113,234 @@ class LoginPage(Screen):
         print("sign up button pressed %s" % obj)
 
 
+class FileRow(RecycleDataViewBehavior, ButtonBehavior, BoxLayout):
+    '''One row of the file list. The RecycleView creates only the rows
+    visible on screen and reuses them while scrolling, filling them from
+    its data, so a folder of 10k entries costs 10k dicts, not 10k
+    widgets. Pressing the row of a folder opens it, of a file downloads
+    it.'''
+
+    name = StringProperty()
+    detail = StringProperty()
+    entry = ObjectProperty()            # the listing.Entry
+
+    def on_press(self):
+        App.get_running_app().root.get_screen('workspace').open(self.entry)
+
+
+class TransferRow(RecycleDataViewBehavior, BoxLayout):
+    '''One row of the transfer list: name, progress bar and status.'''
+
+    name = StringProperty()
+    status = StringProperty()
+    percent = NumericProperty()
+
+
 class UserWorkspace(Screen):
-    '''This is the main screen with the user workspace.'''
+    '''This is the main screen with the user workspace: the contents of the
+    current folder, the transfers and the storage used.'''
+
+    file_list = ObjectProperty()
+    transfer_list = ObjectProperty()
+    path = StringProperty('Magic Briefcase')
+    status = StringProperty()
+    can_go_up = BooleanProperty(False)
+    # storage, in GB
+    limit = NumericProperty(1)
+    usage = NumericProperty(0)
+    storage_text = StringProperty()
 
     def __init__(self, *args, **kwargs):
         super(UserWorkspace, self).__init__(*args, **kwargs)
+        self.token_provider = None
+        self.folders = []               # [(name, contents URL)], the path
+        # a listing still running for a folder left since then is ignored
+        self.listing = 0
+        self.transfers = []             # dicts, see download()
+        self.progress_event = None
+
+    @property
+    def app(self):
+        return App.get_running_app()
+
+    def sign_in(self, username, password):
+        self.status = 'Signing in...'
+        self.file_list.data = []
+        config = self.app.config
+        provider = TokenProvider(username, password,
+                                 config.get('sugarsync', 'application'),
+                                 config.get('sugarsync', 'accesskey'),
+                                 config.get('sugarsync', 'privatekey'),
+                                 store=TokenStore())
+        self.app.run_in_background(self.get_workspace, (provider,),
+                                   self.show_workspace, self.sign_in_failed)
+
+    @staticmethod
+    def get_workspace(provider):
+        '''Runs on a worker: authenticates and gets the user resource and
+        the contents URL of Magic Briefcase.'''
 
-        def load_sign_up_page(obj):
-            self.manager.current = 'login'
-            self.manager.transition.direction = 'right'
+        access = provider.get_access()
+        # renews the token of every request from now on
+        set_token_provider(provider)
+        user_url = XmlUtils(access.response_body).get_node_values('./user')
+        user = SugarSyncHTTPGetUtil(access.token, user_url)
+        briefcase = SugarSyncHTTPGetUtil(access.token,
+                        user.xml_info.get_node_values('./magicBriefcase'))
+        return (provider, user.xml_info,
+                briefcase.xml_info.get_node_values('./contents'))
 
-        pass
-        #button = Button(text='Hello', size_hint=(None, None), size=(100, 40))
-        #button.bind(on_press=load_sign_up_page)
-        #self.add_widget(button)
+    def show_workspace(self, result):
+        self.token_provider, user_info, contents_url = result
+        self.limit = int(user_info.get_node_values('./quota/limit')) / ONE_GB
+        self.usage = int(user_info.get_node_values('./quota/usage')) / ONE_GB
+        self.storage_text = '{0:.2f} GB used | {1:.2f} GB free'.format(
+                                        self.usage, self.limit - self.usage)
+        self.folders = []
+        self.open_folder('Magic Briefcase', contents_url)
+
+    def sign_in_failed(self, error):
+        self.status = ''
+        login_page = self.manager.get_screen('login')
+        login_page.message = 'Login failed: {0}'.format(error)
+        self.manager.current = 'login'
+        self.manager.transition.direction = 'right'
+
+    def open(self, entry):
+        if entry.kind == 'file':
+            self.download(entry)
+        else:
+            self.open_folder(entry.name, entry.url)
+
+    def go_up(self):
+        if len(self.folders) > 1:
+            self.folders.pop()
+            name, contents_url = self.folders.pop()
+            self.open_folder(name, contents_url)
+
+    def open_folder(self, name, contents_url):
+        '''Lists a folder; its entries appear in batches while they arrive,
+        the first ones before the whole folder has been received.'''
+
+        self.folders.append((name, contents_url))
+        self.path = ' / '.join(folder for folder, url in self.folders)
+        self.can_go_up = len(self.folders) > 1
+        self.file_list.data = []
+        self.file_list.scroll_y = 1
+        self.status = 'Listing...'
+        self.listing += 1
+        listing = self.listing
+
+        def add_rows(rows):
+            if listing == self.listing:
+                self.file_list.data.extend(rows)
+
+        def list_folder():
+            rows = []
+            token = self.token_provider.get_token()
+            for entry in iter_collection_contents(token, contents_url):
+                if listing != self.listing:
+                    return          # another folder was opened meanwhile
+                rows.append({'name': entry.name + ('/' if entry.kind != 'file'
+                                                   else ''),
+                             'detail': format_size(entry.size),
+                             'entry': entry})
+                if len(rows) == LISTING_BATCH:
+                    Clock.schedule_once(lambda dt, rows=rows: add_rows(rows))
+                    rows = []
+            return rows
+
+        def listed(rows):
+            add_rows(rows)
+            if listing == self.listing:
+                self.status = '{0} items'.format(len(self.file_list.data))
+
+        self.app.run_in_background(list_folder, (), listed,
+                                   self.listing_failed)
+
+    def listing_failed(self, error):
+        self.status = 'Listing failed: {0}'.format(error)
+
+    def download(self, entry):
+        '''Queues the download of a file to the download directory; the
+        smaller files first.'''
+
+        transfer = {'name': entry.name, 'status': 'queued', 'api': None}
+        self.transfers.append(transfer)
+        directory = os.path.expanduser(self.app.config.get('sugarsync',
+                                                           'download_dir'))
+
+        def download_file():
+            transfer['status'] = 'downloading'
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            downloader = FileDownloadAPI(self.token_provider.get_token(),
+                                         entry.url)
+            transfer['api'] = downloader        # progress() from now on
+            downloader.download(os.path.join(directory, entry.name))
+
+        def done(result):
+            transfer['status'] = 'done'
+
+        def failed(error):
+            transfer['status'] = 'failed: {0}'.format(error)
+
+        self.app.scheduler.submit(entry.size or 0, call_back_on_ui,
+                                  (download_file, (), done, failed))
+        if self.progress_event is None:
+            self.progress_event = Clock.schedule_interval(
+                                    self.show_progress, PROGRESS_INTERVAL)
+        self.show_progress()
+
+    def show_progress(self, dt=None):
+        '''Redraws the transfer list from the progress the transfers report;
+        stops being called once all of them are finished.'''
+
+        rows = []
+        for transfer in self.transfers:
+            percent = 0
+            if transfer['status'] == 'done':
+                percent = 100
+            elif transfer['api'] is not None:
+                position, size = transfer['api'].progress()
+                if size:
+                    percent = 100.0 * position / size
+            rows.append({'name': transfer['name'], 'percent': percent,
+                         'status': transfer['status'] if percent == 0 or
+                                   transfer['status'] != 'downloading'
+                                   else '{0:.0f}%'.format(percent)})
+        self.transfer_list.data = rows
+        if all(transfer['status'] not in ('queued', 'downloading')
+               for transfer in self.transfers):
+            self.progress_event.cancel()
+            self.progress_event = None
+            return False
 
 
 class SugarSync(App):
     '''Controller class.'''
 
+    def build_config(self, config):
+        '''Defaults of sugarsync.ini; the keys come from the developer
+        site.'''
+
+        config.setdefaults('sugarsync', {
+            'application': '',
+            'accesskey': '',
+            'privatekey': '',
+            'download_dir': os.path.join('~', 'SugarSync'),
+            'concurrency': 4})
+
     def build(self):
         '''Overrides parent's build(). Must return a Widget that will be used
         as the root of the widget tree.'''
 
+        concurrency = self.config.getint('sugarsync', 'concurrency')
+        # one connection per transfer, plus the listings
+        configure_session(pool_size=concurrency + 2)
+        self.tasks = SugarSyncClient(concurrency=2)     # sign in, listings
+        self.scheduler = TransferScheduler(concurrency)
+
         # because I'm experimenting, I chose two types of transitions
         st = SlideTransition()
         #wt = WipeTransition()
@@ -81,7 +351,12 @@ class SugarSync(App):
         sm.add_widget(UserWorkspace(name='workspace'))
 
         return sm
-#        return MyWidget()
+
+    def run_in_background(self, function, args=(), on_done=None,
+                          on_error=None):
+        '''Runs function(*args) on a worker thread, see call_back_on_ui().'''
+        return self.tasks.submit(call_back_on_ui, function, args, on_done,
+                                 on_error)
 
 
 if __name__ == '__main__':
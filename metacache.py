@@ -0,0 +1,161 @@
+#!/usr/bin/python
+
+"""Contains a local cache of the metadata resources (user, collections,
+folder contents), so that listing a folder that didn't change doesn't
+download and parse it again."""
+
+import os
+import time
+import sqlite3
+import StringIO
+import threading
+
+# sugarsync packages:
+from utils import SugarSyncHTTPGetUtil
+
+
+class MetadataCache(object):
+    '''Stores the XML responses of GET requests in a SQLite database, keyed
+    by resource URL, along with their validators (the ETag and
+    Last-Modified response headers).
+
+    An entry younger than ttl seconds is used without making any request;
+    an older one is revalidated with a conditional request, which costs a
+    round-trip but no body when nothing changed (304 Not Modified).'''
+
+    DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.sugarsync',
+                                'metadata.db')
+
+    def __init__(self, path=None, ttl=0):
+        self.path = os.path.expanduser(path or self.DEFAULT_PATH)
+        self.ttl = ttl
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        # the connection is shared by the worker threads, one at a time
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS resources ('
+                                    'url TEXT PRIMARY KEY, '
+                                    'body BLOB, '
+                                    'etag TEXT, '
+                                    'last_modified TEXT, '
+                                    'fetched REAL)')
+
+    def lookup(self, url):
+        '''Returns a dict with the cached body, etag, last_modified and
+        fetched time of url, or None if it's not in the cache.'''
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT body, etag, last_modified, fetched FROM resources '
+                'WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+        return {'body': str(row[0]), 'etag': row[1], 'last_modified': row[2],
+                'fetched': row[3]}
+
+    def is_fresh(self, entry):
+        return time.time() - entry['fetched'] < self.ttl
+
+    def store(self, url, body, etag=None, last_modified=None):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO resources VALUES (?, ?, ?, ?, ?)',
+                (url, sqlite3.Binary(body), etag, last_modified, time.time()))
+
+    def touch(self, url):
+        '''The cached entry was revalidated, it is fresh again.'''
+        with self.lock, self.connection:
+            self.connection.execute('UPDATE resources SET fetched = ? '
+                                    'WHERE url = ?', (time.time(), url))
+
+    def invalidate(self, url_prefix):
+        '''Drops url_prefix and every resource below it, e.g. a folder and
+        its contents after uploading a file to it.'''
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM resources WHERE url = ? OR '
+                                    'substr(url, 1, ?) = ?',
+                                    (url_prefix, len(url_prefix) + 1,
+                                     url_prefix + '/'))
+
+    def close(self):
+        self.connection.close()
+
+
+class CachingStream(object):
+    '''Hands out the body of a response with read(size), like the response
+    itself, and stores it in a MetadataCache once it was read to the end;
+    a body not read whole isn't stored.'''
+
+    def __init__(self, response, cache, url):
+        self.response = response
+        self.cache = cache
+        self.url = url
+        self.chunks = []
+        self.stored = False
+
+    def read(self, size=-1):
+        data = self.response.read(size if size >= 0 else None)
+        if data:
+            self.chunks.append(data)
+        elif not self.stored:
+            headers = self.response.info()
+            self.cache.store(self.url, ''.join(self.chunks),
+                             headers.get('ETag'), headers.get('Last-Modified'))
+            self.stored = True
+        return data
+
+
+class CachedHTTPGetUtil(SugarSyncHTTPGetUtil):
+    """SugarSyncHTTPGetUtil that reads the response body from a
+    MetadataCache whenever the cache has a usable copy of it.
+
+    With parse=False, the body is neither read nor parsed here: self.stream
+    hands it out, from the cache or from the response while it arrives,
+    e.g. to listing.ContentsPage, which parses it incrementally."""
+
+    def __init__(self, access_token, url, cache, parse=True):
+        self.cache = cache
+        self.parse = parse
+        self.from_cache = False
+        super(CachedHTTPGetUtil, self).__init__(access_token, url)
+
+    def run(self):
+        '''Overrides the parent's run(). It is being called by __init__().'''
+
+        entry = self.cache.lookup(self.url)
+        if entry is not None and self.cache.is_fresh(entry):
+            self.info = entry['body']
+            self.from_cache = True
+        else:
+            if entry is not None:
+                # conditional request, answered with 304 if nothing changed
+                if entry['etag']:
+                    self.headers['If-None-Match'] = entry['etag']
+                if entry['last_modified']:
+                    self.headers['If-Modified-Since'] = entry['last_modified']
+            self.make_get_request(self.url)
+            if entry is not None and self.response.code == 304:
+                self.response.read()        # releases the connection
+                self.info = entry['body']
+                self.from_cache = True
+                self.cache.touch(self.url)
+            elif not self.parse:
+                # cached once the reader got to the end of it
+                self.stream = CachingStream(self.response, self.cache,
+                                            self.url)
+                return
+            else:
+                self.get_info()
+                headers = self.response.info()
+                self.cache.store(self.url, self.info, headers.get('ETag'),
+                                 headers.get('Last-Modified'))
+        if self.parse:
+            self.get_xml_info()
+        else:
+            self.stream = StringIO.StringIO(self.info)
+
+
+if __name__ == '__main__':
+    print("This file should not be used directly, it is used by sugarsync.py.")
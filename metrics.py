@@ -0,0 +1,347 @@
+#!/usr/bin/python
+
+"""Contains the instrumentation of the HTTP requests and of the transfers:
+timings (DNS, connect, TLS, time to first byte, total), bytes sent and
+received, retries and statuses, per API endpoint, and optional trace
+spans. utils.make_request() and the transfer classes report to METRICS;
+the measures are exported as JSON, in the Prometheus text format, or as
+a trace viewable in chrome://tracing or Perfetto."""
+
+import re
+import json
+import math
+import time
+import socket
+import threading
+import functools
+import contextlib
+import urlparse
+import requests
+from requests.packages.urllib3 import connection, connectionpool
+from requests.packages.urllib3.util import connection as socket_connection
+from requests.packages.urllib3.exceptions import (ConnectTimeoutError,
+                                                  NewConnectionError)
+
+
+def percentile(values, percent):
+    """Returns the nearest-rank percentile of values, 0 if there are none."""
+
+    values = sorted(values)
+    if not values:
+        return 0.0
+    rank = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def endpoint_of(url):
+    """Returns the API endpoint of url, with the resource ids left out:
+    https://api.sugarsync.com/file/:sc:123:456/data -> /file/{id}/data"""
+
+    path = urlparse.urlparse(url).path
+    return re.sub(r'/(file|folder|workspace|syncfolder|contact|'
+                  r'app-authorization)/[^/]+', r'/\1/{id}', path)
+
+
+class EndpointStats(object):
+    '''The measures of the requests made to one method and endpoint.'''
+
+    # samples kept for the percentiles; enough for any single run
+    MAX_SAMPLES = 10000
+
+    def __init__(self):
+        self.count = 0
+        self.statuses = {}              # status (None: no response) -> count
+        self.retries = 0
+        self.sent = 0                   # bytes
+        self.received = 0
+        self.seconds = []               # total time, retries included
+        self.ttfb = []                  # time to first byte, last attempt
+
+    def summary(self):
+        return {'count': self.count,
+                'statuses': dict((str(status), count) for status, count
+                                 in self.statuses.items()),
+                'retries': self.retries,
+                'bytes_sent': self.sent,
+                'bytes_received': self.received,
+                'seconds_total': sum(self.seconds),
+                'p50_seconds': percentile(self.seconds, 50),
+                'p99_seconds': percentile(self.seconds, 99),
+                'ttfb_p50_seconds': percentile(self.ttfb, 50),
+                'ttfb_p99_seconds': percentile(self.ttfb, 99)}
+
+
+class Metrics(object):
+    '''Thread-safe collection of the measures. Counting is always on; it
+    costs a lock per request and per chunk of data read. Spans are kept
+    only while tracing is True.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()  # timings of the current request
+        self.started = time.time()
+        self.endpoints = {}             # (method, endpoint) -> EndpointStats
+        self.connections = {'count': 0, 'dns': 0.0, 'connect': 0.0,
+                            'tls': 0.0}
+        self.tracing = False
+        self.spans = []                 # (name, start, duration, thread, args)
+
+    def stats(self, method, url):
+        key = (method, endpoint_of(url))
+        stats = self.endpoints.get(key)
+        if stats is None:
+            with self.lock:
+                stats = self.endpoints.setdefault(key, EndpointStats())
+        return stats
+
+    def begin_request(self):
+        '''Called before each attempt; the connection opened for it, if any,
+        reports to the returned dict.'''
+        self.local.timings = {'dns': 0.0, 'connect': 0.0, 'tls': 0.0}
+        return self.local.timings
+
+    def connection_opened(self, dns, connect, tls=0.0):
+        timings = getattr(self.local, 'timings', None)
+        if timings is not None:
+            timings.update(dns=dns, connect=connect, tls=tls)
+        with self.lock:
+            self.connections['count'] += 1
+            self.connections['dns'] += dns
+            self.connections['connect'] += connect
+            self.connections['tls'] += tls
+
+    def record_request(self, method, url, status, started, ttfb, sent=0,
+                       retries=0, timings=None):
+        '''Records a request, once its response headers arrived or it
+        failed for good; started is when its first attempt started.'''
+        seconds = time.time() - started
+        stats = self.stats(method, url)
+        with self.lock:
+            stats.count += 1
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+            stats.retries += retries
+            stats.sent += sent
+            if len(stats.seconds) < stats.MAX_SAMPLES:
+                stats.seconds.append(seconds)
+                if ttfb is not None:
+                    stats.ttfb.append(ttfb)
+        if self.tracing:
+            args = {'status': status, 'retries': retries, 'url': url}
+            args.update(timings or {})
+            self.add_span('{0} {1}'.format(method, endpoint_of(url)),
+                          started, seconds, args)
+
+    def record_received(self, stats, size):
+        '''size more bytes of a response body were read; stats is the
+        EndpointStats of the request, see stats().'''
+        with self.lock:
+            stats.received += size
+
+    def add_span(self, name, started, duration, args=None):
+        with self.lock:
+            self.spans.append((name, started, duration,
+                               threading.current_thread().ident, args or {}))
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        '''with METRICS.span('download', file=filename): ...'''
+        if not self.tracing:
+            yield
+            return
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add_span(name, started, time.time() - started, args)
+
+    def summary(self):
+        '''Returns all the measures as a dictionary, ready for JSON.'''
+        with self.lock:
+            endpoints = [dict(method=method, endpoint=endpoint,
+                              **stats.summary())
+                         for (method, endpoint), stats
+                         in sorted(self.endpoints.items())]
+            connections = dict(self.connections)
+        return {'elapsed_seconds': time.time() - self.started,
+                'requests': sum(item['count'] for item in endpoints),
+                'retries': sum(item['retries'] for item in endpoints),
+                'bytes_sent': sum(item['bytes_sent'] for item in endpoints),
+                'bytes_received': sum(item['bytes_received']
+                                      for item in endpoints),
+                'connections': connections,
+                'endpoints': endpoints}
+
+    def to_prometheus(self):
+        '''Returns the measures in the Prometheus text exposition format,
+        e.g. for the textfile collector of node_exporter.'''
+        summary = self.summary()
+        lines = []
+        def sample(name, labels, value):
+            label_text = ','.join('{0}="{1}"'.format(key, labels[key])
+                                  for key in sorted(labels))
+            lines.append('sugarsync_{0}{1} {2}'.format(
+                name, '{' + label_text + '}' if label_text else '', value))
+        def metric(name, kind, help, samples):
+            lines.append('# HELP sugarsync_{0} {1}'.format(name, help))
+            lines.append('# TYPE sugarsync_{0} {1}'.format(name, kind))
+            for labels, value in samples:
+                sample(name, labels, value)
+
+        endpoints = summary['endpoints']
+        def labels(item, **extra):
+            extra.update(method=item['method'], endpoint=item['endpoint'])
+            return extra
+        metric('requests_total', 'counter', 'Requests made.',
+               [(labels(item, status=status), count) for item in endpoints
+                for status, count in sorted(item['statuses'].items())])
+        metric('request_retries_total', 'counter', 'Retried attempts.',
+               [(labels(item), item['retries']) for item in endpoints])
+        metric('request_seconds', 'summary',
+               'Time until the response headers, retries included.',
+               [(labels(item, quantile=quantile), item[key])
+                for item in endpoints
+                for quantile, key in [('0.5', 'p50_seconds'),
+                                      ('0.99', 'p99_seconds')]])
+        for item in endpoints:
+            sample('request_seconds_sum', labels(item), item['seconds_total'])
+            sample('request_seconds_count', labels(item), item['count'])
+        metric('bytes_sent_total', 'counter', 'Request body bytes.',
+               [(labels(item), item['bytes_sent']) for item in endpoints])
+        metric('bytes_received_total', 'counter', 'Response body bytes.',
+               [(labels(item), item['bytes_received']) for item in endpoints])
+        connections = summary['connections']
+        metric('connections_total', 'counter', 'Connections opened.',
+               [({}, connections['count'])])
+        metric('connection_seconds_total', 'counter',
+               'Time spent opening connections.',
+               [({'phase': phase}, connections[phase])
+                for phase in ('dns', 'connect', 'tls')])
+        return '\n'.join(lines) + '\n'
+
+    def to_trace(self):
+        '''Returns the spans in the Trace Event format.'''
+        with self.lock:
+            spans = list(self.spans)
+        return {'traceEvents': [
+                    {'name': name, 'ph': 'X', 'pid': 1, 'tid': thread,
+                     'ts': int((started - self.started) * 1e6),
+                     'dur': int(duration * 1e6), 'args': args}
+                    for name, started, duration, thread, args in spans],
+                'displayTimeUnit': 'ms'}
+
+    def write(self, path):
+        '''Writes the summary to path: Prometheus text if path ends with
+        .prom, JSON otherwise.'''
+        with open(path, 'w') as stream:
+            if path.endswith('.prom'):
+                stream.write(self.to_prometheus())
+            else:
+                json.dump(self.summary(), stream, indent=2)
+
+    def write_trace(self, path):
+        with open(path, 'w') as stream:
+            json.dump(self.to_trace(), stream)
+
+
+METRICS = Metrics()
+
+
+def traced(name):
+    """Decorator recording each call of a method as a span named name,
+    with the method's first argument, e.g. the file transferred."""
+
+    def decorator(method):
+        @functools.wraps(method)
+        def traced_method(self, *args, **kwargs):
+            if not METRICS.tracing:
+                return method(self, *args, **kwargs)
+            with METRICS.span(name, target=str(args[0]) if args else None):
+                return method(self, *args, **kwargs)
+        return traced_method
+    return decorator
+
+
+class TimedConnectionMixin(object):
+    '''Reports how long opening a connection took, split into DNS
+    resolution, TCP handshake and TLS handshake.'''
+
+    def _new_conn(self):
+        started = time.time()
+        try:
+            # resolved here to time it apart from the TCP handshake; TLS
+            # still checks the certificate against self.host
+            addresses = socket.getaddrinfo(self.host, self.port, 0,
+                                           socket.SOCK_STREAM)
+        except socket.error:
+            addresses = None
+        resolved = time.time()
+        self.dns = resolved - started
+        try:
+            if not addresses:
+                # the parent resolves again, and reports the error
+                return super(TimedConnectionMixin, self)._new_conn()
+            return self.connect_to_any(addresses)
+        finally:
+            self.tcp = time.time() - resolved
+
+    def connect_to_any(self, addresses):
+        '''Returns a socket connected to the first of the addresses that
+        accepts the connection, e.g. the IPv4 one if the IPv6 one fails,
+        like urllib3 does after resolving the host itself; raises its
+        exceptions otherwise.'''
+        options = {}
+        if self.source_address:
+            options['source_address'] = self.source_address
+        if self.socket_options:
+            options['socket_options'] = self.socket_options
+        error = None
+        for family, kind, protocol, name, address in addresses:
+            try:
+                return socket_connection.create_connection(
+                        (address[0], self.port), self.timeout, **options)
+            except socket.timeout:
+                error = ConnectTimeoutError(self, "Connection to {0} timed "
+                                            "out. (connect timeout={1})"
+                                            .format(self.host, self.timeout))
+            except socket.error as e:
+                error = NewConnectionError(self, "Failed to establish a new "
+                                           "connection: {0}".format(e))
+        raise error
+
+    def connect(self):
+        self.dns = self.tcp = 0.0
+        started = time.time()
+        super(TimedConnectionMixin, self).connect()
+        total = time.time() - started
+        METRICS.connection_opened(self.dns, self.tcp,
+                                  max(0.0, total - self.dns - self.tcp))
+
+
+class TimedHTTPConnection(TimedConnectionMixin, connection.HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(TimedConnectionMixin, connection.HTTPSConnection):
+    pass
+
+
+class TimedHTTPConnectionPool(connectionpool.HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(connectionpool.HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(requests.adapters.HTTPAdapter):
+    '''HTTPAdapter whose connections report their opening times.'''
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(TimedHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool}
+
+
+if __name__ == '__main__':
+    print("This file should not be used directly, it is used by sugarsync.py.")
@@ -0,0 +1,349 @@
+#!/usr/bin/python
+
+"""Contains a local stand-in for the SugarSync API, used by the tests and
+by benchmark.py to run without network access or an account.
+
+It implements the resources the client uses, in memory:
+    POST /app-authorization            -> Refresh Token
+    POST /authorization                -> Access Token
+    GET  /user
+    GET  /folder/<id>                  collection
+    GET  /folder/<id>/contents         paged with start and max
+    POST /folder/<id>                  creates a <file> or a <folder>
+    GET  /file/<id>
+    GET  /file/<id>/data               supports Range: bytes=start-[end]
+    PUT  /file/<id>/data
+
+and can make the conditions worse on purpose: latency added to every
+request, a bandwidth cap on the data sent and received, and errors
+injected at random or for the next requests.
+
+The metadata responses have an ETag, and are answered with 304 Not
+Modified when a request's If-None-Match matches it.
+
+    server = MockSugarSync(latency=0.05, bandwidth=1024 * 1024)
+    server.start()
+    auth.RefreshToken.URL = server.url + '/app-authorization'
+    auth.AccessToken.URL = server.url + '/authorization'
+    ...
+    server.stop()
+"""
+
+import re
+import sys
+import socket
+import hashlib
+import time
+import random
+import itertools
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from xml.sax.saxutils import escape
+
+
+class MockSugarSync(object):
+    '''The state of the mock API and the conditions it runs under.
+
+    latency - seconds added to every request
+    bandwidth - bytes per second at which bodies are sent and received,
+        per connection, None for no limit
+    error_rate - probability that a request fails with error_status
+    token_lifetime - seconds before an Access Token is rejected with 401
+    '''
+
+    def __init__(self, latency=0.0, bandwidth=None, error_rate=0.0,
+                 error_status=503, token_lifetime=3600, seed=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.token_lifetime = token_lifetime
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.access_tokens = {}         # token -> expiration time
+        self.failures = []              # statuses of the next requests
+        self.requests = 0
+        # answer ranges with Content-Range: bytes 0-99/*, size unknown
+        self.hide_size = False
+        self.files = {}                 # id -> dict(name, data, modified)
+        self.folders = {}               # id -> dict(name, children)
+        self.root = self.add_folder('Magic Briefcase', parent=None)
+        self.httpd = None
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}'.format(*self.httpd.server_address)
+
+    def start(self, port=0):
+        '''Serves on 127.0.0.1:port (a free port by default) in a background
+        thread; returns the base URL.'''
+        self.httpd = MockHTTPServer(('127.0.0.1', port), MockRequestHandler)
+        self.httpd.api = self
+        thread = threading.Thread(target=self.httpd.serve_forever,
+                                  args=(0.05,))    # poll interval, for stop()
+        thread.daemon = True
+        thread.start()
+        return self.url
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def add_folder(self, name, parent='root'):
+        '''Returns the id of a new folder; parent is the id of a folder,
+        'root' for Magic Briefcase.'''
+        with self.lock:
+            folder_id = 'f{0}'.format(next(self.ids))
+            self.folders[folder_id] = {'name': name, 'children': []}
+            if parent is not None:
+                parent = self.root if parent == 'root' else parent
+                self.folders[parent]['children'].append(('folder', folder_id))
+        return folder_id
+
+    def add_file(self, name, data='', parent='root'):
+        '''Returns the id of a new file in folder parent.'''
+        with self.lock:
+            file_id = str(next(self.ids))
+            self.files[file_id] = {'name': name, 'data': data,
+                                   'modified': self.timestamp()}
+            parent = self.root if parent == 'root' else parent
+            self.folders[parent]['children'].append(('file', file_id))
+        return file_id
+
+    def change_file(self, file_id, data):
+        '''Gives file file_id new content, as another client would.'''
+        with self.lock:
+            self.files[file_id]['data'] = data
+            self.files[file_id]['modified'] = self.timestamp()
+
+    def fail_next(self, count=1, status=503):
+        '''The next count requests fail with status.'''
+        with self.lock:
+            self.failures.extend([status] * count)
+
+    def timestamp(self):
+        # a distinct lastModified per change, like the real API
+        return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime()) + \
+            '.{0:03d}-00:00'.format(next(self.ids) % 1000)
+
+    def issue_access_token(self):
+        with self.lock:
+            token = 'access-{0}'.format(next(self.ids))
+            self.access_tokens[token] = time.time() + self.token_lifetime
+        return token
+
+    def is_authorized(self, token):
+        with self.lock:
+            return self.access_tokens.get(token, 0) > time.time()
+
+    def next_failure(self):
+        '''Returns the status the current request must fail with, or None.'''
+        with self.lock:
+            self.requests += 1
+            if self.failures:
+                return self.failures.pop(0)
+            if self.error_rate and self.random.random() < self.error_rate:
+                return self.error_status
+        return None
+
+
+class MockHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # the client closed the connection before the end of the response,
+        # as SegmentedDownloadAPI does to ask for the whole file instead
+        if isinstance(sys.exc_info()[1], socket.error):
+            return
+        BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+
+class MockRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Answers the requests from the state of self.server.api.'''
+
+    protocol_version = 'HTTP/1.1'       # keep-alive, like the real API
+    # the headers and the body are written separately, without this every
+    # response would wait for a delayed ACK
+    disable_nagle_algorithm = True
+    # bytes sent or received at a time when the bandwidth is capped
+    BLOCK_SIZE = 16 * 1024
+
+    @property
+    def api(self):
+        return self.server.api
+
+    @property
+    def base(self):
+        return 'http://{0}:{1}'.format(*self.server.server_address)
+
+    def log_message(self, format, *args):
+        pass                            # quiet
+
+    def do_GET(self):
+        self.handle_api_request(self.get)
+
+    def do_POST(self):
+        self.handle_api_request(self.post)
+
+    def do_PUT(self):
+        self.handle_api_request(self.put)
+
+    def handle_api_request(self, method):
+        body = self.read_body()
+        if self.api.latency:
+            time.sleep(self.api.latency)
+        status = self.api.next_failure()
+        if status is not None:
+            return self.reply(status, 'Injected failure',
+                              {'Retry-After': '0'})
+        path = urlparse.urlparse(self.path).path
+        if (path not in ('/app-authorization', '/authorization') and
+                not self.api.is_authorized(self.headers.get('Authorization'))):
+            return self.reply(401, 'Unauthorized')
+        try:
+            method(path, body)
+        except KeyError:
+            self.reply(404, 'Not found')
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        chunks = []
+        while length > 0:
+            chunk = self.rfile.read(min(length, self.BLOCK_SIZE))
+            if not chunk:
+                break
+            length -= len(chunk)
+            chunks.append(chunk)
+            self.wait_for_bandwidth(len(chunk))
+        return ''.join(chunks)
+
+    def wait_for_bandwidth(self, size):
+        if self.api.bandwidth:
+            time.sleep(float(size) / self.api.bandwidth)
+
+    def reply(self, status, body='', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        for start in range(0, len(body), self.BLOCK_SIZE):
+            self.wfile.write(body[start:start + self.BLOCK_SIZE])
+            self.wait_for_bandwidth(min(self.BLOCK_SIZE, len(body) - start))
+
+    def reply_metadata(self, body):
+        '''Replies with an ETag; 304 Not Modified, without the body, if the
+        request's If-None-Match has the same.'''
+        etag = '"{0}"'.format(hashlib.sha1(body).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            return self.reply(304, '', {'ETag': etag})
+        self.reply(200, body, {'ETag': etag})
+
+    def get(self, path, body):
+        if path == '/user':
+            return self.reply_metadata('<user><username>mock@example.com'
+                              '</username><quota><limit>2000000000</limit>'
+                              '<usage>{0}</usage></quota><magicBriefcase>'
+                              '{1}/folder/{2}</magicBriefcase></user>'.format(
+                                self.usage(), self.base, self.api.root))
+        match = re.match(r'/folder/(\w+)/contents$', path)
+        if match:
+            return self.get_contents(match.group(1))
+        match = re.match(r'/folder/(\w+)$', path)
+        if match:
+            return self.reply_metadata(self.collection_xml(match.group(1)))
+        match = re.match(r'/file/(\w+)$', path)
+        if match:
+            return self.reply_metadata(self.file_xml(match.group(1)))
+        match = re.match(r'/file/(\w+)/data$', path)
+        if match:
+            return self.get_data(self.api.files[match.group(1)]['data'])
+        self.reply(404, 'Not found')
+
+    def get_contents(self, folder_id):
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        start = int(query.get('start', ['0'])[0])
+        maximum = int(query.get('max', ['500'])[0])
+        children = self.api.folders[folder_id]['children']
+        page = children[start:start + maximum]
+        items = [self.collection_xml(child_id) if kind == 'folder' else self.file_xml(child_id)
+                 for kind, child_id in page]
+        self.reply_metadata('<collectionContents start="{0}" hasMore="{1}" '
+                        'end="{2}">{3}</collectionContents>'.format(
+                        start, str(start + maximum < len(children)).lower(),
+                        start + len(page) - 1, ''.join(items)))
+
+    def get_data(self, data):
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if match and int(match.group(1)) < len(data):
+            start = int(match.group(1))
+            end = min(int(match.group(2) or len(data) - 1), len(data) - 1)
+            return self.reply(206, data[start:end + 1], {
+                'Content-Range': 'bytes {0}-{1}/{2}'.format(
+                                    start, end, '*' if self.api.hide_size
+                                                else len(data))})
+        self.reply(200, data)
+
+    def post(self, path, body):
+        if path == '/app-authorization':
+            return self.reply(201, '', {'Location': self.base +
+                                        '/app-authorization/refresh-token'})
+        if path == '/authorization':
+            expiration = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(
+                                        time.time() + self.api.token_lifetime))
+            return self.reply(201, '<authorization><expiration>{0}'
+                              '</expiration><user>{1}/user</user>'
+                              '</authorization>'.format(expiration, self.base),
+                              {'Location': self.api.issue_access_token()})
+        match = re.match(r'/folder/(\w+)$', path)
+        if match:
+            self.api.folders[match.group(1)]        # 404 if unknown
+            name = re.search(r'<displayName>(.*?)</displayName>', body)
+            name = name.group(1) if name else 'unnamed'
+            if body.find('<folder>') != -1:
+                location = '/folder/' + self.api.add_folder(name,
+                                                            match.group(1))
+            else:
+                location = '/file/' + self.api.add_file(name, '',
+                                                        match.group(1))
+            return self.reply(201, '', {'Location': self.base + location})
+        self.reply(404, 'Not found')
+
+    def put(self, path, body):
+        match = re.match(r'/file/(\w+)/data$', path)
+        if match:
+            entry = self.api.files[match.group(1)]
+            with self.api.lock:
+                entry['data'] = body
+                entry['modified'] = self.api.timestamp()
+            return self.reply(204)
+        self.reply(404, 'Not found')
+
+    def usage(self):
+        with self.api.lock:
+            return sum(len(entry['data']) for entry in self.api.files.values())
+
+    def file_xml(self, file_id):
+        entry = self.api.files[file_id]
+        return ('<file><displayName>{0}</displayName><ref>{1}/file/{2}</ref>'
+                '<size>{3}</size><lastModified>{4}</lastModified>'
+                '<fileData>{1}/file/{2}/data</fileData></file>'.format(
+                    escape(entry['name']), self.base, file_id,
+                    len(entry['data']), entry['modified']))
+
+    def collection_xml(self, folder_id):
+        return ('<collection type="folder"><displayName>{0}</displayName>'
+                '<ref>{1}/folder/{2}</ref>'
+                '<contents>{1}/folder/{2}/contents</contents>'
+                '</collection>'.format(
+                    escape(self.api.folders[folder_id]['name']), self.base,
+                    folder_id))
+
+
+if __name__ == '__main__':
+    print("This file should not be used directly, it is used by tests.py "
+          "and benchmark.py.")
@@ -4,7 +4,7 @@
 SugarSync Linux client.
 
 Usage:
-    sugarsync.py --user <username> --password <password> --application <appId> --accesskey <publicAccessKey> --privatekey <privateAccessKey> ( quota | list | download <fileToDownload> | upload <fileToUpload> )
+    sugarsync.py --user <username> --password <password> --application <appId> --accesskey <publicAccessKey> --privatekey <privateAccessKey> [options] ( quota | list | download [<fileToDownload>...] | upload [<fileToUpload>...] | sync <localDir> | watch <localDir> )
     sugarsync.py -h | --help
     sugarsync.py --version
      
@@ -14,33 +14,76 @@ Options:
     -a --application <appId>              The id of the app created from developer site
        --accesskey <publicAccessKey>      Developer accessKey
        --privatekey <privateAccessKey>    Developer privateAccessKey
-    <fileToDownload>                      The file from default "Magic Briefcase" folder that you want to download
-    <fileToUpload>                        The file from current directory that you want to upload into default "Magic Briefcase" folder 
+    <fileToDownload>                      The file from default "Magic Briefcase" folder that you want to download, or a glob pattern
+    <fileToUpload>                        The file from current directory that you want to upload into default "Magic Briefcase" folder, or a glob pattern
+    <localDir>                            The local directory kept in sync with "Magic Briefcase"
+    --debounce <seconds>                  How long watch waits for a burst of changes to end before uploading [default: 2]
+    --tokens <file>                       Where tokens are cached between runs [default: ~/.sugarsync/tokens.json]
+    --no-token-cache                      Always authenticate with the credentials, don't read or write cached tokens
+    --pool-size <n>                       Max. HTTP connections kept alive [default: 10]
+    --timeout <seconds>                   HTTP connect and read timeout [default: 60]
+    --upload-limit <KBps>                 Max. upload bandwidth, all uploads together, in KB/s
+    --download-limit <KBps>               Max. download bandwidth, all downloads together, in KB/s
+    --bandwidth-limit <KBps>              Max. bandwidth of uploads and downloads together, in KB/s
+    --retries <n>                         Times a request is retried after a server error, 429 or connection error [default: 4]
+    --chunk-size <bytes>                  Bytes written to disk at a time when downloading [default: 65536]
+    --segments <n>                        Connections used to download each file larger than --segment-size, in parallel ranges [default: 1]
+    --segment-size <bytes>                Size of the ranges of a file downloaded over several connections [default: 8388608]
+    --checksum <algorithm>                Compute a checksum (md5, sha1, sha256...) of the downloaded data
+    --mmap                                Upload from a memory map of the file instead of reading it
+    --resume                              Continue an interrupted download or upload of the same file; without files, of all the files of the current directory
+    -j --concurrency <n>                  Max. files transferred, or folders listed, at the same time [default: 4]
+    -r --recursive                        List the contents of the folders within Magic Briefcase too
+    --depth <n>                           How many levels of folders to list recursively, all if not given
+    -n --dry-run                          Only show what sync would transfer
+    --force                               Upload files even if they didn't change since they were last uploaded
+    --metadata-cache <file>               Where folder listings are cached [default: ~/.sugarsync/metadata.db]
+    --no-metadata-cache                   Always download folder listings
+    --cache-ttl <seconds>                 Use cached listings younger than this without asking the server [default: 0]
+    --content-cache <dir>                 Keep copies of the downloaded files in <dir>, and copy the files that didn't change remotely from there instead of downloading them again
+    --cache-size <MB>                     Max. size of the content cache; the least recently used copies are deleted first [default: 1024]
+    --cache-link                          Hard link the files to their copies in the content cache instead of copying them
+    --metrics <file>                      Write request timings and byte counts when the command ends, as JSON, or in the Prometheus text format if <file> ends with .prom
+    --trace <file>                        Write a trace of the requests and transfers when the command ends, for chrome://tracing or Perfetto
     -h --help     Show this screen.
     --version     Show version.
 
 Commands: 
 quota                 - Displays user quota
 list                  - Lists "Magic Briefcase" folder contents
+list -r               - Lists "Magic Briefcase" folder contents and the contents of all the folders within
 download "file.txt"   -  Downloads "file.txt" file  from "Magic Briefcase"
+download "*.txt" a.c  -  Downloads all the .txt files and a.c from "Magic Briefcase"
 upload "file.txt"     - Uploads "file.txt" file  to "Magic Briefcase"
+upload "*.txt" a.c    - Uploads all the .txt files and a.c to "Magic Briefcase"
+download --resume     - Continues the interrupted downloads of the current directory
+upload --resume       - Continues the interrupted uploads of the current directory
+sync "dir"            - Uploads new and changed files from "dir", downloads new and changed files from "Magic Briefcase"
+watch "dir"           - Syncs "dir" once, then keeps running and uploads the files of "dir" as soon as they change
 """
 
 # Main SugarSync Linux client file. It was written with python2.7 in mind.
 
-from docopt import docopt   # docopt creates beautiful command-line interfaces
-import xml.etree.ElementTree as ET
+import time
+STARTED = time.time()       # startup is measured from here, see main()
 import os.path, sys
+import glob
 import logging
 
-#### for DEBUG ####
-import urllib2
-###################
+# The sugarsync packages, docopt and the HTTP stack are imported by the 
+# functions that use them, not here: --help and --version return before 
+# anything heavy is loaded, each command loads only what it needs, and 
+# this file can be imported as a library without side effects.
 
-# sugarsync packages:  
-from auth import RefreshToken, AccessToken
-from utils import (XmlUtils, SugarSyncHTTPGetUtil, FileDownloadAPI,
-                    FileCreation, FileUploadAPI)
+# same logger in all modules; 
+# .getLogger(name) retrieves the logger with name, creating it if necessary
+logger = logging.getLogger('sugarsync')
+
+# set by main()
+metadata_cache = None
+content_cache = None
+token_provider = None
+user_url = None
 
 ONE_GB = 1024.0 * 1024 * 1024
 
@@ -50,7 +93,7 @@ def handle_quota_command(user):
     """ Handles "quota" tool command. Takes a user instance and extracts from 
     its info in xml format the quota information and displays it."""
 
-    logger.debug("User info: \n" + user.xml_info.pprint())
+    logger.debug("User info: \n%s", user.xml_info)
 
     '''user xml info example: '''
     '''
@@ -77,25 +120,43 @@ def handle_quota_command(user):
     print("Free storage: {0:.3} GB \n".format(free_storage_in_GB) )
 
 
-def handle_list_command(user):
-    """Handles "list" tool command. Makes an HTTP GET request to the
+def handle_list_command(user, recursive=False, depth=None, concurrency=1):
+    """Handles "list" tool command. Makes HTTP GET requests to the
     user's "Magic Briefcase" contents link and displays the file and folder 
-    names within Magic Briefcase."""
+    names within Magic Briefcase, while they are being received.
+    With recursive=True, the contents of the folders within are listed 
+    too, down to depth levels, concurrency folders at a time."""
     
-    logger.debug("User info: \n" + user.xml_info.pprint())
-
-    contents = get_magic_briefcase_contents(user)
+    from listing import walk_collection
     
-    logger.debug("Magic Briefcase contents: \n" + contents.xml_info.pprint())
+    logger.debug("User info: \n%s", user.xml_info)
 
-    print_folder_contents("MagicBriefcase", contents.xml_info)
+    if recursive:
+        contents = walk_collection(user.access_token, 
+                                   get_magic_briefcase_contents_url(user),
+                                   depth, concurrency, cache=metadata_cache)
+        print_folder_tree("MagicBriefcase", contents)
+    else:
+        contents = get_magic_briefcase_contents(user)
+        print_folder_contents("MagicBriefcase", contents)
 
 
 def get_magic_briefcase_contents(user):
+    """Returns an iterator over the contents of Magic Briefcase, see 
+    listing.iter_collection_contents()."""
+    
+    from listing import iter_collection_contents
+    
+    # Make HTTP GET requests, one per page of contents
+    return iter_collection_contents(user.access_token, 
+                                    get_magic_briefcase_contents_url(user),
+                                    cache=metadata_cache)
+
+
+def get_magic_briefcase_contents_url(user):
     '''
-    Extracts the url to the Magic Briefcase resource, creates the url to
-    the Magic Briefcase resource's contents and returns the response to
-    that url.
+    Extracts the url to the Magic Briefcase resource and returns the url to
+    the Magic Briefcase resource's contents.
     
     Info:
     Make an HTTP GET request to the URL that represents a collection 
@@ -106,162 +167,576 @@ def get_magic_briefcase_contents(user):
     
     # get the URL for magic briefcase collection resource from user info
     magic_briefcase_url = user.xml_info.get_node_values("./magicBriefcase")
-    user.magic_briefcase = SugarSyncHTTPGetUtil(user.access_token, 
-                                                magic_briefcase_url)
+    user.magic_briefcase = get_resource(user.access_token, magic_briefcase_url)
     
-    logger.debug("Magic Briefcase resource: \n" + 
-                 user.magic_briefcase.xml_info.pprint())
+    logger.debug("Magic Briefcase resource: \n%s", 
+                 user.magic_briefcase.xml_info)
     
     # the URL that represents a collection's contents is obtained either by 
     # appending /contents to the  URL that represents the collection:
 #    magic_briefcase_url += '/contents'
     # or by reading the url from the xml response:
-    contents_url = user.magic_briefcase.xml_info.get_node_values(".contents")
-    # Make a HTTP GET request, GET because data keyword param is empty.
-    user.magic_briefcase.contents =  SugarSyncHTTPGetUtil(user.access_token, 
-                                                contents_url)
-    
-    return user.magic_briefcase.contents
-    
-    
-def print_folder_contents(collection_name, xml_resources):
-    """Print folder contents."""
-    
-    folder_contents_template = ("-{0} \n\t"
-                                "-Folders:"
-                                    "{1}"
-                                    "\n\t"
-                                "-Files:"
-                                    "{2}") 
-    folder_names, file_names = "", ""
-    for folder in xml_resources.get_root_element().findall('./collection'):
-        folder_names += "\n\t\t"
-        folder_names += folder.find('displayName').text
-        
-    for file in xml_resources.get_root_element().findall('./file'):
-        file_names += "\n\t\t"
-        file_names += file.find('displayName').text
-        
+    return user.magic_briefcase.xml_info.get_node_values(".contents")
+
+
+def get_resource(access_token, url):
+    """Makes a HTTP GET request to url, going through the metadata cache
+    if there is one."""
+    
+    if metadata_cache is None:
+        from utils import SugarSyncHTTPGetUtil
+        return SugarSyncHTTPGetUtil(access_token, url)
+    from metacache import CachedHTTPGetUtil
+    return CachedHTTPGetUtil(access_token, url, metadata_cache)
+    
+    
+def print_folder_contents(collection_name, entries):
+    """Print folder contents as they arrive; folder names end with "/"."""
+    
     print("\n\n")
-    print(folder_contents_template.format(collection_name, folder_names, 
-                                          file_names))
+    print("-{0}".format(collection_name))
+    for entry in entries:
+        if entry.kind == 'file':
+            print("\t{0}".format(entry.name))
+        else:
+            print("\t{0}/".format(entry.name))
+    print("\n\n")
+
+
+def print_folder_tree(collection_name, paths):
+    """Print the (path, entry) pairs of a folder tree as they arrive; 
+    folder paths end with "/", file paths are followed by the file size."""
+    
+    print("\n\n")
+    print("-{0}".format(collection_name))
+    for path, entry in paths:
+        if entry.kind == 'file':
+            print("\t{0}\t{1}".format(path, entry.size))
+        else:
+            print("\t{0}/".format(path))
     print("\n\n")
         
  
-def handle_download_command(user, filename):
-    """Issues an HTTP GET request to the data resource for the file."""
+def handle_download_command(user, filenames, chunk_size=None, checksum=None,
+                            resume=False, concurrency=1, segments=1, 
+                            segment_size=None):
+    """Issues an HTTP GET request to the data resource for each file. 
+    filenames can contain glob patterns, e.g. "*.txt"; the files are 
+    downloaded concurrently by at most concurrency worker threads, and the
+    files larger than segment_size over segments connections each."""
+    
+    from listing import FolderIndex
+    from transfers import TransferBatch
     
-    logger.debug("User info: \n" + user.xml_info.pprint())
+    logger.debug("User info: \n%s", user.xml_info)
     # get the contents of Magic Briefcase as xml
     contents = get_magic_briefcase_contents(user)
-    logger.debug("Magic Briefcase contents: \n" + contents.xml_info.pprint())
-
-    files = contents.xml_info.get_root_element().findall('./file')
-    # the following loop is time consuming, especially if there are hundreds 
-    # of files
-    for file_resource in files:
-        absolute_path = file_resource.find('./displayName').text
-        # sometimes displayName contains the absolute path, but you 
-        # usually specify just the basename at the command line.
-        # extract basename from path:
-        name = os.path.basename(absolute_path)
-        if filename == name:
-            logger.info("file found")
-            file_url = file_resource.find('./fileData').text
-            downloader = FileDownloadAPI(user.access_token, file_url)
-            downloader.download(filename)
-            
-            logger.info('\nDownload completed successfully. The {0} from ' 
-                        '"MagicBriefcase" was downloaded to the '
-                        'local directory.'.format(filename))
-            return
+
+    # one pass over the listing, then each lookup is a dictionary lookup
+    index = FolderIndex.from_entries(contents)
+    batch = TransferBatch(concurrency)
+    for filename in filenames:
+        matches = index.lookup(filename)
+        for name, file_url in matches:
+            logger.info("file {0} found".format(name))
+            # the version, from the listing, is the content cache key
+            version = None
+            if content_cache is not None:
+                version = content_cache.version_of(index.sizes.get(file_url),
+                                                   index.modified.get(file_url))
+            # the smaller files first
+            batch.add(name, download_and_report, user, file_url, name, 
+                      chunk_size, checksum, resume, segments, segment_size,
+                      version, priority=index.sizes.get(file_url, 0))
+        if not matches:
+            logger.info("File {0} not found in MagicBriefcase "
+                        "folder.".format(filename))
+    
+    batch.run()
+    if batch.completed:
+        logger.info('\nDownload completed successfully. The {0} from ' 
+                    '"MagicBriefcase" was downloaded to the '
+                    'local directory.'.format(', '.join(batch.completed)))
+    if len(batch.jobs) > 1:
+        print(batch.summary())
+
+
+def download_and_report(user, file_url, filename, chunk_size=None, 
+                        checksum=None, resume=False, segments=1, 
+                        segment_size=None, version=None):
+    """Downloads a file, logs its checksum and returns its size; a 
+    TransferBatch job."""
+    
+    digest = download_file(user, file_url, filename, chunk_size, checksum,
+                           resume, segments, segment_size, version)
+    if digest is not None:
+        logger.info('{0} {1}: {2}'.format(checksum, filename, digest))
+    return os.path.getsize(filename)
+
+
+def download_file(user, file_url, filename, chunk_size=None, checksum=None,
+                  resume=False, segments=1, segment_size=None, version=None):
+    """Downloads the file data from file_url to filename and returns the 
+    checksum, if one was asked for. With resume=True, a download of the 
+    same file interrupted before continues from where it stopped.
+    With segments > 1, a file larger than segment_size is downloaded in 
+    ranges over that many connections at once, see 
+    utils.SegmentedDownloadAPI; that isn't resumable.
+    With a content cache and the version of the remote file, see 
+    contentcache.ContentCache.version_of(), an unchanged file is copied 
+    from the cache, and a downloaded one added to it."""
+    
+    from utils import FileDownloadAPI, SegmentedDownloadAPI, hash_file
+    from transfers import TransferJournal
+    
+    use_cache = content_cache is not None and version is not None
+    if use_cache:
+        sha1 = content_cache.get(file_url, version, filename)
+        if sha1 is not None:
+            logger.info("{0} copied from the content cache".format(filename))
+            if checksum == 'sha1':
+                return sha1
+            return hash_file(filename, checksum) if checksum else None
+    
+    journal = TransferJournal('download', filename)
+    temp_filename = filename + '.part'
+    offset = 0
+    if (resume and journal.remote_url == file_url and 
+            os.path.exists(temp_filename)):
+        # only the bytes recorded in the journal are sure to be on disk
+        offset = min(journal.offset, os.path.getsize(temp_filename))
+        logger.info("Resuming download of {0} at byte {1}".format(filename,
+                                                                  offset))
+    
+    if segments > 1 and not offset:
+        # the first range tells the size; a small file is all in it
+        downloader = SegmentedDownloadAPI(user.access_token, file_url, 
+                                          segments, segment_size)
+        digest = downloader.download(filename, chunk_size, checksum)
     else:
-        logger.info("File {0} not found in MagicBriefcase "
-                    "folder.".format(filename))
+        downloader = FileDownloadAPI(user.access_token, file_url, offset)
+        if downloader.offset and downloader.size != journal.size:
+            # the remote file changed since the download was interrupted
+            logger.info("{0} changed remotely, downloading it "
+                        "again".format(filename))
+            downloader.response.close()
+            downloader = FileDownloadAPI(user.access_token, file_url)
+        digest = downloader.download(filename, chunk_size, checksum, journal)
+    if use_cache:
+        content_cache.put(file_url, version, filename)
+    return digest
+
         
-def handle_upload_command(user, file):
-    """Handles "upload" tool command. 
-    1. Extracts the "Magic Briefcase" folder link from the user object
-    2. Creates a file representation in remote "Magic Briefcase" folder
-    3. Uploads the file data associated to the previously created file
-       representation"""
+def handle_upload_command(user, files, use_mmap=False, resume=False,
+                          concurrency=1, force=False):
+    """Handles "upload" tool command. files can contain glob patterns, 
+    e.g. "*.txt"; the files are uploaded concurrently by at most 
+    concurrency worker threads, see upload_file().
+    Files whose content didn't change since they were last uploaded are 
+    skipped, unless force=True, see sync.plan_uploads(); files with the 
+    same content are reported."""
+    
+    from sync import UploadIndex, find_duplicates, plan_uploads
+    from transfers import TransferBatch, Lookahead
     
-    if not os.path.exists(file):
-        logger.info("\nFile {0} does not exist "
-                    "in the current directory!".format(file))
+    paths = []
+    for file in files:
+        matches = sorted(glob.glob(file))
+        if not matches:
+            logger.info("\nFile {0} does not exist "
+                        "in the current directory!".format(file))
+        paths.extend(path for path in matches if os.path.isfile(path))
+    if not paths:
         sys.exit()
-        
+    
+    index = UploadIndex()
+    for group in find_duplicates(paths, index.local_hash):
+        print("same content:\t{0}".format("\t".join(group)))
+    
+    if force:
+        uploads = [(path, None) for path in paths]
+    else:
+        remote = dict((entry.name, entry) 
+                      for entry in get_magic_briefcase_contents(user))
+        uploads, unchanged = plan_uploads(paths, remote, index)
+        for path in unchanged:
+            logger.info("{0} is unchanged, skipped".format(path))
+    
+    # the remote files are created a little ahead of the uploads that fill
+    # them, in the order the batch runs them; with resume, the journals 
+    # may have them already, they are created when needed
+    new_files = [] if resume else sorted((path for path, file_data_url 
+                                          in uploads if file_data_url is None),
+                                         key=os.path.getsize)
+    file_links = Lookahead(lambda path: create_remote_file(user, path),
+                           new_files, concurrency)
+    batch = TransferBatch(concurrency)
+    for path, file_data_url in uploads:
+        # the smaller files first
+        batch.add(path, upload_file, user, path, use_mmap, resume,
+                  file_data_url, index, file_links,
+                  priority=os.path.getsize(path))
+    try:
+        batch.run()
+    finally:
+        # after a failure or Ctrl+C, some files may be created but empty
+        for path, file_data_url in sorted(file_links.close().items()):
+            logger.warning("{0} was created remotely, at {1}, but not "
+                           "uploaded".format(path, file_data_url))
+    
+    if metadata_cache is not None and batch.jobs:
+        # the listing of Magic Briefcase changed
+        magic_briefcase_url = user.xml_info.get_node_values("./magicBriefcase")
+        metadata_cache.invalidate(magic_briefcase_url)
+    if batch.completed:
+        logger.info('\nUpload completed successfully. Check "Magic Briefcase" '
+                    'remote folder')
+    if len(batch.jobs) > 1:
+        print(batch.summary())
+
+
+def create_remote_file(user, file):
+    """Creates a file representation in remote "Magic Briefcase" folder and
+    returns the URL of its data."""
+    
+    from utils import FileCreation
+    
     # get the URL for magic briefcase collection resource from user info
     magic_briefcase_url = user.xml_info.get_node_values("./magicBriefcase")
     file_representation = FileCreation(user.access_token, magic_briefcase_url)
+    return file_representation.create_file(file, 'text/plain')
+
 
-    fileLink = file_representation.create_file(file, 'text/plain')
-    logger.debug("File data link: %s" % fileLink)
+def upload_file(user, file, use_mmap=False, resume=False, file_data_url=None,
+                index=None, file_links=None):
+    """Uploads a file and returns its size:
+    1. Extracts the "Magic Briefcase" folder link from the user object
+    2. Creates a file representation in remote "Magic Briefcase" folder,
+       unless file_data_url, the data URL of an existing file, is given;
+       if file_links, a transfers.Lookahead, is given, it created it 
+       already, or creates it now
+    3. Uploads the file data associated to the previously created file
+       representation
+    With resume=True, the file representation created by an interrupted 
+    upload of the same file is reused instead of creating a new one.
+    The upload is recorded in index, a sync.UploadIndex, if given."""
+    
+    from utils import FileUploadAPI
+    from transfers import TransferJournal
+    from sync import get_remote_metadata
+    
+    journal = TransferJournal('upload', file)
+    stat = os.stat(file)
+    if file_data_url is not None:
+        fileLink = file_data_url
+    elif (resume and journal.remote_url and journal.size == stat.st_size and
+            journal.entry.get('mtime') == stat.st_mtime):
+        # the API has no partial uploads, the data is sent again, but to 
+        # the file created last time
+        fileLink = journal.remote_url
+        logger.info("Resuming upload of {0}".format(file))
+    elif file_links is not None:
+        fileLink = file_links.take(file)
+    else:
+        fileLink = create_remote_file(user, file)
+    journal.start(fileLink, stat.st_size, mtime=stat.st_mtime)
+    logger.debug("File data link: %s", fileLink)
     
     uploader = FileUploadAPI(user.access_token)
-    response = uploader.upload_file(fileLink, file)
-    logger.debug("response status %s" % response.status_code)
+    # hashed while it is sent, for the index
+    response = uploader.upload_file(fileLink, file, use_mmap, 
+                                    checksum='sha1')
+    logger.debug("response status %s", response.code)
+    journal.finish()
+    
+    if index is not None:
+        remote_size, remote_modified = get_remote_metadata(user.access_token,
+                                                           fileLink)
+        index.put(os.path.abspath(file), stat.st_size, stat.st_mtime,
+                  uploader.checksum, fileLink, remote_size, 
+                  remote_modified)
+    
+    return stat.st_size
     
-    logger.info('\nUpload completed successfully. Check "Magic Briefcase" '
-                'remote folder')
+
+
+def get_interrupted_files(direction, journal_directory=None):
+    """Returns the paths, relative to the current directory, of the files
+    below it whose last download or upload (direction) was interrupted,
+    see transfers.TransferJournal.pending()."""
+    
+    from transfers import TransferJournal
+    
+    files = []
+    for journal in TransferJournal.pending(journal_directory):
+        path = os.path.relpath(journal.local_path)
+        if journal.direction == direction and not path.startswith(os.pardir):
+            files.append(path)
+    return files
+
+
+def handle_sync_command(user, directory, dry_run=False, concurrency=1):
+    """Handles "sync" tool command: two-way synchronization of directory 
+    with "Magic Briefcase", see sync.SyncEngine. Files changed on both 
+    sides since the last sync are reported as conflicts and left alone."""
     
+    from sync import SyncEngine
     
+    if not os.path.isdir(directory):
+        logger.info("\nDirectory {0} does not exist!".format(directory))
+        sys.exit()
     
-### MAIN ####
+    magic_briefcase_url = user.xml_info.get_node_values("./magicBriefcase")
+    engine = SyncEngine(user.access_token, directory, magic_briefcase_url,
+                        get_magic_briefcase_contents_url(user), concurrency)
+    plan, batch = engine.run(dry_run)
+    report_sync(plan, batch, engine.changed_folders)
 
-# Create a beautiful CLI interface from the help string, in this case, __doc__
-arguments = docopt(__doc__, version='SugarSync for Linux 0.1', help=True)
 
-# same logger in all modules; 
-# .getLogger(name) retrieves the logger with name, creating it if necessary
-logger = logging.getLogger('sugarsync')
+def report_sync(plan, batch, changed_folders=()):
+    """Prints what a synchronization did, or would do if batch is None, and
+    drops the cached listings of changed_folders, the URLs of the folders 
+    it uploaded to or created folders in."""
+    
+    for path in plan.uploads:
+        print("upload\t{0}".format(path))
+    for path in plan.downloads:
+        print("download\t{0}".format(path))
+    for path in plan.conflicts:
+        print("CONFLICT\t{0}\tchanged on both sides, not synchronized".format(
+                                                                        path))
+    for path in plan.deleted_locally:
+        print("deleted\t{0}\tdeleted locally, kept remotely".format(path))
+    for path in plan.deleted_remotely:
+        print("deleted\t{0}\tdeleted remotely, kept locally".format(path))
+    print(plan.summary())
+    
+    if batch is not None:
+        if metadata_cache is not None:
+            # the folder resource and the pages of its contents
+            for folder_url in changed_folders:
+                metadata_cache.invalidate(folder_url)
+        if batch.jobs:
+            print(batch.summary())
 
-# Retrieve the command line arguments:
-username = arguments['--user']
-password = arguments['--password']
-application = arguments['--application']
-access_key = arguments['--accesskey']
-private_access_key = arguments['--privatekey']
 
-"""
-Get authentication tokens; 
-RefreshToken is persistent, but AccessToken isn't(about 1 hour)
-RefreshToken exists so that the app doesn't need to store the user's 
-username & password for accessing user's resources
-"""
-refresh_token = RefreshToken(username, password, application, 
-                                    access_key, private_access_key).token
-access_object = AccessToken(access_key, private_access_key, refresh_token)
-access_token = access_object.token
-user_url = XmlUtils(access_object.response_body).get_node_values("./user")
-
-user = SugarSyncHTTPGetUtil(access_token, user_url)
-
-## DEBUG ##
-logger.debug('Refresh Token: ' + refresh_token)
-logger.debug('Access Token: ' + access_token)
-logger.debug('Response to request for access token: \n' + 
-             XmlUtils(access_object.response_body).pprint())
-###########
-
-if arguments['quota']:
-    logger.info('"Quota" command chosen.')
-    handle_quota_command(user)
-elif arguments['list']:
-    logger.info('"List" command chosen.')
-    handle_list_command(user)
-elif arguments['download']:
-    file = arguments['<fileToDownload>']
-    logger.info('"Download {0}" command chosen.'.format(file))
-    handle_download_command(user, file)
-elif arguments['upload']:
-    file = arguments['<fileToUpload>']
-    logger.info('"Upload {0}" command chosen.'.format(file))
-    handle_upload_command(user, file)
-else:
-    # it will never get here because docopt takes care of that;
-    # this is left for future extension
-    logger.info('Unknown command')
-
-logger.info("sugarsync.py end")
-###########
\ No newline at end of file
+def handle_watch_command(user, directory, debounce=2.0, concurrency=1):
+    """Handles "watch" tool command: synchronizes directory like "sync", 
+    then watches it with inotify and uploads the files that change, in 
+    batches, see watch.WatchDaemon. Runs until interrupted with Ctrl+C."""
+    
+    from sync import SyncEngine
+    from watch import WatchDaemon
+    
+    if not os.path.isdir(directory):
+        logger.info("\nDirectory {0} does not exist!".format(directory))
+        sys.exit()
+    
+    magic_briefcase_url = user.xml_info.get_node_values("./magicBriefcase")
+    engine = SyncEngine(user.access_token, directory, magic_briefcase_url,
+                        get_magic_briefcase_contents_url(user), concurrency)
+    
+    def report(plan, batch):
+        if batch.jobs or plan.conflicts:
+            report_sync(plan, batch, engine.changed_folders)
+    
+    daemon = WatchDaemon(engine, refresh_access_token, debounce,
+                         on_batch=report)
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        logger.info("Stopped watching {0}".format(directory))
+
+
+def refresh_access_token():
+    """Returns a valid access token, getting a new one if the current one 
+    is about to expire, and keeps a connection to the server open by 
+    requesting the user resource with it; used by the "watch" daemon."""
+    
+    from utils import SugarSyncHTTPGetUtil
+    
+    token = token_provider.get_token()
+    SugarSyncHTTPGetUtil(token, user_url)
+    return token
+    
+    
+def main(argv=None):
+    """Runs the command given in argv, sys.argv[1:] by default."""
+    
+    global metadata_cache, content_cache, token_provider, user_url
+    
+    # nothing is left over from an earlier call in the same process
+    metadata_cache = content_cache = token_provider = user_url = None
+    
+    # Create a beautiful CLI interface from the help string, in this case, __doc__
+    from docopt import docopt   # docopt creates beautiful command-line interfaces
+    arguments = docopt(__doc__, argv, version='SugarSync for Linux 0.1', 
+                       help=True)
+
+    # sugarsync packages:
+    from utils import get_logger
+    from metrics import METRICS
+
+    # the log file is created, and the handlers attached, only now
+    get_logger('sugarsync', 'sugarsync.log')
+
+    for command, files in [('download', '<fileToDownload>'),
+                           ('upload', '<fileToUpload>')]:
+        if arguments[command] and not arguments[files]:
+            if not arguments['--resume']:
+                logger.info("\nNo file to {0} given!".format(command))
+                sys.exit()
+            arguments[files] = get_interrupted_files(command)
+            if not arguments[files]:
+                logger.info("\nNo interrupted {0} in the current "
+                            "directory.".format(command))
+                sys.exit()
+
+    # the measures are written when main() ends, whatever the command and
+    # however it ends, see shutdown()
+    if arguments['--trace']:
+        METRICS.tracing = True
+    try:
+        run_command(arguments)
+    finally:
+        shutdown(arguments['--metrics'], arguments['--trace'])
+
+
+def shutdown(metrics_file=None, trace_file=None):
+    """Writes the measures, if asked for, and closes the caches; called
+    when main() ends, normally or not."""
+    
+    from metrics import METRICS
+    
+    global metadata_cache, content_cache
+    
+    if metrics_file:
+        METRICS.write(metrics_file)
+    if trace_file:
+        METRICS.write_trace(trace_file)
+    for cache in (metadata_cache, content_cache):
+        if cache is not None:
+            cache.close()
+    metadata_cache = content_cache = None
+
+
+def run_command(arguments):
+    """Runs the command parsed by main() from the command line."""
+    
+    # sugarsync packages:
+    from auth import TokenStore, TokenProvider
+    from utils import (XmlUtils, SugarSyncHTTPGetUtil, RequestPolicy, 
+                       configure_session, set_token_provider, 
+                       set_bandwidth_limits)
+    
+    global metadata_cache, content_cache, token_provider, user_url
+    
+    # Retrieve the command line arguments:
+    username = arguments['--user']
+    password = arguments['--password']
+    application = arguments['--application']
+    access_key = arguments['--accesskey']
+    private_access_key = arguments['--privatekey']
+
+    # one pool of keep-alive connections for all the requests made below;
+    # each concurrent transfer, and each range of a segmented download, 
+    # needs a connection of its own
+    concurrency = int(arguments['--concurrency'])
+    segments = int(arguments['--segments'])
+    configure_session(pool_size=max(int(arguments['--pool-size']), 
+                                    concurrency * segments),
+                      timeout=float(arguments['--timeout']),
+                      policy=RequestPolicy(retries=int(arguments['--retries'])))
+
+    # the transfers share the bandwidth limits: upload, download, total
+    set_bandwidth_limits(*[float(arguments[option]) * 1024 if arguments[option]
+                           else None for option in ('--upload-limit', 
+                                                    '--download-limit', 
+                                                    '--bandwidth-limit')])
+
+    # folder listings are revalidated with conditional requests, or not at 
+    # all while they are younger than --cache-ttl; quota lists nothing
+    if not (arguments['--no-metadata-cache'] or arguments['quota']):
+        from metacache import MetadataCache
+        metadata_cache = MetadataCache(arguments['--metadata-cache'],
+                                       ttl=float(arguments['--cache-ttl']))
+    # the content of the downloaded files, only if asked for: it takes disk
+    # space, up to --cache-size
+    if arguments['--content-cache'] and arguments['download']:
+        from contentcache import ContentCache
+        max_bytes = int(arguments['--cache-size']) * 1024 * 1024
+        content_cache = ContentCache(arguments['--content-cache'], max_bytes,
+                                     link=arguments['--cache-link'])
+
+    logger.debug("Started in %.0f ms", (time.time() - STARTED) * 1000)
+
+    """
+    Get authentication tokens; 
+    RefreshToken is persistent, but AccessToken isn't(about 1 hour)
+    RefreshToken exists so that the app doesn't need to store the user's 
+    username & password for accessing user's resources
+    Both are cached in the token store, so usually no request is made here.
+    The token provider renews the Access Token when it is about to expire or
+    is rejected, so commands that run longer than an hour don't fail halfway.
+    """
+    token_store = None
+    if not arguments['--no-token-cache']:
+        token_store = TokenStore(arguments['--tokens'])
+    token_provider = TokenProvider(username, password, application, access_key,
+                                   private_access_key, store=token_store)
+    set_token_provider(token_provider)
+    access_object = token_provider.get_access()
+    access_token = access_object.token
+    user_url = XmlUtils(access_object.response_body).get_node_values("./user")
+
+    user = SugarSyncHTTPGetUtil(access_token, user_url)
+
+    ## DEBUG ##
+    # the arguments are formatted only if debug records are written
+    logger.debug('Access Token: %s', access_token)
+    logger.debug('Response to request for access token: \n%s', 
+                 XmlUtils(access_object.response_body))
+    ###########
+
+    if arguments['quota']:
+        logger.info('"Quota" command chosen.')
+        handle_quota_command(user)
+    elif arguments['list']:
+        logger.info('"List" command chosen.')
+        depth = arguments['--depth']
+        handle_list_command(user, arguments['--recursive'], 
+                            int(depth) if depth else None, concurrency)
+    elif arguments['download']:
+        files = arguments['<fileToDownload>']
+        logger.info('"Download {0}" command chosen.'.format(' '.join(files)))
+        handle_download_command(user, files, int(arguments['--chunk-size']),
+                                arguments['--checksum'], arguments['--resume'],
+                                concurrency, segments, 
+                                int(arguments['--segment-size']))
+    elif arguments['upload']:
+        files = arguments['<fileToUpload>']
+        logger.info('"Upload {0}" command chosen.'.format(' '.join(files)))
+        handle_upload_command(user, files, arguments['--mmap'], 
+                              arguments['--resume'], concurrency, 
+                              arguments['--force'])
+    elif arguments['sync']:
+        directory = arguments['<localDir>']
+        logger.info('"Sync {0}" command chosen.'.format(directory))
+        handle_sync_command(user, directory, arguments['--dry-run'], concurrency)
+    elif arguments['watch']:
+        directory = arguments['<localDir>']
+        logger.info('"Watch {0}" command chosen.'.format(directory))
+        handle_watch_command(user, directory, float(arguments['--debounce']),
+                             concurrency)
+    else:
+        # it will never get here because docopt takes care of that;
+        # this is left for future extension
+        logger.info('Unknown command')
+
+    logger.info("sugarsync.py end")
+
+
+### MAIN ####
+
+if __name__ == '__main__':
+    main()
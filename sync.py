@@ -0,0 +1,470 @@
+#!/usr/bin/python
+
+"""Contains the two-way synchronization of a local directory with the
+"Magic Briefcase" folder.
+
+Each run compares three things: the local tree, the remote tree and the
+state recorded in a local database at the end of the previous run. Only
+what changed on one side since then is transferred; a file changed on both
+sides is a conflict, which is reported and left alone. Deletions are
+reported too, but never propagated."""
+
+import os
+import hashlib
+import sqlite3
+import logging
+import mimetypes
+import threading
+
+# sugarsync packages:
+from utils import (SugarSyncHTTPGetUtil, FileDownloadAPI, FileCreation,
+                   FolderCreation, FileUploadAPI, RequestError, hash_file,
+                   throttle)
+from listing import Entry, walk_collection
+from transfers import TransferBatch, Lookahead
+
+# same logger in all modules
+logger = logging.getLogger('sugarsync')
+
+
+def get_remote_metadata(access_token, file_data_url):
+    '''Returns the size and lastModified of the remote file whose data is
+    at file_data_url; after an upload, the server decides them.'''
+
+    file_url = file_data_url[:-len('/data')]
+    remote = SugarSyncHTTPGetUtil(access_token, file_url).xml_info
+    return (int(remote.get_node_values('./size')),
+            remote.get_node_values('./lastModified'))
+
+
+class SyncState(object):
+    '''The state of each file at the end of the last synchronization, in a
+    SQLite database: local size, mtime and sha1 hash, remote fileData URL,
+    size and lastModified.'''
+
+    FILENAME = '.sugarsync-state.db'
+
+    def __init__(self, path):
+        self.path = path
+        # the connection is shared by the transfer threads, one at a time
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS files ('
+                                    'path TEXT PRIMARY KEY, '
+                                    'size INTEGER, '
+                                    'mtime REAL, '
+                                    'hash TEXT, '
+                                    'remote_url TEXT, '
+                                    'remote_size INTEGER, '
+                                    'remote_modified TEXT)')
+
+    def all(self):
+        '''Returns {path: row}, rows are dictionary-like.'''
+        with self.lock:
+            rows = self.connection.execute('SELECT * FROM files').fetchall()
+        return dict((row['path'], row) for row in rows)
+
+    def put(self, path, size, mtime, hash, remote_url, remote_size,
+            remote_modified):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (path, size, mtime, hash, remote_url, remote_size,
+                 remote_modified))
+
+    def delete(self, path):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM files WHERE path = ?',
+                                    (path,))
+
+    def close(self):
+        self.connection.close()
+
+
+class SyncPlan(object):
+    '''What a synchronization has to do, as lists of relative paths.'''
+
+    def __init__(self):
+        self.uploads = []
+        self.downloads = []
+        self.conflicts = []
+        self.deleted_locally = []       # still present remotely
+        self.deleted_remotely = []      # still present locally
+        self.forget = []                # deleted on both sides
+        self.adopt = []                 # present on both sides, same content
+
+    def summary(self):
+        return ("{0} to upload, {1} to download, {2} conflicts, "
+                "{3} deleted locally, {4} deleted remotely".format(
+                    len(self.uploads), len(self.downloads),
+                    len(self.conflicts), len(self.deleted_locally),
+                    len(self.deleted_remotely)))
+
+
+def scan_local(directory):
+    '''Returns {relative path: (size, mtime)} for the files below
+    directory, except the state database and partial downloads.'''
+
+    files = {}
+    for root, dirnames, filenames in os.walk(directory):
+        for filename in filenames:
+            if (filename.startswith(SyncState.FILENAME) or
+                    filename.endswith('.part')):
+                continue
+            path = os.path.join(root, filename)
+            stat = os.stat(path)
+            relative_path = os.path.relpath(path, directory)
+            files[relative_path.replace(os.sep, '/')] = (stat.st_size,
+                                                         stat.st_mtime)
+    return files
+
+
+def plan_sync(local, remote, state, hash_local=None, hash_remote=None):
+    '''Compares the local files, {path: (size, mtime)}, the remote files,
+    {path: listing.Entry}, and the state, {path: row}, and returns a
+    SyncPlan. hash_local(path) is called to tell a file whose mtime changed
+    from one whose content changed.
+    A file present on both sides but never synchronized is adopted only if
+    hash_local(path) and hash_remote(path) tell the content is the same;
+    without them, or if the content differs, it is a conflict.'''
+
+    plan = SyncPlan()
+    for path in sorted(set(local) | set(remote) | set(state)):
+        l, r, s = local.get(path), remote.get(path), state.get(path)
+
+        if s is None:
+            if l is not None and r is None:
+                plan.uploads.append(path)
+            elif r is not None and l is None:
+                plan.downloads.append(path)
+            elif (l[0] == r.size and hash_local is not None and
+                    hash_remote is not None and
+                    hash_local(path) == hash_remote(path)):
+                # the same file, synchronized some other way
+                plan.adopt.append(path)
+            else:
+                plan.conflicts.append(path)
+            continue
+
+        if l is None and r is None:
+            plan.forget.append(path)
+        elif l is None:
+            plan.deleted_locally.append(path)
+        elif r is None:
+            plan.deleted_remotely.append(path)
+        else:
+            local_changed = (l[0] != s['size'] or l[1] != s['mtime'])
+            if local_changed and hash_local is not None:
+                # touched, but not modified?
+                local_changed = hash_local(path) != s['hash']
+            remote_changed = (r.size != s['remote_size'] or
+                              r.last_modified != s['remote_modified'])
+            if local_changed and remote_changed:
+                plan.conflicts.append(path)
+            elif local_changed:
+                plan.uploads.append(path)
+            elif remote_changed:
+                plan.downloads.append(path)
+    return plan
+
+
+class SyncEngine(object):
+    '''Synchronizes directory with a remote collection, by default "Magic
+    Briefcase": collection_url is the collection resource, contents_url
+    the URL of its contents.'''
+
+    def __init__(self, access_token, directory, collection_url, contents_url,
+                 concurrency=4):
+        self.access_token = access_token
+        self.directory = directory
+        self.collection_url = collection_url
+        self.contents_url = contents_url
+        self.concurrency = concurrency
+        self.state = SyncState(os.path.join(directory, SyncState.FILENAME))
+        # the URLs of the remote folders whose listing the last carry_out()
+        # changed, e.g. to drop them from a metacache.MetadataCache
+        self.changed_folders = set()
+
+    def local_path(self, path):
+        return os.path.join(self.directory, *path.split('/'))
+
+    def scan_remote(self):
+        '''Returns ({path: Entry} of files, {path: URL} of folders).'''
+        files, folders = {}, {}
+        for path, entry in walk_collection(self.access_token,
+                                           self.contents_url,
+                                           concurrency=self.concurrency):
+            if entry.kind == 'file':
+                files[path] = entry
+            else:
+                folders[path] = entry.ref
+        return files, folders
+
+    def run(self, dry_run=False):
+        '''Synchronizes and returns the SyncPlan that was carried out, and
+        the TransferBatch that did it (None for a dry run).'''
+
+        local = scan_local(self.directory)
+        self.remote, self.folders = self.scan_remote()
+        plan = plan_sync(local, self.remote, self.state.all(), self.hash_local,
+                         self.hash_remote)
+        if dry_run:
+            return plan, None
+        return plan, self.carry_out(plan)
+
+    def sync_paths(self, paths):
+        '''Synchronizes only the files at the given relative paths and
+        returns the SyncPlan and the TransferBatch, like run(). Instead of
+        listing the remote tree again, the files are compared with the
+        listing of the last run(), kept up to date by the uploads since and
+        by refresh_remote(); the "watch" daemon knows which files changed.'''
+
+        paths = set(paths)
+        self.refresh_remote(paths)
+        local = {}
+        for path in paths:
+            local_path = self.local_path(path)
+            if os.path.isfile(local_path):
+                stat = os.stat(local_path)
+                local[path] = (stat.st_size, stat.st_mtime)
+        remote = dict((path, entry) for path, entry in self.remote.items()
+                      if path in paths)
+        state = dict((path, row) for path, row in self.state.all().items()
+                     if path in paths)
+        plan = plan_sync(local, remote, state, self.hash_local,
+                         self.hash_remote)
+        return plan, self.carry_out(plan)
+
+    def refresh_remote(self, paths):
+        '''Updates the size and lastModified of the remote files at paths in
+        the listing of the last run(), which may have changed remotely
+        since; the files deleted remotely are dropped from it.'''
+        for path in paths:
+            entry = self.remote.get(path)
+            if entry is None:
+                continue
+            try:
+                size, modified = get_remote_metadata(self.access_token,
+                                                     entry.url)
+            except RequestError as e:
+                if e.code != 404:
+                    raise
+                del self.remote[path]
+                continue
+            self.remote[path] = entry._replace(size=size,
+                                               last_modified=modified)
+
+    def hash_local(self, path):
+        return hash_file(self.local_path(path))
+
+    def hash_remote(self, path):
+        '''Returns the sha1 hash of a remote file's content, which is read
+        from the server but not saved; the API doesn't give checksums.'''
+        downloader = FileDownloadAPI(self.access_token, self.remote[path].url)
+        digest = hashlib.sha1()
+        try:
+            while True:
+                chunk = downloader.response.read(FileDownloadAPI.CHUNK_SIZE)
+                if not chunk:
+                    break
+                throttle('download', len(chunk))
+                digest.update(chunk)
+        finally:
+            downloader.response.close()
+        return digest.hexdigest()
+
+    def carry_out(self, plan):
+        '''Transfers what plan says and returns the TransferBatch.'''
+        for path in plan.forget:
+            self.state.delete(path)
+        for path in plan.adopt:
+            self.record(path, self.remote[path].url,
+                        self.remote[path].size, self.remote[path].last_modified)
+
+        batch = TransferBatch(self.concurrency)
+        sizes = dict((path, os.path.getsize(self.local_path(path)))
+                     for path in plan.uploads)
+        new_files = {}                  # path -> URL of the remote folder
+        self.changed_folders = set()
+        for path in plan.uploads:
+            # the folders are created before the uploads start
+            folder_url = self.get_folder(path.rpartition('/')[0])
+            self.changed_folders.add(folder_url)
+            if path not in self.remote:
+                new_files[path] = folder_url
+        # the remote files are created a little ahead of their uploads, in
+        # the order the batch runs them
+        file_links = Lookahead(lambda path: self.create_file(path,
+                                                    new_files[path]),
+                               sorted(new_files, key=sizes.get),
+                               self.concurrency)
+        for path in plan.uploads:
+            # the smaller files first
+            batch.add(path, self.upload, path, file_links,
+                      priority=sizes[path])
+        for path in plan.downloads:
+            batch.add(path, self.download, path,
+                      priority=self.remote[path].size or 0)
+        try:
+            batch.run()
+        finally:
+            # after a failure or Ctrl+C, some files may be created but empty
+            for path, file_data_url in sorted(file_links.close().items()):
+                logger.warning("{0} was created remotely, at {1}, but not "
+                               "uploaded".format(path, file_data_url))
+        return batch
+
+    def get_folder(self, folder_path):
+        '''Returns the URL of the remote folder folder_path, creating it and
+        its parents if they don't exist.'''
+        if folder_path == '':
+            return self.collection_url
+        if folder_path not in self.folders:
+            parent, _, name = folder_path.rpartition('/')
+            parent_url = self.get_folder(parent)
+            creator = FolderCreation(self.access_token, parent_url)
+            self.folders[folder_path] = creator.create_folder(name)
+            self.changed_folders.add(parent_url)
+        return self.folders[folder_path]
+
+    def create_file(self, path, folder_url):
+        '''Creates the remote file of path in folder_url, returns its
+        fileData URL.'''
+        media_type = (mimetypes.guess_type(path)[0] or
+                      'application/octet-stream')
+        creator = FileCreation(self.access_token, folder_url)
+        return creator.create_file(path.rpartition('/')[2], media_type)
+
+    def upload(self, path, file_links):
+        '''Uploads a new or changed local file; a TransferBatch job.
+        file_links is the transfers.Lookahead creating the new remote
+        files.'''
+        local_path = self.local_path(path)
+        size, mtime = os.path.getsize(local_path), os.path.getmtime(local_path)
+
+        if path in self.remote:
+            # the existing file gets new content
+            file_data_url = self.remote[path].url
+        else:
+            file_data_url = file_links.take(path)
+        # hashed while it is sent, not read twice
+        uploader = FileUploadAPI(self.access_token)
+        uploader.upload_file(file_data_url, local_path, checksum='sha1')
+        content_hash = uploader.checksum
+
+        remote_size, remote_modified = get_remote_metadata(self.access_token,
+                                                           file_data_url)
+        self.state.put(path, size, mtime, content_hash, file_data_url,
+                       remote_size, remote_modified)
+        # what the listing would say now
+        self.remote[path] = Entry('file', path.rpartition('/')[2],
+                                  file_data_url[:-len('/data')], file_data_url,
+                                  remote_size, remote_modified)
+        return size
+
+    def download(self, path):
+        '''Downloads a new or changed remote file; a TransferBatch job.'''
+        entry = self.remote[path]
+        local_path = self.local_path(path)
+        directory = os.path.dirname(local_path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # another transfer thread created it
+                if not os.path.isdir(directory):
+                    raise
+        downloader = FileDownloadAPI(self.access_token, entry.url)
+        content_hash = downloader.download(local_path, checksum='sha1')
+        self.record(path, entry.url, entry.size, entry.last_modified,
+                    content_hash)
+        return entry.size
+
+    def record(self, path, remote_url, remote_size, remote_modified,
+               content_hash=None):
+        '''Records that path is the same locally and remotely.'''
+        local_path = self.local_path(path)
+        self.state.put(path, os.path.getsize(local_path),
+                       os.path.getmtime(local_path),
+                       content_hash or hash_file(local_path), remote_url,
+                       remote_size, remote_modified)
+
+
+class UploadIndex(SyncState):
+    '''The same records as SyncState, for the files uploaded with the
+    "upload" command, keyed by absolute path: what was uploaded, where,
+    and what the remote file looked like right after the upload.'''
+
+    DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.sugarsync',
+                                'uploads.db')
+
+    def __init__(self, path=None):
+        path = os.path.expanduser(path or self.DEFAULT_PATH)
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        super(UploadIndex, self).__init__(path)
+
+    def get(self, path):
+        with self.lock:
+            return self.connection.execute('SELECT * FROM files WHERE '
+                                           'path = ?', (path,)).fetchone()
+
+    def local_hash(self, path):
+        '''Returns the hash of a local file, from the index if the file's
+        size and mtime didn't change since it was recorded.'''
+        stat = os.stat(path)
+        row = self.get(os.path.abspath(path))
+        if (row is not None and row['size'] == stat.st_size and
+                row['mtime'] == stat.st_mtime):
+            return row['hash']
+        return hash_file(path)
+
+
+def plan_uploads(paths, remote, index):
+    '''Splits the local paths to upload into ([(path, fileData URL or None)]
+    to upload, [path] unchanged). remote is {displayName: listing.Entry}
+    of the target folder.
+
+    A file is unchanged if the remote file it was last uploaded to is
+    still as it was right after that upload (same fileData URL, size and
+    lastModified) and the local content has the same hash. A changed file
+    whose remote copy is intact is uploaded again to the same remote file
+    instead of creating a new one.'''
+
+    uploads, unchanged = [], []
+    for path in paths:
+        row = index.get(os.path.abspath(path))
+        entry = remote.get(path)
+        if (row is not None and entry is not None and
+                entry.url == row['remote_url'] and
+                entry.size == row['remote_size'] and
+                entry.last_modified == row['remote_modified']):
+            if index.local_hash(path) == row['hash']:
+                unchanged.append(path)
+            else:
+                uploads.append((path, entry.url))
+        else:
+            uploads.append((path, None))
+    return uploads, unchanged
+
+
+def find_duplicates(paths, hash_of=hash_file):
+    '''Returns the groups of paths with the same content. Only the files
+    sharing their size with another file are hashed.'''
+
+    by_size = {}
+    for path in paths:
+        by_size.setdefault(os.path.getsize(path), []).append(path)
+    by_hash = {}
+    for same_size in by_size.values():
+        if len(same_size) > 1:
+            for path in same_size:
+                by_hash.setdefault(hash_of(path), []).append(path)
+    return sorted(group for group in by_hash.values() if len(group) > 1)
+
+
+if __name__ == '__main__':
+    print("This file should not be used directly, it is used by sugarsync.py.")
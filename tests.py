@@ -4,10 +4,1099 @@
 """Runs tests using the unittest stdlib."""
 
 import unittest
+import os
+import sys
+import stat
+import signal
+import socket
+import hashlib
+import shutil
+import tempfile
+import time
+import StringIO
+import threading
+import subprocess
 
-class TestAuth(unittest.TestCase):
+import auth
+import utils
+import transfers
+import listing
+import metacache
+import contentcache
+import sync
+import watch
+import sugarsync
+import client
+import mockserver
+import metrics
+
+
+class MockServerTestCase(unittest.TestCase):
+    '''Runs the test against a mockserver.MockSugarSync.'''
+
+    def setUp(self):
+        self.server = mockserver.MockSugarSync()
+        self.server.start()
+        self.urls = auth.RefreshToken.URL, auth.AccessToken.URL
+        auth.RefreshToken.URL = self.server.url + '/app-authorization'
+        auth.AccessToken.URL = self.server.url + '/authorization'
+        # no waiting between retries
+        utils.configure_session(policy=utils.RequestPolicy(backoff=0))
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        auth.RefreshToken.URL, auth.AccessToken.URL = self.urls
+        utils.configure_session(policy=utils.RequestPolicy())
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def get_access_token(self, store=None):
+        return auth.get_access_token('user@example.com', 'password', 'app',
+                                     'key', 'private key', store)
+
+class TestAuth(MockServerTestCase):
     def test_auth(self):
-        self.assertFalse(True)
+        access = self.get_access_token()
+        self.assertTrue(self.server.is_authorized(access.token))
+        self.assertTrue(access.expires > time.time() + 3000)
+        user_url = utils.XmlUtils(access.response_body).get_node_values(
+                                                                './user')
+        user = utils.SugarSyncHTTPGetUtil(access.token, user_url)
+        self.assertEqual(user.xml_info.get_node_values('./username'),
+                         'mock@example.com')
+
+    def test_tokens_are_reused_from_the_store(self):
+        store = auth.TokenStore(os.path.join(self.directory, 'tokens.json'))
+        token = self.get_access_token(store).token
+        requests = self.server.requests
+        self.assertEqual(self.get_access_token(store).token, token)
+        self.assertEqual(self.server.requests, requests)
+
+    def test_token_renewal_during_the_circuit_trial(self):
+        breaker = utils.CircuitBreaker(threshold=2, reset_timeout=0.2)
+        utils.configure_session(policy=utils.RequestPolicy(
+                                    retries=0, backoff=0, breaker=breaker))
+        provider = auth.TokenProvider('user@example.com', 'password', 'app',
+                                      'key', 'private key')
+        user_url = self.server.url + '/user'
+        utils.set_token_provider(provider)
+        try:
+            utils.SugarSyncHTTPGetUtil(provider.get_token(), user_url)
+            self.server.fail_next(2, 500)
+            for attempt in range(2):
+                self.assertRaises(utils.RequestError,
+                                  utils.SugarSyncHTTPGetUtil, 'token', user_url)
+            self.assertRaises(utils.CircuitOpenError,
+                              utils.SugarSyncHTTPGetUtil, 'token', user_url)
+            time.sleep(0.25)
+            # the trial request needs a new token first
+            provider.access.expires = time.time() + 60
+            utils.SugarSyncHTTPGetUtil('token', user_url)
+            self.assertEqual(breaker.trial, None)
+            self.assertEqual(breaker.opened, None)
+        finally:
+            utils.set_token_provider(None)
+
+    def test_rejected_token_is_renewed_once(self):
+        # no retries: only the replay after the 401 can succeed
+        utils.configure_session(policy=utils.RequestPolicy(retries=0,
+                                                           backoff=0))
+        provider = auth.TokenProvider('user@example.com', 'password', 'app',
+                                      'key', 'private key')
+        user_url = self.server.url + '/user'
+        utils.set_token_provider(provider)
+        try:
+            token = provider.get_token()
+            self.server.fail_next(1, 401)
+            user = utils.SugarSyncHTTPGetUtil(token, user_url)
+            self.assertEqual(user.xml_info.get_node_values('./username'),
+                             'mock@example.com')
+            self.assertNotEqual(provider.get_token(), token)
+            self.assertTrue(self.server.is_authorized(provider.get_token()))
+        finally:
+            utils.set_token_provider(None)
+
+    def test_rejected_credentials(self):
+        self.server.fail_next(1, 401)
+        self.assertRaises(auth.AuthorizationError, self.get_access_token)
+
+class TestTransfersWithMockServer(MockServerTestCase):
+    def test_upload_list_and_download(self):
+        token = self.get_access_token().token
+        folder_url = '{0}/folder/{1}'.format(self.server.url, self.server.root)
+        local_path = os.path.join(self.directory, 'a.bin')
+        with open(local_path, 'wb') as stream:
+            stream.write(os.urandom(100000))
+        file_data_url = utils.FileCreation(token, folder_url).create_file(
+                                                'a.bin', 'application/octet-stream')
+        # the first attempt of the upload fails, it is sent again
+        self.server.fail_next(1, 503)
+        uploader = utils.FileUploadAPI(token)
+        uploader.upload_file(file_data_url, local_path, checksum='sha1')
+        self.assertEqual(uploader.progress(), (100000, 100000))
+        self.assertEqual(uploader.checksum, utils.hash_file(local_path))
+
+        entries = list(listing.iter_collection_contents(
+                                    token, folder_url + '/contents'))
+        self.assertEqual([(entry.name, entry.size) for entry in entries],
+                         [('a.bin', 100000)])
+        copy = os.path.join(self.directory, 'copy.bin')
+        downloader = utils.FileDownloadAPI(token, entries[0].url)
+        downloader.download(copy)
+        self.assertEqual(downloader.progress(), (100000, 100000))
+        self.assertEqual(utils.hash_file(copy), utils.hash_file(local_path))
+
+    def test_segmented_download(self):
+        token = self.get_access_token().token
+        data = os.urandom(100000)
+        url = '{0}/file/{1}/data'.format(self.server.url,
+                                         self.server.add_file('a.bin', data))
+        downloader = utils.SegmentedDownloadAPI(token, url, concurrency=3,
+                                                segment_size=16384)
+        # make_request gives up at once, the ranges are requested again
+        utils.configure_session(policy=utils.RequestPolicy(retries=0,
+                                                           backoff=0))
+        self.server.fail_next(2, 503)
+        requests = self.server.requests
+        copy = os.path.join(self.directory, 'copy.bin')
+        downloader.download(copy)
+        with open(copy, 'rb') as stream:
+            self.assertEqual(stream.read(), data)
+        self.assertEqual(downloader.progress(), (100000, 100000))
+        # the 6 ranges after the first one, and the 2 failed attempts
+        self.assertEqual(self.server.requests - requests, 8)
+        self.assertFalse(os.path.exists(copy + '.part'))
+
+    def test_segmented_download_of_unknown_size(self):
+        token = self.get_access_token().token
+        data = os.urandom(50000)
+        url = '{0}/file/{1}/data'.format(self.server.url,
+                                         self.server.add_file('a.bin', data))
+        self.server.hide_size = True
+        downloader = utils.SegmentedDownloadAPI(token, url,
+                                                segment_size=16384)
+        copy = os.path.join(self.directory, 'copy.bin')
+        downloader.download(copy)
+        # not just the first range
+        with open(copy, 'rb') as stream:
+            self.assertEqual(stream.read(), data)
+
+    def test_remote_file_reads_blocks(self):
+        token = self.get_access_token().token
+        data = os.urandom(100000)
+        url = '{0}/file/{1}/data'.format(self.server.url,
+                                         self.server.add_file('a.bin', data))
+        requests = self.server.requests
+        remote = utils.RemoteFile(token, url, block_size=10000, read_ahead=2)
+        self.assertEqual(remote.size, 100000)
+        remote.seek(-10, os.SEEK_END)
+        self.assertEqual(remote.read(), data[-10:])
+        self.assertEqual(remote.tell(), 100000)
+        self.assertEqual(remote.read(), '')
+        remote.seek(0)
+        self.assertEqual(remote.read(25000), data[:25000])
+        # block 0 (by __init__), block 9, then 1-3 read ahead in one request
+        self.assertEqual(self.server.requests - requests, 3)
+        self.assertEqual(remote.read(), data[25000:])
+        self.assertEqual(remote.received, 100000)
+
+    def test_errors_raise(self):
+        token = self.get_access_token().token
+        self.assertRaises(utils.RequestError, utils.SugarSyncHTTPGetUtil,
+                          token, self.server.url + '/file/404')
+        self.server.fail_next(10, 500)
+        self.assertRaises(utils.RequestError, utils.SugarSyncHTTPGetUtil,
+                          token, self.server.url + '/user')
+
+
+class TestMetrics(MockServerTestCase):
+    def setUp(self):
+        MockServerTestCase.setUp(self)
+        # fresh measures, the module's METRICS is shared by all the tests
+        self.metrics = metrics.Metrics()
+        self.metrics.tracing = True
+        self.saved = metrics.METRICS
+        metrics.METRICS = utils.METRICS = self.metrics
+
+    def tearDown(self):
+        metrics.METRICS = utils.METRICS = self.saved
+        MockServerTestCase.tearDown(self)
+
+    def test_endpoint_of(self):
+        self.assertEqual(metrics.endpoint_of(
+                    'https://api.sugarsync.com/file/:sc:1:2/data?x=1'),
+                    '/file/{id}/data')
+        self.assertEqual(metrics.endpoint_of('https://api.sugarsync.com/user'),
+                         '/user')
+
+    def test_requests_are_measured(self):
+        token = self.get_access_token().token
+        file_id = self.server.add_file('a.txt', 'x' * 1000)
+        self.server.fail_next(1, 503)
+        path = os.path.join(self.directory, 'a.txt')
+        utils.FileDownloadAPI(token, '{0}/file/{1}/data'.format(
+                                    self.server.url, file_id)).download(path)
+
+        summary = self.metrics.summary()
+        data = [item for item in summary['endpoints']
+                if item['endpoint'] == '/file/{id}/data'][0]
+        self.assertEqual((data['method'], data['count'], data['retries']),
+                         ('GET', 1, 1))
+        self.assertEqual(data['bytes_received'], 1000)
+        self.assertEqual(data['statuses'], {'200': 1})
+        self.assertTrue(summary['connections']['count'] >= 1)
+        text = self.metrics.to_prometheus()
+        self.assertTrue('sugarsync_requests_total{endpoint="/file/{id}/data",'
+                        'method="GET",status="200"} 1' in text)
+        names = [event['name'] for event
+                 in self.metrics.to_trace()['traceEvents']]
+        self.assertTrue('download' in names)
+        self.assertTrue('GET /file/{id}/data' in names)
+
+    def test_connection_tries_every_address(self):
+        port = self.server.httpd.server_address[1]
+        getaddrinfo = socket.getaddrinfo
+        def resolve(host, *args):
+            if host == 'sugarsync.test':
+                # an IPv6 address first, on which nothing listens
+                return ([(socket.AF_INET6, socket.SOCK_STREAM, 6, '',
+                          ('::1', port, 0, 0))] +
+                        getaddrinfo('127.0.0.1', *args))
+            return getaddrinfo(host, *args)
+        socket.getaddrinfo = resolve
+        try:
+            http = metrics.TimedHTTPConnection('sugarsync.test', port)
+            http.request('GET', '/user')
+            response = http.getresponse()
+            response.read()
+            http.close()
+            self.assertEqual(response.status, 401)
+        finally:
+            socket.getaddrinfo = getaddrinfo
+        self.assertEqual(self.metrics.connections['count'], 1)
+
+
+class TestStartup(unittest.TestCase):
+    def test_version_loads_nothing_heavy(self):
+        directory = tempfile.mkdtemp()
+        try:
+            code = ("import sys, sugarsync\n"
+                    "try:\n"
+                    "    sugarsync.main(['--version'])\n"
+                    "except SystemExit:\n"
+                    "    print(sorted(name for name in ('requests', 'utils')\n"
+                    "                 if name in sys.modules))\n")
+            env = dict(os.environ, PYTHONPATH=os.path.dirname(
+                                            os.path.abspath(__file__)))
+            output = subprocess.check_output([sys.executable, '-c', code],
+                                             cwd=directory, env=env)
+            self.assertEqual(output.split(), ['SugarSync', 'for', 'Linux',
+                                              '0.1', '[]'])
+            # no log file either
+            self.assertEqual(os.listdir(directory), [])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_main_twice_in_one_process(self):
+        directory = tempfile.mkdtemp()
+        try:
+            code = ("import os, sys, auth, mockserver, sugarsync\n"
+                    "server = mockserver.MockSugarSync()\n"
+                    "server.start()\n"
+                    "auth.RefreshToken.URL = server.url + '/app-authorization'\n"
+                    "auth.AccessToken.URL = server.url + '/authorization'\n"
+                    "options = ['-u', 'u', '-p', 'p', '-a', 'a', '--accesskey',\n"
+                    "           'k', '--privatekey', 'pk', '--no-token-cache',\n"
+                    "           '--no-metadata-cache']\n"
+                    "sugarsync.main(options + ['--content-cache', 'cache',\n"
+                    "                          '--metrics', 'metrics.json',\n"
+                    "                          'download', 'a.txt'])\n"
+                    "print(os.path.exists('metrics.json'))\n"
+                    "sugarsync.main(options + ['download', 'a.txt'])\n"
+                    "print(sugarsync.content_cache)\n"
+                    "server.stop()\n")
+            env = dict(os.environ, PYTHONPATH=os.path.dirname(
+                                            os.path.abspath(__file__)))
+            process = subprocess.Popen([sys.executable, '-c', code],
+                                       cwd=directory, env=env,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+            output, log = process.communicate()
+            # the measures are written, and the caches closed, when main()
+            # ends, not at exit
+            self.assertEqual(output.split(), ['True', 'None'])
+            # once per call, the console handler isn't added twice
+            self.assertEqual(log.count('sugarsync.py end'), 2)
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestTokenStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache', 'tokens.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_tokens_survive_between_stores(self):
+        auth.TokenStore(self.path).put('refresh:x', 'token', '<body/>')
+        entry = auth.TokenStore(self.path).get('refresh:x')
+        self.assertEqual(entry['token'], 'token')
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+
+    def test_token_near_expiry_is_not_used(self):
+        store = auth.TokenStore(self.path)
+        store.put('access:x', 'token', '', time.time() + 60)
+        self.assertEqual(store.get('access:x'), None)
+
+    def test_expiration_is_read_from_response(self):
+        body = ('<authorization><expiration>2010-06-07T14:19:37.000-07:00'
+                '</expiration></authorization>')
+        expires = auth.parse_expiration(body)
+        self.assertEqual(expires, 1275945577)
+
+
+class TestTokenProvider(unittest.TestCase):
+    class Provider(auth.TokenProvider):
+        # counts the renewals instead of making requests
+        renewals = 0
+        def renew(self):
+            time.sleep(0.01)
+            self.renewals += 1
+            self.access = auth.AccessToken.__new__(auth.AccessToken)
+            self.access.token = 'token{0}'.format(self.renewals)
+            self.access.expires = time.time() + 3600
+
+    def test_a_rejected_token_is_renewed_once(self):
+        provider = self.Provider('u', 'p', 'a', 'k', 'pk')
+        token = provider.get_token()
+        def rejected():
+            provider.invalidate(token)
+            tokens.append(provider.get_token())
+        tokens = []
+        threads = [threading.Thread(target=rejected) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(provider.renewals, 2)
+        self.assertEqual(set(tokens), set(['token2']))
+
+    def test_token_is_renewed_before_it_expires(self):
+        provider = self.Provider('u', 'p', 'a', 'k', 'pk')
+        provider.get_token()
+        provider.access.expires = time.time() + 60
+        self.assertEqual(provider.get_token(), 'token2')
+
+class TestTransferJournal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_interrupted_transfer_is_pending(self):
+        journal = transfers.TransferJournal('download', 'file.txt',
+                                            self.directory)
+        journal.start('https://example.com/file/1/data', 2000)
+        journal.update(1000)
+        pending = transfers.TransferJournal.pending(self.directory)
+        self.assertEqual(len(pending), 1)
+        self.assertEqual(pending[0].offset, 1000)
+        self.assertEqual(pending[0].size, 2000)
+
+    def test_finished_transfer_is_forgotten(self):
+        journal = transfers.TransferJournal('upload', 'file.txt',
+                                            self.directory)
+        journal.start('https://example.com/file/1/data', 2000)
+        journal.finish()
+        self.assertEqual(transfers.TransferJournal.pending(self.directory), [])
+
+    def test_resume_without_files_finds_the_interrupted_ones(self):
+        cwd = os.getcwd()
+        os.chdir(self.directory)
+        try:
+            for direction, path in [('download', 'a.txt'),
+                                    ('upload', 'b.txt'),
+                                    ('download', os.path.join(cwd, 'c.txt'))]:
+                journal = transfers.TransferJournal(direction, path,
+                                                    self.directory)
+                journal.start('https://example.com/file/1/data', 2000)
+            # c.txt is outside the current directory
+            self.assertEqual(sugarsync.get_interrupted_files(
+                                            'download', self.directory),
+                             ['a.txt'])
+            self.assertEqual(sugarsync.get_interrupted_files(
+                                            'upload', self.directory),
+                             ['b.txt'])
+        finally:
+            os.chdir(cwd)
+
+
+class TestFolderIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = listing.FolderIndex()
+        self.index.add('notes.txt', 'url/1')
+        self.index.add('Documents/report.txt', 'url/2')
+        self.index.add('photo.jpg', 'url/3')
+
+    def test_exact_and_basename_match(self):
+        self.assertEqual(self.index.lookup('Documents/report.txt'),
+                         [('report.txt', 'url/2')])
+        self.assertEqual(self.index.lookup('report.txt'),
+                         [('report.txt', 'url/2')])
+
+    def test_glob_match(self):
+        self.assertEqual(self.index.lookup('*.txt'),
+                         [('notes.txt', 'url/1'), ('report.txt', 'url/2')])
+        self.assertEqual(self.index.lookup('missing.txt'), [])
+
+class TestListingWithMockServer(MockServerTestCase):
+    def setUp(self):
+        MockServerTestCase.setUp(self)
+        self.token = self.get_access_token().token
+        self.contents_url = '{0}/folder/{1}/contents'.format(
+                                        self.server.url, self.server.root)
+
+    def test_contents_are_paged(self):
+        names = ['{0}.txt'.format(i) for i in range(5)]
+        for name in names:
+            self.server.add_file(name)
+        requests = self.server.requests
+        entries = list(listing.iter_collection_contents(
+                                self.token, self.contents_url, page_size=2))
+        self.assertEqual([entry.name for entry in entries], names)
+        # hasMore was true twice
+        self.assertEqual(self.server.requests - requests, 3)
+
+    def test_walk_stops_at_max_depth(self):
+        a = self.server.add_folder('a')
+        b = self.server.add_folder('b', a)
+        self.server.add_file('deep.txt', parent=b)
+        self.server.add_file('top.txt')
+        walk = listing.walk_collection(self.token, self.contents_url)
+        self.assertEqual(sorted(path for path, entry in walk),
+                         ['a', 'a/b', 'a/b/deep.txt', 'top.txt'])
+        walk = listing.walk_collection(self.token, self.contents_url,
+                                       max_depth=2)
+        self.assertEqual(sorted(path for path, entry in walk),
+                         ['a', 'a/b', 'top.txt'])
+
+    def test_walk_raises_the_error_of_a_worker(self):
+        self.server.add_folder('a')
+        walk = listing.walk_collection(self.token, self.contents_url)
+        self.assertEqual(next(walk)[0], 'a')
+        # the listing of a, requested next, fails
+        self.server.fail_next(1, 404)
+        self.assertRaises(utils.RequestError, list, walk)
+
+class TestContentsPage(unittest.TestCase):
+    def test_entries_and_paging_attributes(self):
+        page = listing.ContentsPage(StringIO.StringIO(
+            '<collectionContents start="0" hasMore="true" end="1">'
+            '<collection type="folder"><displayName>Photos</displayName>'
+            '<contents>url/folder/contents</contents></collection>'
+            '<file><displayName>notes.txt</displayName><size>12</size>'
+            '<fileData>url/file/data</fileData></file>'
+            '</collectionContents>'))
+        entries = list(page)
+        self.assertEqual([(e.kind, e.name, e.url) for e in entries],
+                         [('folder', 'Photos', 'url/folder/contents'),
+                          ('file', 'notes.txt', 'url/file/data')])
+        self.assertEqual(entries[1].size, 12)
+        self.assertTrue(page.has_more)
+        self.assertEqual(page.end, 1)
+
+class TestMetadataCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = metacache.MetadataCache(
+            os.path.join(self.directory, 'metadata.db'), ttl=60)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.directory)
+
+    def test_entry_is_fresh_within_ttl(self):
+        self.cache.store('https://x/folder/1', '<collection/>', '"v1"')
+        entry = self.cache.lookup('https://x/folder/1')
+        self.assertEqual(entry['body'], '<collection/>')
+        self.assertEqual(entry['etag'], '"v1"')
+        self.assertTrue(self.cache.is_fresh(entry))
+
+    def test_invalidate_drops_the_folder_and_its_contents(self):
+        for url in ['https://x/folder/1', 'https://x/folder/1/contents',
+                    'https://x/folder/10']:
+            self.cache.store(url, '<x/>')
+        self.cache.invalidate('https://x/folder/1')
+        self.assertEqual(self.cache.lookup('https://x/folder/1/contents'), None)
+        self.assertNotEqual(self.cache.lookup('https://x/folder/10'), None)
+
+class TestContentCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = contentcache.ContentCache(
+            os.path.join(self.directory, 'content'), max_bytes=250)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.directory)
+
+    def add(self, url, version, data):
+        path = os.path.join(self.directory, 'downloaded')
+        with open(path, 'wb') as stream:
+            stream.write(data)
+        self.cache.put(url, version, path)
+
+    def get(self, url, version):
+        path = os.path.join(self.directory, 'copy')
+        if self.cache.get(url, version, path) is None:
+            return None
+        with open(path, 'rb') as stream:
+            return stream.read()
+
+    def test_hit_only_for_the_same_version(self):
+        self.add('url/1', '100/t1', 'a' * 100)
+        self.assertEqual(self.get('url/1', '100/t1'), 'a' * 100)
+        self.assertEqual(self.get('url/1', '100/t2'), None)
+
+    def test_least_recently_used_evicted(self):
+        self.add('url/1', 'v', '1' * 100)
+        time.sleep(0.01)
+        self.add('url/2', 'v', '2' * 100)
+        time.sleep(0.01)
+        self.get('url/1', 'v')              # url/2 is now the oldest
+        time.sleep(0.01)
+        self.add('url/3', 'v', '3' * 100)
+        self.assertEqual(self.cache.lookup('url/2', 'v'), None)
+        self.assertNotEqual(self.cache.lookup('url/1', 'v'), None)
+        self.assertEqual(self.cache.size(), 200)
+
+    def test_damaged_copy_dropped(self):
+        self.add('url/1', 'v', 'a' * 100)
+        name = self.cache.lookup('url/1', 'v')['name']
+        with open(self.cache.blob_path(name), 'r+b') as stream:
+            stream.write('b')
+        self.assertEqual(self.get('url/1', 'v'), None)
+        self.assertEqual(self.cache.lookup('url/1', 'v'), None)
+
+class TestMetadataCacheWithMockServer(MockServerTestCase):
+    def test_unchanged_listing_is_revalidated(self):
+        token = self.get_access_token().token
+        self.server.add_file('a.txt', 'a')
+        cache = metacache.MetadataCache(
+                            os.path.join(self.directory, 'metadata.db'))
+        url = '{0}/folder/{1}/contents'.format(self.server.url,
+                                               self.server.root)
+        try:
+            first = metacache.CachedHTTPGetUtil(token, url, cache)
+            self.assertFalse(first.from_cache)
+            # ttl=0: asked again, answered with 304 and no body
+            second = metacache.CachedHTTPGetUtil(token, url, cache)
+            self.assertTrue(second.from_cache)
+            self.assertEqual(second.response.code, 304)
+            self.assertEqual(second.info, first.info)
+            self.server.add_file('b.txt', 'b')
+            third = metacache.CachedHTTPGetUtil(token, url, cache)
+            self.assertFalse(third.from_cache)
+            self.assertTrue('b.txt' in third.info)
+        finally:
+            cache.close()
+
+    def test_listing_is_cached_while_it_is_parsed(self):
+        token = self.get_access_token().token
+        self.server.add_file('a.txt', 'a')
+        cache = metacache.MetadataCache(
+                            os.path.join(self.directory, 'metadata.db'))
+        url = '{0}/folder/{1}/contents'.format(self.server.url,
+                                               self.server.root)
+        try:
+            first = list(listing.iter_collection_contents(token, url,
+                                                          cache=cache))
+            page_url = url + '?start=0&max=500'
+            self.assertTrue('a.txt' in cache.lookup(page_url)['body'])
+            # revalidated: the same entries, from the cached body
+            second = metacache.CachedHTTPGetUtil(token, page_url, cache,
+                                                 parse=False)
+            self.assertTrue(second.from_cache)
+            self.assertEqual(list(listing.ContentsPage(second.stream)), first)
+        finally:
+            cache.close()
+
+    def test_sync_reports_the_folders_it_changed(self):
+        token = self.get_access_token().token
+        root_url = '{0}/folder/{1}'.format(self.server.url, self.server.root)
+        local = os.path.join(self.directory, 'local')
+        os.makedirs(os.path.join(local, 'docs'))
+        with open(os.path.join(local, 'docs', 'a.txt'), 'w') as stream:
+            stream.write('a')
+        engine = sync.SyncEngine(token, local, root_url,
+                                 root_url + '/contents', concurrency=2)
+        try:
+            engine.run()
+        finally:
+            engine.state.close()
+        # docs was created in the root, a.txt in docs
+        self.assertEqual(engine.changed_folders,
+                         set([root_url, engine.folders['docs']]))
+
+class TestSyncEngineWithMockServer(MockServerTestCase):
+    def setUp(self):
+        super(TestSyncEngineWithMockServer, self).setUp()
+        self.root_url = '{0}/folder/{1}'.format(self.server.url,
+                                                self.server.root)
+        self.local = os.path.join(self.directory, 'local')
+        os.makedirs(self.local)
+
+    def sync(self):
+        '''Runs a synchronization and returns its plan.'''
+        engine = sync.SyncEngine(self.get_access_token().token, self.local,
+                                 self.root_url, self.root_url + '/contents',
+                                 concurrency=2)
+        try:
+            plan, batch = engine.run()
+        finally:
+            engine.state.close()
+        self.assertEqual(batch.failed, [])
+        return plan
+
+    def remote_data(self, name):
+        return [entry['data'] for entry in self.server.files.values()
+                if entry['name'] == name]
+
+    def read(self, name):
+        with open(os.path.join(self.local, name), 'rb') as stream:
+            return stream.read()
+
+    def test_two_way_sync(self):
+        with open(os.path.join(self.local, 'up.txt'), 'wb') as stream:
+            stream.write('local content')
+        self.server.add_file('down.txt', 'remote content')
+        plan = self.sync()
+        self.assertEqual(plan.uploads, ['up.txt'])
+        self.assertEqual(plan.downloads, ['down.txt'])
+        self.assertEqual(self.remote_data('up.txt'), ['local content'])
+        self.assertEqual(self.read('down.txt'), 'remote content')
+        # both sides are the same now
+        plan = self.sync()
+        self.assertEqual(plan.uploads + plan.downloads + plan.conflicts, [])
+
+    def test_remote_change_is_downloaded(self):
+        file_id = self.server.add_file('a.txt', 'first')
+        self.sync()
+        self.assertEqual(self.read('a.txt'), 'first')
+        self.server.change_file(file_id, 'second version')
+        plan = self.sync()
+        self.assertEqual(plan.downloads, ['a.txt'])
+        self.assertEqual(plan.uploads + plan.conflicts, [])
+        self.assertEqual(self.read('a.txt'), 'second version')
+
+    def test_unsynced_files_are_adopted_only_if_the_same(self):
+        self.server.add_file('same.txt', 'content')
+        self.server.add_file('other.txt', 'remote')
+        for name, data in [('same.txt', 'content'), ('other.txt', 'local!')]:
+            with open(os.path.join(self.local, name), 'wb') as stream:
+                stream.write(data)
+        plan = self.sync()
+        self.assertEqual(plan.adopt, ['same.txt'])
+        # the same size, but not the same content
+        self.assertEqual(plan.conflicts, ['other.txt'])
+        self.assertEqual(self.read('other.txt'), 'local!')
+
+    def test_remote_change_between_watch_batches_is_a_conflict(self):
+        file_id = self.server.add_file('a.txt', 'first')
+        engine = sync.SyncEngine(self.get_access_token().token, self.local,
+                                 self.root_url, self.root_url + '/contents')
+        try:
+            engine.run()
+            self.server.change_file(file_id, 'remote edit')
+            with open(os.path.join(self.local, 'a.txt'), 'wb') as stream:
+                stream.write('local edit')
+            # no new listing, as between the batches of "watch"
+            plan, batch = engine.sync_paths(['a.txt'])
+        finally:
+            engine.state.close()
+        self.assertEqual(plan.conflicts, ['a.txt'])
+        self.assertEqual(plan.uploads, [])
+        self.assertEqual(self.remote_data('a.txt'), ['remote edit'])
+
+class TestPlanSync(unittest.TestCase):
+    def remote(self, size, modified):
+        return listing.Entry('file', 'x', 'ref', 'url', size, modified)
+
+    def state(self, size, mtime, remote_size, remote_modified):
+        return {'size': size, 'mtime': mtime, 'hash': 'h',
+                'remote_size': remote_size, 'remote_modified': remote_modified}
+
+    def test_new_files_go_both_ways(self):
+        plan = sync.plan_sync({'up.txt': (1, 1.0)},
+                              {'down.txt': self.remote(2, 't1')}, {})
+        self.assertEqual(plan.uploads, ['up.txt'])
+        self.assertEqual(plan.downloads, ['down.txt'])
+
+    def test_changed_on_both_sides_is_a_conflict(self):
+        plan = sync.plan_sync({'a.txt': (5, 2.0)},
+                              {'a.txt': self.remote(6, 't2')},
+                              {'a.txt': self.state(4, 1.0, 4, 't1')})
+        self.assertEqual(plan.conflicts, ['a.txt'])
+        self.assertEqual(plan.uploads + plan.downloads, [])
+
+    def test_touched_file_with_same_hash_is_not_uploaded(self):
+        plan = sync.plan_sync({'a.txt': (4, 2.0)},
+                              {'a.txt': self.remote(4, 't1')},
+                              {'a.txt': self.state(4, 1.0, 4, 't1')},
+                              hash_local=lambda path: 'h')
+        self.assertEqual(plan.uploads, [])
+
+    def test_unsynced_files_of_the_same_size_are_compared(self):
+        local, remote = {'a.txt': (4, 2.0)}, {'a.txt': self.remote(4, 't1')}
+        plan = sync.plan_sync(local, remote, {},
+                              hash_local=lambda path: 'h1',
+                              hash_remote=lambda path: 'h2')
+        self.assertEqual(plan.adopt, [])
+        self.assertEqual(plan.conflicts, ['a.txt'])
+        plan = sync.plan_sync(local, remote, {},
+                              hash_local=lambda path: 'h1',
+                              hash_remote=lambda path: 'h1')
+        self.assertEqual(plan.adopt, ['a.txt'])
+        self.assertEqual(plan.conflicts, [])
+
+class TestFindDuplicates(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_only_files_with_the_same_content_are_grouped(self):
+        paths = []
+        for name, content in [('a', 'same'), ('b', 'same'), ('c', 'diff'),
+                              ('d', 'longer')]:
+            paths.append(os.path.join(self.directory, name))
+            with open(paths[-1], 'wb') as stream:
+                stream.write(content)
+        hashed = []
+        def hash_of(path):
+            hashed.append(path)
+            return utils.hash_file(path)
+        self.assertEqual(sync.find_duplicates(paths, hash_of),
+                         [paths[:2]])
+        # "longer" has a size of its own, it isn't read
+        self.assertEqual(sorted(hashed), paths[:3])
+
+class TestPlanUploads(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        # the upload command is given paths relative to the current
+        # directory, and looks them up by name in Magic Briefcase
+        os.chdir(self.directory)
+        self.index = sync.UploadIndex(os.path.join(self.directory,
+                                                   'uploads.db'))
+        self.remote = {}
+        for name in ['same.txt', 'edited.txt', 'replaced.txt', 'copy.txt']:
+            with open(name, 'wb') as stream:
+                stream.write('content')
+            self.record(name, 'url/' + name)
+
+    def tearDown(self):
+        self.index.close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def record(self, name, url):
+        '''As the upload command does after uploading name to url.'''
+        stat = os.stat(name)
+        self.index.put(os.path.abspath(name), stat.st_size, stat.st_mtime,
+                       utils.hash_file(name), url, stat.st_size, 't1')
+        self.remote[name] = listing.Entry('file', name, url[:-5], url,
+                                          stat.st_size, 't1')
+
+    def test_unchanged_files_are_skipped(self):
+        with open('edited.txt', 'ab') as stream:
+            stream.write(' edited')
+        # changed remotely since it was uploaded
+        self.remote['replaced.txt'] = self.remote['replaced.txt']._replace(
+                                                        last_modified='t2')
+        with open('new.txt', 'wb') as stream:
+            stream.write('new')
+        uploads, unchanged = sync.plan_uploads(
+                ['same.txt', 'edited.txt', 'replaced.txt', 'new.txt'],
+                self.remote, self.index)
+        self.assertEqual(unchanged, ['same.txt'])
+        # the edited file gets new content in the same remote file
+        self.assertEqual(uploads, [('edited.txt', 'url/edited.txt'),
+                                   ('replaced.txt', None), ('new.txt', None)])
+
+    def test_recorded_hashes_find_duplicates(self):
+        # a recorded hash is trusted while the size and mtime match, the
+        # file isn't read again
+        stat = os.stat('copy.txt')
+        self.index.put(os.path.abspath('copy.txt'), stat.st_size,
+                       stat.st_mtime, 'recorded', 'url/copy.txt',
+                       stat.st_size, 't1')
+        self.assertEqual(self.index.local_hash('copy.txt'), 'recorded')
+        self.assertEqual(sync.find_duplicates(
+                            ['same.txt', 'edited.txt', 'copy.txt'],
+                            self.index.local_hash),
+                         [['same.txt', 'edited.txt']])
+
+class TestTransferScheduler(unittest.TestCase):
+    def test_lower_priority_numbers_run_first(self):
+        scheduler = transfers.TransferScheduler(concurrency=1)
+        started = threading.Event()
+        release = threading.Event()
+        def block():
+            started.set()
+            release.wait(10)
+        order = []
+        scheduler.submit(0, block)
+        started.wait(10)
+        # queued while the only worker is busy
+        for name, priority in [('bulk', 100), ('small', 1), ('bulk2', 100),
+                               ('interactive', 0)]:
+            scheduler.submit(priority, order.append, (name,))
+        release.set()
+        scheduler.close()
+        self.assertEqual(order, ['interactive', 'small', 'bulk', 'bulk2'])
+
+    def test_token_bucket_limits_the_rate(self):
+        bucket = utils.TokenBucket(rate=1000000, burst=100000)
+        started = time.time()
+        for i in range(4):
+            bucket.consume(100000)
+        # the burst is free, the rest takes 0.3 s at 1 MB/s
+        self.assertTrue(0.25 <= time.time() - started < 1.0)
+
+class TestRequestPolicy(unittest.TestCase):
+    def test_circuit_opens_after_consecutive_failures(self):
+        breaker = utils.CircuitBreaker(threshold=2, reset_timeout=60)
+        breaker.record_failure()
+        breaker.before_request()
+        breaker.record_failure()
+        self.assertRaises(utils.CircuitOpenError, breaker.before_request)
+        # after reset_timeout one trial request goes through
+        breaker.opened -= 60
+        breaker.before_request()
+        self.assertRaises(utils.CircuitOpenError, breaker.before_request)
+        breaker.record_success()
+        breaker.before_request()
+
+    def test_only_safe_retries(self):
+        policy = utils.RequestPolicy()
+        self.assertTrue(policy.should_retry('GET', 502))
+        self.assertFalse(policy.should_retry('GET', 404))
+        # the POST may have created the file already
+        self.assertFalse(policy.should_retry('POST', 502))
+        self.assertTrue(policy.should_retry('POST', 503))
+        timeout = utils.requests.exceptions.ReadTimeout()
+        self.assertTrue(policy.should_retry('PUT', error=timeout))
+        self.assertFalse(policy.should_retry('POST', error=timeout))
+
+    def test_backoff_and_retry_after(self):
+        policy = utils.RequestPolicy(backoff=1, max_delay=5)
+        for attempt in range(10):
+            self.assertTrue(0 <= policy.delay(attempt) <= min(5, 2 ** attempt))
+        self.assertEqual(policy.delay(0, retry_after=7.0), 7.0)
+        self.assertEqual(utils.parse_retry_after('120'), 120.0)
+        self.assertEqual(utils.parse_retry_after(
+                                'Wed, 21 Oct 2015 07:28:00 GMT'), 0.0)
+        self.assertEqual(utils.parse_retry_after('soon'), None)
+
+class TestPipeline(unittest.TestCase):
+    def test_upload_stream_reads_ahead(self):
+        data = os.urandom(100000)
+        stream = utils.PipelinedUploadStream(StringIO.StringIO(data),
+                                             len(data), 1000, 'sha1',
+                                             block_size=4096, depth=2)
+        stream.read()
+        # a retried request sends everything again
+        stream.rewind()
+        chunks = list(stream)
+        stream.stop()
+        self.assertEqual(''.join(chunks), data)
+        self.assertEqual(stream.digest.hexdigest(),
+                         hashlib.sha1(data).hexdigest())
+
+    def test_lookahead(self):
+        computed = []
+        def create(key):
+            computed.append(key)
+            if key == 'bad':
+                raise IOError("failed")
+            return key.upper()
+        lookahead = transfers.Lookahead(create, ['a', 'b', 'bad', 'c'],
+                                        ahead=2)
+        deadline = time.time() + 5
+        while len(computed) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.05)
+        # no more than ahead results wait to be taken
+        self.assertEqual(computed, ['a', 'b'])
+        self.assertEqual(lookahead.take('a'), 'A')
+        self.assertRaises(IOError, lookahead.take, 'bad')
+        # a key it wasn't given is computed by the caller
+        self.assertEqual(lookahead.take('d'), 'D')
+        self.assertEqual(lookahead.take('c'), 'C')
+        self.assertEqual(lookahead.take('b'), 'B')
+
+    def test_lookahead_close(self):
+        computed = []
+        def create(key):
+            computed.append(key)
+            return key.upper()
+        lookahead = transfers.Lookahead(create, ['a', 'b', 'c'])
+        deadline = time.time() + 5
+        while not computed and time.time() < deadline:
+            time.sleep(0.01)
+        # the thread waits for room for 'b', as after a failed batch
+        self.assertEqual(lookahead.close(), {'a': 'A'})
+        self.assertFalse(lookahead.thread.is_alive())
+        self.assertEqual(computed, ['a'])
+        self.assertRaises(ValueError, lookahead.take, 'b')
+
+
+class TestTransferBatch(unittest.TestCase):
+    def test_failures_dont_stop_the_batch(self):
+        def transfer(size):
+            if size is None:
+                raise IOError("connection lost")
+            return size
+        batch = transfers.TransferBatch(concurrency=2)
+        for name, size in [('a', 10), ('b', None), ('c', 20)]:
+            batch.add(name, transfer, size)
+        batch.run()
+        self.assertEqual(sorted(batch.completed), ['a', 'c'])
+        self.assertEqual([name for name, error in batch.failed], ['b'])
+        self.assertEqual(batch.transferred, 30)
+
+    def test_interrupt_cancels_the_queued_transfers(self):
+        ran = []
+        def transfer(name):
+            ran.append(name)
+            time.sleep(0.3)
+            return 1
+        batch = transfers.TransferBatch(concurrency=1)
+        for i in range(20):
+            batch.add(str(i), transfer, str(i))
+        # Ctrl+C while the first transfer runs
+        threading.Timer(0.1, os.kill, (os.getpid(), signal.SIGINT)).start()
+        started = time.time()
+        self.assertRaises(KeyboardInterrupt, batch.run)
+        self.assertTrue(time.time() - started < 2)
+        time.sleep(0.3)
+        self.assertEqual(ran, ['0'])
+
+class TestSugarSyncClient(unittest.TestCase):
+    def test_calls_are_queued_on_a_bounded_pool(self):
+        lock = threading.Lock()
+        running = [0, 0]                # now, at most
+        def call(number):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+            return number * 2
+        with client.SugarSyncClient(concurrency=3) as sugarsync:
+            results = [sugarsync.submit(call, n) for n in range(20)]
+            self.assertEqual(sugarsync.gather(results, timeout=10),
+                             range(0, 40, 2))
+        self.assertEqual(running[1], 3)
+
+    def test_failures_are_raised_by_gather(self):
+        with client.SugarSyncClient(concurrency=2) as sugarsync:
+            result = sugarsync.submit(int, 'not a number')
+            self.assertRaises(ValueError, sugarsync.gather, [result], 10)
+
+class TestDebouncer(unittest.TestCase):
+    def test_a_burst_becomes_one_batch(self):
+        debouncer = watch.Debouncer(window=2, max_delay=30)
+        self.assertEqual(debouncer.timeout(0), None)
+        debouncer.add('a', now=0)
+        debouncer.add('b', now=1)
+        debouncer.add('a', now=2.5)
+        # waits for 2 seconds without changes
+        self.assertFalse(debouncer.ready(now=4))
+        self.assertEqual(debouncer.timeout(now=4), 0.5)
+        self.assertTrue(debouncer.ready(now=4.5))
+        self.assertEqual(debouncer.take(), ['a', 'b'])
+        self.assertEqual(debouncer.timeout(5), None)
+
+    def test_endless_changes_are_flushed_after_max_delay(self):
+        debouncer = watch.Debouncer(window=2, max_delay=5)
+        for now in range(7):
+            debouncer.add('log', now=now)
+        self.assertTrue(debouncer.ready(now=6))
+
+class TestWatchDaemon(unittest.TestCase):
+    class Engine(object):
+        # records the syncs instead of making requests
+        def __init__(self, directory):
+            self.directory = directory
+            self.remote = {}
+            self.state = sync.SyncState(os.path.join(directory,
+                                                     sync.SyncState.FILENAME))
+            self.synced = []
+        def run(self):
+            self.synced.append('all')
+            return None, None
+        def sync_paths(self, paths):
+            self.synced.append(paths)
+            return None, None
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = self.Engine(self.directory)
+        self.refreshes = 0
+        self.daemon = watch.WatchDaemon(self.engine, self.refresh)
+
+    def tearDown(self):
+        self.daemon.inotify.close()
+        self.engine.state.close()
+        shutil.rmtree(self.directory)
+
+    def refresh(self):
+        self.refreshes += 1
+        if self.refreshes in (2, 3):
+            raise utils.RequestError('refresh failed', 503)
+        return 'token'
+
+    def test_failed_batch_is_retried_later(self):
+        self.daemon.flush()
+        self.assertEqual(self.engine.synced, ['all'])
+        path = os.path.join(self.directory, 'a.txt')
+        self.daemon.debouncer.add(path)
+        self.daemon.flush()             # the refresh fails
+        self.assertEqual(self.engine.synced, ['all'])
+        self.assertTrue(self.daemon.backing_off())
+        self.assertEqual(self.daemon.debouncer.take(), [path])
+        # a failed keepalive doesn't stop the daemon either
+        self.daemon.keep_alive()
+        self.daemon.debouncer.add(path)
+        self.daemon.flush()
+        self.assertEqual(self.engine.synced, ['all', ['a.txt']])
+        self.assertFalse(self.daemon.backing_off())
+
+class TestInotify(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.inotify = watch.Inotify()
+
+    def tearDown(self):
+        self.inotify.close()
+        shutil.rmtree(self.directory)
+
+    def test_written_files_are_reported(self):
+        os.mkdir(os.path.join(self.directory, 'sub'))
+        self.inotify.add_tree(self.directory)
+        path = os.path.join(self.directory, 'sub', 'a.txt')
+        with open(path, 'w') as stream:
+            stream.write('data')
+        events = self.inotify.read_events(timeout=1)
+        self.assertIn((path, watch.IN_CLOSE_WRITE), events)
         
 
 
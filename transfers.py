@@ -0,0 +1,352 @@
+#!/usr/bin/python
+
+"""Contains the classes that keep track of file transfers, so that
+interrupted transfers can be resumed instead of started all over again,
+and the classes that run many transfers at once."""
+
+import os
+import json
+import hashlib
+import time
+import logging
+import itertools
+import threading
+import Queue
+
+# sugarsync packages:
+from metrics import METRICS
+
+# same logger in all modules
+logger = logging.getLogger('sugarsync')
+
+
+class TransferJournal(object):
+    '''Records the progress of one transfer in a small JSON file:
+        {"direction": "download", "local_path": "/home/user/file.txt",
+         "remote_url": "https://api.sugarsync.com/file/.../data",
+         "size": 20000000000, "offset": 19000000000}
+    offset is the number of bytes known to be safely on disk (downloads).
+    The file is removed when the transfer completes, so any journal left
+    in the directory belongs to an interrupted transfer.'''
+
+    DEFAULT_DIRECTORY = os.path.join(os.path.expanduser('~'), '.sugarsync',
+                                     'journal')
+
+    def __init__(self, direction, local_path, directory=None):
+        '''direction is "download" or "upload".'''
+
+        self.directory = os.path.expanduser(directory or
+                                            self.DEFAULT_DIRECTORY)
+        self.direction = direction
+        self.local_path = os.path.abspath(local_path)
+        # one journal per local file and direction
+        name = hashlib.sha1(self.local_path.encode('utf-8')).hexdigest()
+        self.path = os.path.join(self.directory,
+                                 '{0}-{1}.json'.format(direction, name))
+        self.entry = self.load()
+
+    def load(self):
+        '''Returns the recorded transfer, or an empty dict if there is none.'''
+        try:
+            with open(self.path) as stream:
+                return json.load(stream)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def save(self):
+        '''Writes the journal to a temporary file which replaces the old
+        journal, so it is never left half written.'''
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0o700)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as stream:
+            json.dump(self.entry, stream)
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.rename(temp_path, self.path)
+
+    @property
+    def remote_url(self):
+        return self.entry.get('remote_url')
+
+    @property
+    def size(self):
+        return self.entry.get('size')
+
+    @property
+    def offset(self):
+        return self.entry.get('offset', 0)
+
+    def start(self, remote_url, size, offset=0, **details):
+        '''Records a new transfer; details are stored along, e.g. the mtime
+        of an uploaded file.'''
+        self.entry = {'direction': self.direction,
+                      'local_path': self.local_path,
+                      'remote_url': remote_url,
+                      'size': size,
+                      'offset': offset}
+        self.entry.update(details)
+        self.save()
+
+    def update(self, offset):
+        '''Records that the first offset bytes are complete.'''
+        self.entry['offset'] = offset
+        self.save()
+
+    def finish(self):
+        '''The transfer is complete, the journal is no longer needed.'''
+        self.entry = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    @classmethod
+    def pending(cls, directory=None):
+        '''Returns the journals of all the interrupted transfers.'''
+        directory = os.path.expanduser(directory or cls.DEFAULT_DIRECTORY)
+        if not os.path.isdir(directory):
+            return []
+        journals = []
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith('.json'):
+                continue
+            with open(os.path.join(directory, name)) as stream:
+                try:
+                    entry = json.load(stream)
+                except ValueError:
+                    continue
+            if entry:
+                journals.append(cls(entry['direction'], entry['local_path'],
+                                    directory))
+        return journals
+
+
+class TransferScheduler(object):
+    '''Runs transfers on concurrency worker threads, in the order of their
+    priority rather than in the order they were submitted: the lowest
+    priority number first, e.g. the smallest file, so that a few small or
+    interactive transfers don't wait behind a queue of bulk ones. Equal
+    priorities run in submission order.'''
+
+    def __init__(self, concurrency=4):
+        self.queue = Queue.PriorityQueue()
+        self.counter = itertools.count()      # breaks the ties, FIFO
+        self.workers = []
+        for i in range(concurrency):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, priority, function, args=(), callback=None):
+        '''Queues function(*args); callback, if given, gets its result.'''
+        self.queue.put((priority, next(self.counter), function, args,
+                        callback))
+
+    def work(self):
+        while True:
+            priority, number, function, args, callback = self.queue.get()
+            if function is None:
+                break
+            try:
+                result = function(*args)
+                if callback is not None:
+                    callback(result)
+            except Exception:
+                logger.exception("Scheduled transfer failed")
+
+    def close(self, cancel=False, timeout=None):
+        '''Stops the workers once the queued transfers are done; with
+        cancel=True, those not started yet are dropped instead. Waits at
+        most timeout seconds for the transfers running, if given: the
+        workers are daemon threads, they don't keep the process alive.'''
+        if cancel:
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+        for worker in self.workers:
+            self.queue.put((float('inf'), next(self.counter), None, (), None))
+        deadline = None if timeout is None else time.time() + timeout
+        for worker in self.workers:
+            worker.join(None if deadline is None
+                        else max(0.0, deadline - time.time()))
+
+
+class Lookahead(object):
+    '''Computes function(key) for each of keys, in order, on a thread of
+    its own, before the results are asked for: at most ahead results are
+    kept ready and not taken yet. In a batch of uploads, the POST that
+    creates the remote file of the next upload is made while the current
+    upload is still sending data.
+
+    take(key) returns the result, or raises the exception of the call. A
+    key that wasn't computed yet is computed by the thread that takes it,
+    so taking the keys in another order only changes what was ready.
+    close() stops the thread once the results are no longer needed, e.g.
+    when the batch ends, failed or not.'''
+
+    def __init__(self, function, keys, ahead=1):
+        self.function = function
+        self.keys = list(keys)
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(ahead)
+        self.results = {}               # key -> (result, exception)
+        self.claimed = {}               # key -> Event, set once computed
+        self.closed = False
+        self.thread = threading.Thread(target=self.work)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def work(self):
+        for key in self.keys:
+            self.slots.acquire()
+            with self.lock:
+                if self.closed:
+                    return
+                if key in self.claimed:
+                    # taken, and computed, already
+                    self.slots.release()
+                    continue
+                done = self.claimed[key] = threading.Event()
+            self.compute(key, done)
+
+    def compute(self, key, done):
+        try:
+            self.results[key] = (self.function(key), None)
+        except Exception as e:
+            logger.debug("%s failed", key, exc_info=True)
+            self.results[key] = (None, e)
+        done.set()
+
+    def take(self, key):
+        with self.lock:
+            if self.closed:
+                raise ValueError("Lookahead closed")
+            done = self.claimed.get(key)
+            prepared = done is not None
+            if not prepared:
+                done = self.claimed[key] = threading.Event()
+        if prepared:
+            done.wait()
+            self.slots.release()        # room for one more
+        else:
+            self.compute(key, done)
+        result, error = self.results.pop(key)
+        if error is not None:
+            raise error
+        return result
+
+    def close(self):
+        '''Stops the thread, after the call it is making, if any, and
+        returns {key: result} of the results computed but never taken, e.g.
+        the remote files created for uploads that didn't run.'''
+        with self.lock:
+            self.closed = True
+        self.slots.release()            # wakes the thread waiting for room
+        self.thread.join()
+        with self.lock:
+            unused = dict((key, result) for key, (result, error)
+                          in self.results.items() if error is None)
+            self.results.clear()
+        return unused
+
+
+class TransferBatch(object):
+    '''Runs many transfers concurrently on a bounded pool of worker threads,
+    by priority, see TransferScheduler; a scheduler can be shared by
+    several batches.
+    A transfer is a function that returns the number of bytes it moved; all
+    of them share the caller's access token and the HTTP session of utils,
+    so there is no per-file authentication or connection setup.
+    A failed transfer is logged and doesn't stop the others. If run() is
+    interrupted, e.g. by Ctrl+C, the transfers not started yet are
+    cancelled, and those running are waited for STOP_TIMEOUT seconds at
+    most.'''
+
+    STOP_TIMEOUT = 5.0
+
+    def __init__(self, concurrency=4, scheduler=None):
+        self.concurrency = concurrency
+        self.scheduler = scheduler
+        self.jobs = []                  # (name, function, args, priority)
+        self.transferred = 0            # bytes
+        self.completed = []             # names
+        self.failed = []                # (name, exception)
+        self.elapsed = 0.0
+        self.cancelled = threading.Event()
+
+    def add(self, name, function, *args, **kwargs):
+        '''Adds function(*args) to the batch; name identifies the transfer
+        in logs and in the summary. Accepts a priority=number keyword
+        argument, 0 by default, lower runs first.'''
+        self.jobs.append((name, function, args,
+                          kwargs.get('priority', 0)))
+
+    def run(self):
+        '''Runs all the transfers and returns when they are finished.'''
+        if not self.jobs:
+            return self
+        scheduler = self.scheduler or TransferScheduler(
+                            max(1, min(self.concurrency, len(self.jobs))))
+        results = Queue.Queue()
+        started = time.time()
+        try:
+            # in order too, the first job starts as soon as it is submitted
+            for name, function, args, priority in sorted(
+                                    self.jobs, key=lambda job: job[3]):
+                scheduler.submit(priority, self.run_job,
+                                 ((name, function, args),), results.put)
+            # results come back as soon as each transfer finishes
+            for i in range(len(self.jobs)):
+                while True:
+                    try:
+                        # without a timeout, Ctrl+C isn't handled while waiting
+                        name, size, error = results.get(timeout=1)
+                        break
+                    except Queue.Empty:
+                        continue
+                if error is None:
+                    self.completed.append(name)
+                    self.transferred += size or 0
+                    logger.info("{0} done".format(name))
+                else:
+                    self.failed.append((name, error))
+                    logger.error("{0} failed: {1}".format(name, error))
+        except BaseException:
+            # a shared scheduler is left running, without the jobs of
+            # this batch
+            self.cancelled.set()
+            if self.scheduler is None:
+                scheduler.close(cancel=True, timeout=self.STOP_TIMEOUT)
+            raise
+        if self.scheduler is None:
+            scheduler.close()
+        self.elapsed = time.time() - started
+        return self
+
+    def run_job(self, job):
+        '''Runs in a worker thread; exceptions are returned, not raised, so
+        one failure doesn't abort the whole batch.'''
+        name, function, args = job
+        if self.cancelled.is_set():
+            return name, 0, IOError("Cancelled")
+        try:
+            with METRICS.span('transfer', job=name):
+                return name, function(*args), None
+        except Exception as e:
+            logger.debug("%s failed", name, exc_info=True)
+            return name, 0, e
+
+    def summary(self):
+        '''Returns the aggregate throughput of the batch, as text.'''
+        megabytes = self.transferred / (1024.0 * 1024)
+        throughput = megabytes / self.elapsed if self.elapsed else 0.0
+        return ("{0} files, {1:.1f} MB in {2:.1f} s ({3:.2f} MB/s), "
+                "{4} failed".format(len(self.completed), megabytes,
+                                    self.elapsed, throughput,
+                                    len(self.failed)))
+
+
+if __name__ == '__main__':
+    print("This file should not be used directly, it is used by sugarsync.py.")
@@ -3,42 +3,378 @@
 """Contains utility classes needed for parsing XML, etc."""
 
 import xml.etree.ElementTree as ET        # convert to and from XML
-import xml.dom.minidom      # a light-weight implementation of the DOM i-face
 import urllib2                            # open urls
 import requests             # replaces urllib2, HTTP for Humans
 import logging             
+import threading
+import Queue
+import hashlib
+import collections
+import os
+import errno
+import mmap
+import time
+import random
+import email.utils
 
-def make_request(http_request):
-        """Makes the actual HTTP request and gets a HTTP response, handling 
-        any exceptions."""
-       
-        try:
-            """
-            urllib2 uses httplib which uses the socket module.
-            By default the socket module has no timeout and can hang. So you 
-            should specify how long a socket should wait for a response before 
-            timing out.
-            """
-            response = urllib2.urlopen(http_request)
-        except urllib2.HTTPError as e:
-            logger.debug("The server couldn't fulfill the request.")
-            logger.debug('Error code: ', e.code)
-            # If we get a redirect, the URL of the page fetched may not be 
-            # the same as the URL requested, so we need the real url:
-            logger.debug("The actual URL you got the response from:")
-            logger.debug(e.geturl()) 
-            logger.debug("Here are the response headers:")
-            logger.debug(e.info())
-            logger.debug("Response body, usually HTML format:")              
-            logger.debug(e.read())               # reads the HTML page with the error
-        except urllib2.URLError as e:
-            logger.error("We failed to reach a server.")
-            logger.error("Reason: ", e.reason)
-        else: 
-            logger.debug("Got response from server!")
-
-            return response    # obj. with .geturl(), .read(), .info() methods
+# sugarsync packages:
+from metrics import METRICS, TimedHTTPAdapter, traced
+
+
+# All the requests go to the same host, so they share one requests.Session
+# which keeps the connections alive in a pool; this way only the first 
+# request pays for the TCP and TLS handshakes.
+POOL_SIZE = 10           # max. connections kept alive per host
+TIMEOUT = (10, 60)       # (connect, read) timeouts, in seconds
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def configure_session(pool_size=POOL_SIZE, timeout=TIMEOUT, policy=None):
+    """Creates the HTTP session shared by all the API classes, replacing 
+    the previous one. timeout is either a number of seconds or a 
+    (connect, read) tuple; policy, a RequestPolicy, replaces the one used
+    by make_request()."""
+    
+    global _session, TIMEOUT, POLICY
+    
+    session = requests.Session()
+    # the adapter's connections report how long they took to open
+    adapter = TimedHTTPAdapter(pool_connections=pool_size,
+                               pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    
+    with _session_lock:
+        old_session, _session = _session, session
+        TIMEOUT = timeout
+        if policy is not None:
+            POLICY = policy
+    if old_session is not None:
+        old_session.close()
+    return session
+
+
+def get_session():
+    """Returns the shared HTTP session, creating it on first use."""
+    
+    if _session is None:
+        configure_session()
+    return _session
+
+
+class PutRequest(urllib2.Request):
+    """urllib2.Request makes only GET and POST requests."""
+    
+    def get_method(self):
+        return 'PUT'
+
+
+class HTTPResponse(object):
+    """Wraps a requests.Response, keeping the interface of the responses 
+    returned by urllib2.urlopen(): .geturl(), .info(), .read(), .code
+    The bytes read are counted in stats, a metrics.EndpointStats."""
+    
+    def __init__(self, response, stats=None):
+        self.response = response
+        self.code = response.status_code
+        self.stats = stats
+        
+    def getcode(self):
+        return self.code
+    
+    def geturl(self):
+        return self.response.url
+    
+    def info(self):
+        '''Returns the response headers, a case insensitive dictionary.'''
+        return self.response.headers
+    
+    def read(self, size=None):
+        '''Reads size bytes, or everything up to the end of the body.
+        Like with urllib2, the body can be read only once.'''
+        data = self.response.raw.read(size, decode_content=True)
+        if self.stats is not None:
+            METRICS.record_received(self.stats, len(data))
+        return data
+    
+    def close(self):
+        self.response.close()
+
+
+class RequestError(IOError):
+    """A request failed for good. code is the HTTP status code, None if no
+    response was received; response is the HTTPResponse, if any, with its
+    body already read."""
+    
+    def __init__(self, message, code=None, response=None):
+        super(RequestError, self).__init__(message)
+        self.code = code
+        self.response = response
+
+
+class CircuitOpenError(RequestError):
+    """The API failed too many times in a row, requests fail at once 
+    instead of adding to the load and waiting for timeouts."""
+
+
+class CircuitBreaker(object):
+    """Counts the consecutive failures that mean the API is degraded (5xx, 
+    connection errors, timeouts). After threshold of them the circuit 
+    opens: for reset_timeout seconds every request fails at once with 
+    CircuitOpenError. Then one trial request is let through; if it 
+    succeeds the circuit closes, if it fails the circuit opens again.
+    threshold=None disables it."""
+    
+    def __init__(self, threshold=5, reset_timeout=30.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened = None              # when the circuit opened
+        # the thread making the trial request, None if there is none
+        self.trial = None
+    
+    def before_request(self):
+        with self.lock:
+            if self.opened is None:
+                return
+            remaining = self.opened + self.reset_timeout - time.time()
+            if remaining > 0 or self.trial is not None:
+                raise CircuitOpenError("The API failed {0} times in a row, "
+                                       "not retrying for {1:.1f} s".format(
+                                        self.failures, max(remaining, 0)))
+            self.trial = threading.current_thread().ident
+    
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.trial = None
+    
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial = None
+            if self.threshold is not None and self.failures >= self.threshold:
+                self.opened = time.time()
+    
+    def abandon(self):
+        '''The request of the current thread ended without telling anything
+        about the API, e.g. its upload body couldn't be read: if it was the
+        trial request, the next request is the trial.'''
+        with self.lock:
+            if self.trial == threading.current_thread().ident:
+                self.trial = None
+
+
+class RequestPolicy(object):
+    """How make_request() handles failures: how many times a request is 
+    retried, how long it waits in between and the circuit breaker shared 
+    by all the requests.
+    
+    The waits grow exponentially, backoff * 2 ** attempt, up to max_delay,
+    and each is a random fraction of that ("full jitter"), so that the 
+    clients that failed together don't retry together. A Retry-After 
+    response header is obeyed instead, unless it asks for more than 
+    max_delay; then the request fails at once."""
+    
+    # 429 Too Many Requests and the server errors which are usually brief
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    
+    def __init__(self, retries=4, backoff=0.5, max_delay=60.0, breaker=None):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.breaker = breaker or CircuitBreaker()
+    
+    def delay(self, attempt, retry_after=None):
+        '''Returns the seconds to wait before retry number attempt + 1.'''
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.max_delay, 
+                                     self.backoff * 2 ** attempt))
+    
+    def should_retry(self, method, status=None, error=None):
+        '''Tells if a request that failed with the HTTP status, or with the
+        requests exception error, can be retried. A POST isn't idempotent
+        (it creates a file or folder), so it is retried only if it surely
+        wasn't carried out.'''
+        if error is not None:
+            if isinstance(error, requests.exceptions.ConnectTimeout):
+                return True             # nothing was sent
+            return method != 'POST' and isinstance(error, 
+                                    (requests.exceptions.ConnectionError,
+                                     requests.exceptions.Timeout))
+        if status in (429, 503):
+            return True                 # refused without being processed
+        return method != 'POST' and status in self.RETRY_STATUSES
+    
+    @staticmethod
+    def is_degraded(status=None, error=None):
+        '''Tells if the failure counts for the circuit breaker.'''
+        if error is not None:
+            return isinstance(error, (requests.exceptions.ConnectionError,
+                                      requests.exceptions.Timeout))
+        return status >= 500
+
+
+POLICY = RequestPolicy()
+
+# the source of the access tokens, an auth.TokenProvider, see 
+# set_token_provider()
+TOKEN_PROVIDER = None
+
+
+def set_token_provider(provider):
+    """Makes make_request() send every authorized request with the access 
+    token of provider (anything with .get_token() and .invalidate(token)),
+    instead of the token its headers were built with; None stops it."""
+    
+    global TOKEN_PROVIDER
+    TOKEN_PROVIDER = provider
+
+
+def parse_retry_after(value):
+    """Returns the seconds to wait that a Retry-After header asks for, 
+    either as a number of seconds or as a HTTP date; None if there is no 
+    usable value."""
+    
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0.0, email.utils.mktime_tz(date) - time.time())
+
+
+def make_request(http_request, timeout=None, policy=None):
+        """Makes the actual HTTP request and returns a HTTP response. 
+        http_request is a urllib2.Request; it is sent through the shared 
+        session, so the connection is reused. timeout overrides the 
+        session's timeout for this request.
+        
+        Failures are retried as policy, a RequestPolicy (by default the one
+        set by configure_session()), allows; a request that fails for good
+        raises RequestError, one stopped by the circuit breaker 
+        CircuitOpenError. An upload body is sent again from its start.
+        
+        If a token provider is set, see set_token_provider(), the request 
+        is sent with its current access token, and a request rejected with
+        401 Unauthorized is sent again, once, with a new token.
         
+        The request is recorded in metrics.METRICS: its timings, bytes 
+        sent and retries, and as it is read, the bytes received."""
+        
+        policy = policy or POLICY
+        method = http_request.get_method()
+        url = http_request.get_full_url()
+        headers = dict(http_request.header_items())
+        size = len(http_request.get_data() or '')
+        started = time.time()
+        attempt = 0
+        sent = replayed = False
+        while True:
+            # the token first: renewing it is a request of its own, which
+            # must not find the trial slot of the circuit breaker taken
+            # by this one
+            token = None
+            if TOKEN_PROVIDER is not None and 'Authorization' in headers:
+                token = headers['Authorization'] = TOKEN_PROVIDER.get_token()
+            policy.breaker.before_request()
+            try:
+                data = http_request.get_data()
+                if sent and hasattr(data, 'rewind'):
+                    data.rewind()
+                status = error = retry_after = None
+                sent = True
+                timings = METRICS.begin_request()
+                try:
+                    """
+                    urllib2 uses httplib which uses the socket module.
+                    By default the socket module has no timeout and can hang. So 
+                    you should specify how long a socket should wait for a 
+                    response before timing out.
+                    """
+                    # stream=True: the body is read only when .read() is called
+                    response = get_session().request(
+                                    method, url, data=data,
+                                    headers=headers,
+                                    timeout=timeout or TIMEOUT,
+                                    stream=True)
+                except requests.exceptions.RequestException as e:
+                    error = e
+                    failure = RequestError("We failed to reach a server. "
+                                           "Reason: {0}".format(e))
+                else:
+                    if response.status_code < 400:
+                        policy.breaker.record_success()
+                        logger.debug("Got response from server!")
+                        # elapsed ends when the headers arrive
+                        ttfb = max(0.0, response.elapsed.total_seconds() -
+                                        sum(timings.values()))
+                        METRICS.record_request(method, url, response.status_code,
+                                               started, ttfb, size,
+                                               attempt + replayed, timings)
+                        return HTTPResponse(response, METRICS.stats(method, url))    # obj. with .geturl(), .read(), .info() methods
+                    status = response.status_code
+                    log_error_response(response)
+                    if status == 401 and token is not None and not replayed:
+                        # the token expired or was revoked
+                        logger.info("Access token rejected, getting a new one")
+                        policy.breaker.record_success()
+                        TOKEN_PROVIDER.invalidate(token)
+                        replayed = True
+                        continue
+                    retry_after = parse_retry_after(
+                                            response.headers.get('Retry-After'))
+                    failure = RequestError("{0} {1} failed with HTTP status "
+                                           "{2}".format(method, url, status),
+                                           status, HTTPResponse(response))
+            
+                if policy.is_degraded(status, error):
+                    policy.breaker.record_failure()
+                else:
+                    policy.breaker.record_success()
+                if (attempt >= policy.retries or 
+                        not policy.should_retry(method, status, error) or
+                        (retry_after is not None and 
+                         retry_after > policy.max_delay)):
+                    logger.error(str(failure))
+                    METRICS.record_request(method, url, status, started, None,
+                                           size, attempt + replayed, timings)
+                    raise failure
+                delay = policy.delay(attempt, retry_after)
+                attempt += 1
+                logger.info("{0}; retry {1} of {2} in {3:.1f} s".format(
+                                failure, attempt, policy.retries, delay))
+                time.sleep(delay)
+            except BaseException:
+                # e.g. the upload body couldn't be read, or Ctrl+C: the
+                # breaker mustn't wait for this attempt forever
+                policy.breaker.abandon()
+                raise
+
+
+def log_error_response(response):
+    """Logs an error response; its body is read, releasing the connection."""
+    
+    logger.debug("The server couldn't fulfill the request.")
+    logger.debug('Error code: %s', response.status_code)
+    # If we get a redirect, the URL of the page fetched may not be 
+    # the same as the URL requested, so we need the real url:
+    logger.debug("The actual URL you got the response from:")
+    logger.debug(response.url) 
+    logger.debug("Here are the response headers:")
+    logger.debug(response.headers)
+    logger.debug("Response body, usually HTML format:")              
+    logger.debug(response.content)
+        
+
 
 class XmlUtils(object):
     '''Used to parse XML files.'''
@@ -47,8 +383,15 @@ class XmlUtils(object):
         # Parse XML tree into an Element with Element nodes
         self.root = ET.fromstring(self.xml_string)      # the top most Element
         
+    def __str__(self):
+        # so that logger.debug("%s", xml_utils) formats it only if the 
+        # record is actually written
+        return self.pprint()
+    
     def pprint(self):
         '''Makes self.xml_string readable for sys.stdout or other streams.'''
+        # imported here, only debugging needs it
+        import xml.dom.minidom  # a light-weight implementation of the DOM i-face
         xml_doc = xml.dom.minidom.parseString(self.xml_string)
         pretty_xml_as_string = xml_doc.toprettyxml()
         return pretty_xml_as_string
@@ -111,20 +454,456 @@ class SugarSyncHTTPGetUtil(object):
     
 
 class FileDownloadAPI(SugarSyncHTTPGetUtil):
-    """Sample class for file download."""
+    """Sample class for file download. The file data is streamed to disk 
+    in chunks, so the memory used doesn't depend on the file size."""
+    
+    # bytes read from the response and written to disk at a time
+    CHUNK_SIZE = 64 * 1024
+    # how often (in bytes) the journal of the download is brought up to date
+    JOURNAL_INTERVAL = 8 * 1024 * 1024
+    
+    def __init__(self, access_token, url, offset=0):
+        '''offset > 0 requests only the data after the first offset bytes 
+        (HTTP Range request), to continue an interrupted download.'''
+        
+        self.offset = offset
+        self.position = offset          # bytes on disk, see progress()
+        super(FileDownloadAPI, self).__init__(access_token, url)
     
     def run(self):
         '''Calls the methods in an immutable order. Overrides 
-        the parent's run(). It is being called by __init__().'''
+        the parent's run(). It is being called by __init__().
+        The body is not read here, download() reads it.'''
         
+        if self.offset:
+            self.headers['Range'] = 'bytes={0}-'.format(self.offset)
         self.make_get_request(self.url)
-        self.get_info()
+        self.get_size()
+    
+    def get_size(self):
+        '''Sets self.size to the size of the whole remote file (None if 
+        unknown) and self.offset to where the response data starts.'''
+        
+        self.size = None
+        headers = self.response.info()
+        if self.response.code == 206:         # Partial Content
+            # e.g. Content-Range: bytes 1000-1999/2000
+            total = headers.get('Content-Range', '').rpartition('/')[2]
+            if total.isdigit():
+                self.size = int(total)
+        else:
+            # the server ignored the Range header and sent the whole file
+            self.offset = 0
+            length = headers.get('Content-Length', '')
+            if length.isdigit():
+                self.size = int(length)
+        return self.size
+    
+    def progress(self):
+        '''Returns (bytes downloaded, total size or None); can be called from
+        another thread while download() runs, e.g. to display progress.'''
+        return self.position, self.size
+    
+    @traced('download')
+    def download(self, filename, chunk_size=None, checksum=None, 
+                 journal=None):
+        """Writes the downloaded data to the local file.
+        
+        The data goes to filename + '.part' first, which is renamed to 
+        filename only when the download is complete, so filename is never 
+        left half written. checksum is the name of a hashlib algorithm, 
+        e.g. 'md5'; the digest is computed while the data is written and 
+        returned as a hex string. 
+        If a transfers.TransferJournal is given, the number of bytes safely
+        written to disk is recorded in it, so the download can be resumed
+        later with FileDownloadAPI(access_token, url, journal.offset)."""
+        
+        chunk_size = chunk_size or self.CHUNK_SIZE
+        digest = hashlib.new(checksum) if checksum else None
+        self.temp_filename = filename + '.part'
+        
+        # continue after the data already downloaded, if any
+        mode = 'r+b' if self.offset else 'wb'
+        with open(self.temp_filename, mode) as stream:
+            if digest is not None:
+                # the digest must include the data downloaded before
+                remaining = self.offset
+                while remaining > 0:
+                    chunk = stream.read(min(chunk_size, remaining))
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    remaining -= len(chunk)
+            stream.seek(self.offset)
+            stream.truncate()
+            
+            position = synced = self.offset
+            if journal is not None:
+                journal.start(self.url, self.size, position)
+            try:
+                while True:
+                    chunk = self.response.read(chunk_size)
+                    if not chunk:
+                        break
+                    throttle('download', len(chunk))
+                    stream.write(chunk)
+                    position += len(chunk)
+                    self.position = position
+                    if digest is not None:
+                        digest.update(chunk)
+                    if (journal is not None and 
+                            position - synced >= self.JOURNAL_INTERVAL):
+                        stream.flush()
+                        os.fsync(stream.fileno())
+                        journal.update(position)
+                        synced = position
+            finally:
+                # make sure the data is on disk before the rename, or before
+                # it is recorded in the journal if the connection dropped
+                stream.flush()
+                os.fsync(stream.fileno())
+                if journal is not None and position != synced:
+                    journal.update(position)
+        
+        if self.size is not None and position != self.size:
+            raise IOError("Download of {0} incomplete: got {1} of {2} "
+                          "bytes".format(filename, position, self.size))
+        os.rename(self.temp_filename, filename)    # atomic on POSIX
+        if journal is not None:
+            journal.finish()
+        
+        self.checksum = digest.hexdigest() if digest is not None else None
+        return self.checksum
+
+
+class SegmentedDownloadAPI(FileDownloadAPI):
+    """Downloads one file over several connections at once, for large files
+    that a single connection can't transfer at the speed of the link.
+    
+    The file is split into byte ranges of segment_size bytes, fetched by
+    concurrency threads with Range requests over the shared session (its
+    pool_size should be at least concurrency), and each range is written
+    at its own offset in the file, allocated at its final size first. A
+    range whose transfer fails is requested again from the byte where it
+    stopped, up to RETRIES times, while the others are kept.
+    The request made by __init__ is for the first range; its Content-Range
+    header tells the size of the file. A server that ignores the Range
+    header sends the whole file instead, which is then downloaded as one
+    stream, like FileDownloadAPI does."""
+    
+    SEGMENT_SIZE = 8 * 1024 * 1024
+    # attempts of a range after the first one, beyond those of make_request()
+    RETRIES = 3
+    
+    def __init__(self, access_token, url, concurrency=4, segment_size=None):
+        self.concurrency = concurrency
+        self.segment_size = segment_size or self.SEGMENT_SIZE
+        self.received = {}              # range start -> bytes written
+        super(SegmentedDownloadAPI, self).__init__(access_token, url)
+    
+    def run(self):
+        '''Requests the first range. Overrides the parent's run().'''
+        try:
+            self.response = self.request_range(0, self.segment_size - 1)
+        except RequestError as e:
+            if e.code != 416:           # Range Not Satisfiable: empty file
+                raise
+            self.make_get_request(self.url)
+        self.get_size()
+    
+    def request_range(self, start, end):
+        '''Returns the response to a GET of the bytes start to end, both
+        included.'''
+        headers = dict(self.headers, Range='bytes={0}-{1}'.format(start, end))
+        return make_request(urllib2.Request(self.url, headers=headers))
+    
+    def segments(self):
+        '''Returns the (start, end) byte ranges of the file, end included.'''
+        return [(start, min(start + self.segment_size, self.size) - 1)
+                for start in range(0, self.size, self.segment_size)]
+    
+    def progress(self):
+        if not self.received:
+            return super(SegmentedDownloadAPI, self).progress()
+        return sum(self.received.values()), self.size
     
-    def download(self, filename):
-        """Writes the downloaded data to the local file."""
+    @traced('download')
+    def download(self, filename, chunk_size=None, checksum=None):
+        """Writes the downloaded data to filename, through filename +
+        '.part' like FileDownloadAPI.download(); returns the hex digest of
+        the data if checksum, the name of a hashlib algorithm, is given.
+        The digest is computed once the file is complete, since the ranges
+        arrive in any order."""
+    
+        if self.response.code == 206 and self.size is None:
+            # Content-Range: bytes 0-8388607/* - the size is unknown, so the
+            # ranges can't be planned; the whole file is requested instead
+            self.response.close()
+            self.make_get_request(self.url)
+            self.get_size()
+        if self.response.code != 206 or len(self.segments()) == 1:
+            # the whole file is coming, on this connection, as one stream:
+            # no threads to start for a file in one range
+            return super(SegmentedDownloadAPI, self).download(
+                                                filename, chunk_size, checksum)
+    
+        chunk_size = chunk_size or self.CHUNK_SIZE
+        self.temp_filename = filename + '.part'
+        segments = self.segments()
+        # every key exists before the threads start, so that progress()
+        # can iterate while they update the values
+        self.received = dict((start, 0) for start, end in segments)
+        with open(self.temp_filename, 'wb') as stream:
+            stream.truncate(self.size)
+    
+        # plain threads: a ThreadPool costs about 0.1 s to start and join,
+        # more than a small file takes to download
+        pending = collections.deque(segments)
+        errors = {}
+        def fetch_segments():
+            while True:
+                try:
+                    segment = pending.popleft()     # atomic
+                except IndexError:
+                    return
+                errors[segment] = self.fetch_segment(segment, chunk_size)
+        threads = [threading.Thread(target=fetch_segments)
+                   for i in range(max(1, min(self.concurrency,
+                                             len(segments))))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        failed = [(segment, errors[segment]) for segment in segments
+                  if errors.get(segment) is not None]
+        if failed:
+            raise IOError("Download of {0} failed: {1} of {2} ranges, the "
+                          "first one with: {3}".format(filename, len(failed),
+                                                       len(segments),
+                                                       failed[0][1]))
+    
+        position = sum(self.received.values())
+        with open(self.temp_filename, 'r+b') as stream:
+            stream.seek(0, os.SEEK_END)
+            if position != self.size or stream.tell() != self.size:
+                raise IOError("Download of {0} incomplete: got {1} of {2} "
+                              "bytes".format(filename, position, self.size))
+            # make sure the data is on disk before the rename
+            os.fsync(stream.fileno())
+        os.rename(self.temp_filename, filename)    # atomic on POSIX
+    
+        self.checksum = hash_file(filename, checksum) if checksum else None
+        return self.checksum
+    
+    def fetch_segment(self, segment, chunk_size):
+        """Runs in a worker thread: writes the bytes of one range at their
+        offset. Each thread has a file object of its own, so the offsets
+        of the others don't move under it. Returns the exception that made
+        it give up, None if the range is complete."""
+    
+        start, end = segment
+        position = start
+        # the first range was requested by __init__
+        response = self.response if start == 0 else None
+        attempt = 0
+        with open(self.temp_filename, 'r+b') as stream:
+            while True:
+                try:
+                    if response is None:
+                        response = self.request_range(position, end)
+                        if response.code != 206:
+                            raise IOError("The server ignored the range "
+                                          "{0}-{1}".format(position, end))
+                    stream.seek(position)
+                    while position <= end:
+                        chunk = response.read(min(chunk_size,
+                                                  end + 1 - position))
+                        if not chunk:
+                            raise IOError("The connection closed at byte "
+                                          "{0}".format(position))
+                        throttle('download', len(chunk))
+                        stream.write(chunk)
+                        position += len(chunk)
+                        self.received[start] = position - start
+                    return None
+                except Exception as e:
+                    if response is not None:
+                        response.close()
+                        response = None
+                    if attempt >= self.RETRIES or not self.can_retry(e):
+                        logger.error("Range {0}-{1} of {2} failed: "
+                                     "{3}".format(start, end, self.url, e))
+                        return e
+                    delay = POLICY.delay(attempt)
+                    attempt += 1
+                    logger.info("Range {0}-{1} of {2} failed at byte {3}: "
+                                "{4}; retry {5} of {6} in {7:.1f} s".format(
+                                    start, end, self.url, position, e,
+                                    attempt, self.RETRIES, delay))
+                    time.sleep(delay)
+    
+    @staticmethod
+    def can_retry(error):
+        '''Tells if a range that failed with error is worth requesting
+        again; make_request() already retried it if it could.'''
+        if isinstance(error, CircuitOpenError):
+            return False
+        if isinstance(error, RequestError) and error.code is not None:
+            return POLICY.should_retry('GET', error.code)
+        # the connection dropped, or closed early, in the middle of the data
+        return True
+
+
+class RemoteFile(SugarSyncHTTPGetUtil):
+    """Read-only file-like object over the data of a remote file, with
+    read(), seek() and tell(), for looking at parts of a large file, e.g.
+    the header of an archive or the end of a log, without downloading it.
 
-        with open(filename, 'wb') as stream:       # open(filename_or_a_path)
-            downloaded_file = stream.write(self.info)  
+    The data is fetched in blocks of block_size bytes with Range requests
+    and the last cache_blocks blocks used are kept in memory. A read that
+    continues where the one before stopped fetches read_ahead more blocks
+    in the same request, so reading the file through costs one round-trip
+    per 1 + read_ahead blocks.
+    The size of the file is needed to seek from its end; if it isn't
+    given, e.g. from the listing, __init__ fetches the first block, whose
+    Content-Range header tells it. Like file objects, a RemoteFile must not
+    be shared by threads."""
+
+    BLOCK_SIZE = 256 * 1024
+    CACHE_BLOCKS = 16
+    READ_AHEAD = 3
+
+    def __init__(self, access_token, url, size=None, block_size=None,
+                 cache_blocks=None, read_ahead=None):
+        self.size = size
+        self.block_size = block_size or self.BLOCK_SIZE
+        self.read_ahead = self.READ_AHEAD if read_ahead is None else read_ahead
+        # room for at least a block and the ones read ahead with it
+        self.cache_blocks = max(cache_blocks or self.CACHE_BLOCKS,
+                                self.read_ahead + 1)
+        self.blocks = collections.OrderedDict()  # block number -> data, LRU
+        self.position = 0
+        self.last_block = None          # the block the last read ended in
+        self.received = 0               # bytes fetched from the server
+        self.closed = False
+        super(RemoteFile, self).__init__(access_token, url)
+
+    def run(self):
+        '''Gets the size of the file, if it isn't known, by fetching its
+        first block. Overrides the parent's run().'''
+        if self.size is None:
+            try:
+                self.fetch(0, 1)
+            except RequestError as e:
+                if e.code != 416:       # Range Not Satisfiable: empty file
+                    raise
+                self.size = 0
+
+    def fetch(self, first, count):
+        '''Fetches count blocks from the block first on, in one request, and
+        adds them to the cache.'''
+
+        start = first * self.block_size
+        end = (first + count) * self.block_size - 1
+        if self.size is not None:
+            end = min(end, self.size - 1)
+        headers = dict(self.headers, Range='bytes={0}-{1}'.format(start, end))
+        response = make_request(urllib2.Request(self.url, headers=headers))
+        try:
+            headers = response.info()
+            if response.code == 206:
+                # e.g. Content-Range: bytes 0-262143/1048576
+                total = headers.get('Content-Range', '').rpartition('/')[2]
+            else:
+                # the whole file, which is fine if it is all in the range,
+                # e.g. an empty one
+                total = headers.get('Content-Length', '')
+                if start or not total.isdigit() or int(total) > end + 1:
+                    raise IOError("The server ignored the range {0}-{1} of "
+                                  "{2}".format(start, end, self.url))
+            if self.size is None:
+                if not total.isdigit():
+                    raise IOError("The size of {0} is "
+                                  "unknown".format(self.url))
+                self.size = int(total)
+                end = min(end, self.size - 1)
+            data = response.read()
+        finally:
+            response.close()
+        if len(data) != end + 1 - start:
+            raise IOError("Got {0} bytes of the range {1}-{2} of "
+                          "{3}".format(len(data), start, end, self.url))
+        throttle('download', len(data))
+        self.received += len(data)
+        for offset in range(0, len(data), self.block_size):
+            self.blocks[first + offset // self.block_size] = \
+                data[offset:offset + self.block_size]
+        while len(self.blocks) > self.cache_blocks:
+            self.blocks.popitem(last=False)
+
+    def get_block(self, number):
+        '''Returns the data of a block, from the cache if it's there.'''
+
+        data = self.blocks.pop(number, None)
+        if data is None:
+            count = 1
+            if number == self.last_block or number - 1 == self.last_block:
+                # a sequential read: the next blocks will be asked for too,
+                # up to the first one already cached
+                last = (self.size - 1) // self.block_size
+                while (count <= self.read_ahead and number + count <= last
+                       and number + count not in self.blocks):
+                    count += 1
+            self.fetch(number, count)
+            data = self.blocks.pop(number)
+        self.blocks[number] = data      # the most recently used now
+        return data
+
+    def read(self, size=-1):
+        '''Returns at most size bytes, all the rest of the file if size is
+        negative, '' at the end of the file.'''
+
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        remaining = self.size - self.position
+        if size is None or size < 0 or size > remaining:
+            size = max(0, remaining)
+        chunks = []
+        while size > 0:
+            number, offset = divmod(self.position, self.block_size)
+            chunk = self.get_block(number)[offset:offset + size]
+            chunks.append(chunk)
+            self.position += len(chunk)
+            size -= len(chunk)
+            self.last_block = number
+        return ''.join(chunks)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        elif whence != os.SEEK_SET:
+            raise ValueError("Invalid whence ({0})".format(whence))
+        if offset < 0:
+            raise IOError(errno.EINVAL, "Invalid argument")
+        self.position = offset
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.closed = True
+        self.blocks.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
 
 """When you upload a file, first you create the file in the target folder, 
@@ -185,6 +964,222 @@ class FileCreation():
                                                         media_type)
 
 
+class FolderCreation(FileCreation):
+    """Sample class used for creating a folder within a collection; url is
+    the URL of the collection (not of its contents)."""
+
+    # template used for creating a folder:
+    CREATE_FOLDER_REQUEST_TEMPLATE = ('<?xml version="1.0" encoding="UTF-8" ?>'
+                                        "<folder>"
+                                                "<displayName>{0}</displayName>"
+                                        "</folder>")
+
+    def create_folder(self, display_name):
+        '''Creates the folder and returns its URL; the URL of its contents
+        is the folder URL + "/contents".'''
+
+        data = self.CREATE_FOLDER_REQUEST_TEMPLATE.format(display_name)
+        self.make_post_request(self.url, data)
+
+        # get the location of the folder:
+        self.folderLink = self.response.info().get('Location', '')
+        if self.folderLink == '':
+            raise ValueError("Folder link is empty!")
+
+        return self.folderLink
+
+
+class TokenBucket(object):
+    """Limits a data rate, shared by any number of threads: rate bytes 
+    per second on average, with bursts of up to burst bytes (one second's 
+    worth by default). consume() takes bytes from the bucket and waits 
+    until the bucket has refilled enough to cover them."""
+    
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+    
+    def consume(self, size):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, 
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # the bucket goes into debt, the next callers wait for it too
+            self.tokens -= size
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+# TokenBuckets limiting the bandwidth used by all the transfers together, 
+# see set_bandwidth_limits()
+BANDWIDTH_LIMITS = {'upload': None, 'download': None, 'total': None}
+
+
+def set_bandwidth_limits(upload=None, download=None, total=None):
+    """Caps the bandwidth of the uploads, of the downloads and of both, in 
+    bytes per second; None is unlimited. The caps apply to all the 
+    transfers together, however many run at the same time."""
+    
+    for name, rate in [('upload', upload), ('download', download),
+                       ('total', total)]:
+        BANDWIDTH_LIMITS[name] = TokenBucket(rate) if rate else None
+
+
+def throttle(direction, size):
+    """Waits until size more bytes can be transferred in direction, 
+    "upload" or "download", within the bandwidth limits."""
+    
+    for name in (direction, 'total'):
+        bucket = BANDWIDTH_LIMITS[name]
+        if bucket is not None:
+            bucket.consume(size)
+
+
+def hash_file(path, algorithm='sha1', chunk_size=64 * 1024):
+    '''Returns the hex digest of a file's content; the file is read
+    chunk_size bytes at a time, never whole.'''
+
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as stream:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class UploadStream(object):
+    '''File-like object used as the body of an upload request. It hands out 
+    the data of a file object or of an mmap at most buffer_size bytes at a 
+    time, so the file is never copied whole in memory. len() tells requests
+    how many bytes are left, which becomes the Content-Length. Reading 
+    waits as needed to stay within the upload bandwidth limit.'''
+    
+    # httplib sends file-like bodies in blocks of 8192 bytes
+    BUFFER_SIZE = 8192
+    
+    def __init__(self, source, length, buffer_size=None):
+        self.source = source            # file object or mmap, with .read()
+        self.length = length
+        self.position = 0
+        self.buffer_size = buffer_size or self.BUFFER_SIZE
+        
+    def __len__(self):
+        return self.length - self.position
+    
+    def rewind(self):
+        '''Goes back to the start of the data, to send it again when the
+        request is retried.'''
+        self.source.seek(0)
+        self.position = 0
+    
+    def __iter__(self):
+        while True:
+            chunk = self.read()
+            if not chunk:
+                break
+            yield chunk
+    
+    def read(self, size=None):
+        if size is None or size < 0 or size > self.buffer_size:
+            size = self.buffer_size
+        chunk = self.source.read(min(size, len(self)))
+        self.position += len(chunk)
+        throttle('upload', len(chunk))
+        return chunk
+
+
+class PipelinedUploadStream(UploadStream):
+    '''UploadStream whose data is read from the disk, and hashed, by a
+    thread of its own while the blocks read before are being sent: up to
+    depth blocks of block_size bytes wait in a bounded queue, so the disk
+    reads, the checksum and the network overlap instead of adding up, and
+    the memory used stays depth * block_size whatever the file size.
+    With checksum, the name of a hashlib algorithm, the digest of the data
+    is in .digest once it was all read.'''
+    
+    BLOCK_SIZE = 256 * 1024
+    DEPTH = 4
+    
+    def __init__(self, source, length, buffer_size=None, checksum=None,
+                 block_size=None, depth=None):
+        super(PipelinedUploadStream, self).__init__(source, length,
+                                                    buffer_size)
+        self.checksum = checksum
+        self.block_size = block_size or self.BLOCK_SIZE
+        self.depth = depth or self.DEPTH
+        self.start_reader()
+    
+    def start_reader(self):
+        self.block = ''                 # the block being handed out
+        self.offset = 0                 # ... and how much of it was
+        self.digest = hashlib.new(self.checksum) if self.checksum else None
+        self.blocks = Queue.Queue(self.depth)
+        self.stopped = threading.Event()
+        self.reader = threading.Thread(target=self.read_blocks,
+                                       args=(self.blocks, self.stopped,
+                                             self.digest))
+        self.reader.daemon = True
+        self.reader.start()
+    
+    def read_blocks(self, blocks, stopped, digest):
+        '''Runs in the reader thread; the arguments are those of the current
+        attempt, see rewind(). An error is handed to read() to raise.'''
+        remaining = self.length
+        while True:
+            try:
+                block = self.source.read(min(self.block_size, remaining))
+                remaining -= len(block)
+                if digest is not None:
+                    digest.update(block)
+            except Exception as e:
+                block = e
+            # never blocked for good: the request may have been abandoned
+            while not stopped.is_set():
+                try:
+                    blocks.put(block, timeout=0.1)
+                    break
+                except Queue.Full:
+                    pass
+            if stopped.is_set() or not block or isinstance(block, Exception):
+                return
+    
+    def stop(self):
+        '''Stops the reader thread; call it before closing the source.'''
+        self.stopped.set()
+        self.reader.join()
+    
+    def rewind(self):
+        self.stop()
+        super(PipelinedUploadStream, self).rewind()
+        self.start_reader()
+    
+    def read(self, size=None):
+        if size is None or size < 0 or size > self.buffer_size:
+            size = self.buffer_size
+        if not len(self):
+            return ''
+        if self.offset >= len(self.block):
+            self.block = self.blocks.get()
+            self.offset = 0
+            if isinstance(self.block, Exception):
+                raise self.block
+            if not self.block:
+                raise IOError("{0} bytes missing, the file is shorter than "
+                              "when the upload started".format(len(self)))
+        chunk = self.block[self.offset:self.offset + size]
+        self.offset += len(chunk)
+        self.position += len(chunk)
+        throttle('upload', len(chunk))
+        return chunk
+
+
 class FileUploadAPI(object):
     '''Sample class for uploading a file.'''
     
@@ -194,13 +1189,57 @@ class FileUploadAPI(object):
         self.headers = {'User-Agent' : self.API_SAMPLE_USER_AGENT,
                         'Content-Type': 'application/octet-stream; charset=UTF-8',
                         'Authorization': access_token}
+        self.stream = None              # the UploadStream being sent
+        self.size = None
+        self.checksum = None
     
-    def upload_file(self, file_data_url, local_file_path):
-        stream = open(local_file_path, 'rb')    # open(filename_or_a_path)
-        data = stream.read()                    # read until EOF
-        self.headers['Content-Length'] = str(len(data))
-        self.response = requests.put(file_data_url, data=data, headers=self.headers)
+    def progress(self):
+        '''Returns (bytes sent, total size or None); can be called from
+        another thread while upload_file() runs. A retried request starts
+        again from 0.'''
+        # not "if self.stream": its len() is what is left to send
+        return getattr(self.stream, 'position', 0), self.size
+    
+    @traced('upload')
+    def upload_file(self, file_data_url, local_file_path, use_mmap=False,
+                    buffer_size=None, checksum=None, pipelined=True):
+        '''Streams the local file to file_data_url. With use_mmap=True the 
+        data is read from a memory map of the file instead of through the
+        file object, leaving the caching to the kernel's page cache.
+        With pipelined=True the file is read ahead by another thread while
+        the data is sent, see PipelinedUploadStream. With checksum, the 
+        name of a hashlib algorithm, the hex digest of the data sent is 
+        kept in self.checksum; pipelined, it is computed on the way.'''
+        
+        with open(local_file_path, 'rb') as stream:  # open(filename_or_a_path)
+            size = os.fstat(stream.fileno()).st_size
+            source = stream
+            # empty files can't be mapped
+            if use_mmap and size > 0:
+                source = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+            data = ''
+            try:
+                if size and pipelined:
+                    data = PipelinedUploadStream(source, size, buffer_size,
+                                                 checksum)
+                elif size:
+                    data = UploadStream(source, size, buffer_size)
+                self.stream, self.size = data, size
+                self.headers['Content-Length'] = str(size)
+                self.request = PutRequest(file_data_url, data=data,
+                                          headers=self.headers)
+                self.response = make_request(self.request)
+            finally:
+                if isinstance(data, PipelinedUploadStream):
+                    data.stop()
+                if source is not stream:
+                    source.close()
         
+        if checksum:
+            digest = getattr(data, 'digest', None)
+            # read again only if it wasn't hashed while it was sent
+            self.checksum = (digest.hexdigest() if digest is not None else
+                             hash_file(local_file_path, checksum))
         return self.response
  
  
@@ -208,6 +1247,15 @@ def get_logger(name, file):
     '''Initialization; this is used to create any loggers needed. '''
     
     logger = logging.getLogger(name)
+    # called again, e.g. by a second sugarsync.main() in the same process:
+    # the handlers of the first call are reused, or replaced if the file is
+    # another one, so that no record is written twice
+    if getattr(logger, 'log_handlers', None):
+        if logger.log_file == file:
+            return logger
+        for handler in logger.log_handlers:
+            logger.removeHandler(handler)
+            handler.close()
     logger.setLevel(logging.DEBUG)    
     # if level = INFO, records all except DEBUG
     
@@ -229,12 +1277,16 @@ def get_logger(name, file):
     # a logger can have multiple handlers, each with its own log level
     logger.addHandler(fh)
     logger.addHandler(console)
+    logger.log_file = file
+    logger.log_handlers = [fh, console]
     
     return logger    
 
 
 ##### MAIN #####
 
-# logger initialization, the same logger in all modules, any modules that 
-# import this module will have access to this logger: 
-logger = get_logger('sugarsync', 'sugarsync.log')
+# the same logger in all modules; its handlers are added by get_logger(), 
+# called by sugarsync.main(), so importing this module creates no log file.
+# Until then the records are dropped.
+logger = logging.getLogger('sugarsync')
+logger.addHandler(logging.NullHandler())
@@ -0,0 +1,295 @@
+#!/usr/bin/python
+
+"""Contains the "watch" daemon, which keeps a local directory synchronized
+with "Magic Briefcase" while it runs, uploading the files as soon as they
+change. The changes are reported by the Linux inotify API, used through
+ctypes, so nothing is polled and nothing has to be installed."""
+
+import os
+import time
+import errno
+import struct
+import select
+import ctypes
+import ctypes.util
+import logging
+
+# sugarsync packages:
+from sync import SyncState, scan_local
+
+# same logger in all modules
+logger = logging.getLogger('sugarsync')
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event {int wd; uint32_t mask, cookie, len; char name[];}
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify(object):
+    '''Watches a directory tree with inotify. A watch covers the entries of
+    one directory only, so every directory below gets a watch of its own;
+    the directories created while watching are added as they appear.'''
+
+    MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+            IN_DELETE)
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.inotify_add_watch = libc.inotify_add_watch
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+        self.directories = {}           # watch descriptor -> directory
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, directory):
+        wd = self.inotify_add_watch(self.fd, directory, self.MASK)
+        if wd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code), directory)
+        self.directories[wd] = directory
+
+    def add_tree(self, directory):
+        '''Watches directory and all the directories below it.'''
+        for root, dirnames, filenames in os.walk(directory):
+            try:
+                self.add_watch(root)
+            except OSError as e:
+                # removed in the meantime
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def read_events(self, timeout=None):
+        '''Waits at most timeout seconds (None: forever) for events and
+        returns them as [(path, mask)]. path is None when the kernel queue
+        overflowed and events were lost.'''
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return []
+            raise
+        return list(self.parse_events(data))
+
+    def parse_events(self, data):
+        # a read returns whole events only
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            if mask & IN_IGNORED:
+                # the directory was removed, so was its watch
+                self.directories.pop(wd, None)
+            elif mask & IN_Q_OVERFLOW:
+                yield None, mask
+            elif wd in self.directories:
+                yield os.path.join(self.directories[wd], name), mask
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Debouncer(object):
+    '''Coalesces bursts of changes. The changed paths are collected until
+    none arrived for window seconds, or the first of them waited for
+    max_delay seconds, and are then handed out at once, as one batch; a
+    file saved ten times in a row is uploaded once.'''
+
+    def __init__(self, window=2.0, max_delay=30.0):
+        self.window = window
+        self.max_delay = max_delay
+        self.pending = set()
+        self.first = None               # when the first pending change arrived
+        self.last = None                # ... and the last one
+
+    def add(self, path, now=None):
+        now = time.time() if now is None else now
+        if not self.pending:
+            self.first = now
+        self.pending.add(path)
+        self.last = now
+
+    def timeout(self, now=None):
+        '''Returns the seconds until the pending batch is due, None if
+        nothing is pending.'''
+        if not self.pending:
+            return None
+        now = time.time() if now is None else now
+        due = min(self.last + self.window, self.first + self.max_delay)
+        return max(0.0, due - now)
+
+    def ready(self, now=None):
+        return self.timeout(now) == 0.0
+
+    def take(self):
+        '''Returns the pending paths, sorted, and forgets them.'''
+        batch = sorted(self.pending)
+        self.pending.clear()
+        self.first = self.last = None
+        return batch
+
+
+class WatchDaemon(object):
+    '''Uploads the files changed in the directory of a sync.SyncEngine, in
+    debounced batches. The remote tree is listed once, by the first sync;
+    each batch then compares only the changed files with what the engine
+    knows about the remote side, see SyncEngine.sync_paths().
+
+    refresh() is called before each batch, and every keepalive seconds
+    while idle; it returns a valid access token, and making a request with
+    it keeps a connection of the HTTP session open, so a batch starts
+    without authentication or connection setup. on_batch(plan, batch) is
+    called after each batch.
+
+    A batch that fails on a network error is not lost: its paths are
+    pending again and are synchronized RETRY_DELAY seconds later, twice as
+    long after each failure in a row, up to MAX_RETRY_DELAY.'''
+
+    RETRY_DELAY = 5.0
+    MAX_RETRY_DELAY = 300.0
+
+    def __init__(self, engine, refresh=None, debounce=2.0, max_delay=30.0,
+                 keepalive=240.0, on_batch=None):
+        self.engine = engine
+        self.refresh = refresh
+        self.keepalive = keepalive
+        self.on_batch = on_batch
+        self.debouncer = Debouncer(debounce, max_delay)
+        self.inotify = Inotify()
+        self.rescan = True              # list the remote tree again
+        self.refreshed = time.time()
+        self.failures = 0               # batches failed in a row
+        self.retry_at = None            # no batch before, after a failure
+
+    def run(self):
+        '''Watches until interrupted (KeyboardInterrupt).'''
+        # watch first, so that nothing changed during the first sync is lost
+        self.inotify.add_tree(self.engine.directory)
+        logger.info("Watching {0}".format(self.engine.directory))
+        try:
+            self.flush()
+            while True:
+                for path, mask in self.inotify.read_events(self.wait_time()):
+                    self.handle(path, mask)
+                if self.debouncer.ready() and not self.backing_off():
+                    self.flush()
+                elif (self.refresh is not None and
+                        time.time() - self.refreshed >= self.keepalive):
+                    self.keep_alive()
+        finally:
+            self.inotify.close()
+
+    def backing_off(self):
+        return self.retry_at is not None and time.time() < self.retry_at
+
+    def wait_time(self):
+        timeout = self.debouncer.timeout()
+        if timeout is not None and self.retry_at is not None:
+            timeout = max(timeout, self.retry_at - time.time())
+        if self.refresh is not None:
+            until_refresh = max(0.0, self.refreshed + self.keepalive -
+                                     time.time())
+            if timeout is None or until_refresh < timeout:
+                timeout = until_refresh
+        return timeout
+
+    def handle(self, path, mask):
+        if path is None:
+            logger.info("Events were lost, synchronizing everything")
+            self.rescan = True
+            self.debouncer.add(self.engine.directory)
+            return
+        name = os.path.basename(path)
+        if name.startswith(SyncState.FILENAME) or name.endswith('.part'):
+            return
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+            # files may have been created before the watch was added
+            self.inotify.add_tree(path)
+        elif mask & IN_CREATE:
+            # not written yet, IN_CLOSE_WRITE follows
+            return
+        self.debouncer.add(path)
+
+    def expand(self, paths):
+        '''Returns the relative paths of the files changed, given the local
+        paths of the files and directories that changed.'''
+        known = set(self.engine.remote) | set(self.engine.state.all())
+        changed = set()
+        for path in paths:
+            relative_path = os.path.relpath(path, self.engine.directory)
+            relative_path = relative_path.replace(os.sep, '/')
+            if os.path.isdir(path):
+                prefix = '' if relative_path == '.' else relative_path + '/'
+                changed.update(prefix + name for name in scan_local(path))
+                # the files deleted from a directory moved out of the tree
+                changed.update(name for name in known
+                               if name.startswith(prefix))
+            else:
+                changed.add(relative_path)
+                changed.update(name for name in known
+                               if name.startswith(relative_path + '/'))
+        return sorted(changed)
+
+    def refresh_token(self):
+        self.engine.access_token = self.refresh()
+        self.refreshed = time.time()
+
+    def keep_alive(self):
+        '''Refreshes the token while idle; a failure only means the next
+        batch will try again.'''
+        try:
+            self.refresh_token()
+        except (IOError, OSError) as e:
+            logger.warning("Keepalive request failed: {0}".format(e))
+            self.refreshed = time.time()
+
+    def flush(self):
+        '''Synchronizes the pending changes. If that fails on a network or
+        disk error, they are pending again, see RETRY_DELAY.'''
+        paths = self.debouncer.take()
+        try:
+            if self.refresh is not None:
+                self.refresh_token()
+            if self.rescan:
+                plan, batch = self.engine.run()
+                self.rescan = False
+            else:
+                plan, batch = self.engine.sync_paths(self.expand(paths))
+        except (IOError, OSError) as e:
+            # RequestError and CircuitOpenError are IOErrors too
+            self.failures += 1
+            delay = min(self.MAX_RETRY_DELAY,
+                        self.RETRY_DELAY * 2 ** (self.failures - 1))
+            self.retry_at = time.time() + delay
+            logger.error("Synchronization failed: {0}; trying again in "
+                         "{1:.0f} s".format(e, delay))
+            # a rescan has no paths of its own
+            for path in paths or [self.engine.directory]:
+                self.debouncer.add(path)
+            return
+        self.failures = 0
+        self.retry_at = None
+        if self.on_batch is not None:
+            self.on_batch(plan, batch)
+
+
+if __name__ == '__main__':
+    print("This file should not be used directly, it is used by sugarsync.py.")